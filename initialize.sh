@@ -12,9 +12,15 @@ fi
 
 #echo "from django.contrib.auth.models import User; if not User.objects.all().exists(): User.create_superuser('root', 'root@localhost', password='password')" | python3 src/manage.py shell
 
-python3 src/manage.py collectstatic --noinput
-python3 src/manage.py makemigrations
-python3 src/manage.py migrate --noinput
+# `initialize.sh release` is the one-shot step each deploy runs once, before
+# starting servers; they then start without touching the database
+if [ "$1" = "release" ]; then
+  python3 src/manage.py migrate --noinput
+  python3 src/manage.py createcachetable
+  python3 src/manage.py collectstatic --noinput
+  exit
+fi
 
-echo "Starting up server on 0.0.0.0:8000"
-python3 src/manage.py runserver 0.0.0.0:8000
+echo "Starting up gunicorn on 0.0.0.0:8000"
+cd src
+exec gunicorn --config pickmybruin/gunicorn_config.py pickmybruin.wsgi
@@ -28,7 +28,7 @@ class CommentFactory(factory.django.DjangoModelFactory):
         model = Comment
 
     body = fake.text()
-    blog = BlogFactory()
+    blog = factory.SubFactory(BlogFactory)
     published = timezone.now()
     author = factory.Faker('first_name')
 
@@ -6,9 +6,10 @@ from django.contrib.auth.models import User
 
 #Source files
 from users.models import Profile
-from pickmybruin import keys,settings
+from pickmybruin import keys,settings,metrics
 
 #Python Files
+import time
 import boto3
 
 class BlogPost(models.Model):
@@ -62,7 +63,13 @@ class BlogPicture(models.Model):
         )
 
         s3 = session.resource("s3")
-        s3.Object(settings.AWS_STORAGE_BUCKET_NAME, pictureid).delete()
+        start = time.time()
+        try:
+            s3.Object(settings.AWS_STORAGE_BUCKET_NAME, pictureid).delete()
+        except Exception:
+            metrics.S3_DELETE_SECONDS.labels(outcome='error').observe(time.time() - start)
+            raise
+        metrics.S3_DELETE_SECONDS.labels(outcome='ok').observe(time.time() - start)
 
 class Comment(models.Model):
     """
@@ -20,6 +20,9 @@ from django.utils import timezone
 
 #Source Files
 from .models import BlogPost, BlogPicture, Comment
+from pickmybruin import metrics
+from pickmybruin.authentication import get_own_profile
+from pickmybruin.routers import ReplicaReadsMixin
 from .serializers import *
 
 
@@ -30,7 +33,7 @@ class CreateBlogView(generics.CreateAPIView):
     #Need to add check for duplicate blog titles and content
     def post(self, request, username):
         #add check for username and url match, else return 400
-        if(self.request.user.profile.get_username() == username):
+        if(get_own_profile(self.request).get_username() == username):
             new_blog = BlogPost.objects.create(
                         title=request.data['title'],
                         author=self.request.user.first_name + ' ' + request.user.last_name,
@@ -121,7 +124,7 @@ class RUDBlogView(generics.RetrieveUpdateDestroyAPIView):
             return Response(status=400)
 
 #Return all Blog Posts or any number, 10, 20 , 50 random blogs
-class BlogView(generics.ListAPIView):
+class BlogView(ReplicaReadsMixin, generics.ListAPIView):
     queryset = BlogPost.objects.all()
     serializer_class = BlogPostSerializer
 
@@ -148,6 +151,13 @@ class BlogView(generics.ListAPIView):
 
         return queryset
 
+    # the search query runs when the page is fetched
+    def paginate_queryset(self, queryset):
+        if 'query' not in self.request.GET:
+            return super().paginate_queryset(queryset)
+        with metrics.SEARCH_SECONDS.labels(view='blog').time():
+            return super().paginate_queryset(queryset)
+
 #Check if comment has type=post, type=comment
 class CreateCommentView(generics.CreateAPIView):
     serializer_class = CommentSerializer
@@ -14,4 +14,9 @@ class RequestSerializer(WritableNestedModelSerializer):
     class Meta:
         model = Request
         fields = ('mentee', 'mentor', 'email_body', 'preferred_mentee_email', 'phone', 'date_created',)
-        read_only_fields = ('mentee', 'mentor', 'email_body', 'preferred_mentee_email', 'phone', 'date_created',)
\ No newline at end of file
+        read_only_fields = ('mentee', 'mentor', 'email_body', 'preferred_mentee_email', 'phone', 'date_created',)
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        queryset = queryset.select_related('mentee__user')
+        return MentorSerializer.setup_eager_loading(queryset, prefix='mentor__')
@@ -180,3 +180,20 @@ class ListRequestsTest(APITestCase):
     
 
 
+
+    def test_list_requests_query_count(self):
+        # profile with own mentor id, count, requests + mentee + mentor, then one
+        # prefetch per mentor m2m, however many requests there are
+        for count in (2, 20):
+            # unique last names so generated emails/usernames can't collide
+            for i in range(count):
+                factories.RequestFactory(mentor=self.mentor, mentee__user__last_name='Mentee_{}_{}'.format(count, i))
+                factories.RequestFactory(mentee=self.profile, mentor__profile__user__last_name='Mentor_{}_{}'.format(count, i))
+
+            with self.assertNumQueries(6):
+                resp = self.client.get(
+                    self.get_url,
+                )
+
+            self.assertEqual(len(resp.data['results']), 2 * count)
+            Request.objects.all().delete()
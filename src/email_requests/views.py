@@ -7,17 +7,16 @@ from .serializers import RequestSerializer
 from users.models import Profile, Mentor, User
 from .models import Request
 from rest_framework import generics
+from pickmybruin.authentication import get_own_profile
 from pickmybruin.settings import REQUEST_TEMPLATE
-
-import sendgrid
-from sendgrid.helpers.mail import Email, Content, Substitution, Mail
+from outbox.models import OutboundEmail
 
 # Create your views here.
 class EmailRequestView(generics.CreateAPIView):
     serializer_class = RequestSerializer
 
     def get_object(self):
-        return get_object_or_404(Profile, user=self.request.user)
+        return get_own_profile(self.request)
 
 
     def post(self, request, *args, **kwargs):
@@ -31,26 +30,23 @@ class EmailRequestView(generics.CreateAPIView):
         user_message = request.data.get('message', 'No message entered')
 
         mentee_user=self.request.user
-        mentee_profile = get_object_or_404(Profile, user=mentee_user)
+        mentee_profile = get_own_profile(request)
         mentee_name = mentee_user.first_name + ' ' + mentee_user.last_name
         phone_html = '' if phone_num=='' else ('<b>Phone Number:</b> ' + phone_num)
         email_html = '<b>Email:</b> ' + preferred_mentee_email
 
         if mentor.profile.notifications_enabled is True:
-            from_email =  Email('noreply@bquest.ucladevx.com')
-            to_email = Email(mentor_email)
-            subject = 'New Request from BQuest'
-            content = Content('text/html', 'N/A')
-            mail = Mail(from_email, subject, to_email, content)
-            mail.personalizations[0].add_substitution(Substitution('mentee_name', mentee_name))
-            mail.personalizations[0].add_substitution(Substitution('user_message', user_message))
-            mail.personalizations[0].add_substitution(Substitution('email_html', email_html))
-            mail.personalizations[0].add_substitution(Substitution('phone_html', phone_html))
-            mail.template_id = REQUEST_TEMPLATE
-            sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-            response = sg.client.mail.send.post(request_body=mail.get())
-            if not (200 <= response.status_code < 300):
-                raise ValidationError({'sendgrid_status_code': response.status_code})
+            OutboundEmail.enqueue(
+                to_email=mentor_email,
+                subject='New Request from BQuest',
+                template_id=REQUEST_TEMPLATE,
+                substitutions={
+                    'mentee_name': mentee_name,
+                    'user_message': user_message,
+                    'email_html': email_html,
+                    'phone_html': phone_html,
+                },
+            )
 
         new_request = Request(
             mentee=mentee_profile,
@@ -69,16 +65,15 @@ class ListOwnRequestsView(generics.ListAPIView):
     serializer_class = RequestSerializer
 
     def get_queryset(self):
-        profile = get_object_or_404(Profile, user=self.request.user)
-
-        mentor = Mentor.objects.filter(profile=profile).first()
+        profile = get_own_profile(self.request)
 
         query = Q(mentee=profile)
 
-        if (mentor is not None):
-            query |= Q(mentor=mentor)
+        if (profile.own_mentor_id is not None):
+            query |= Q(mentor_id=profile.own_mentor_id)
 
-        return Request.objects.filter(query).order_by('date_created').reverse()
+        queryset = Request.objects.filter(query).order_by('date_created').reverse()
+        return RequestSerializer.setup_eager_loading(queryset)
 
 
 
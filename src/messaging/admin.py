@@ -11,4 +11,8 @@ class MessageAdmin(admin.ModelAdmin):
 
 @admin.register(models.Thread)
 class ThreadAdmin(admin.ModelAdmin):
-    pass
\ No newline at end of file
+    pass
+
+@admin.register(models.ArchivedMessage)
+class ArchivedMessageAdmin(admin.ModelAdmin):
+    pass
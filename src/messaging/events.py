@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+NEW_MESSAGE = 'new_message'
+THREAD_READ = 'thread_read'
+
+
+def publish(event_type, profile_ids, **data):
+    """
+    NOTIFYs the messaging channel. Postgres holds notifications until the
+    surrounding transaction commits and drops them on rollback, so listeners
+    never hear about rows they can't read yet
+    """
+    payload = dict(data, type=event_type, profiles=sorted(set(id for id in profile_ids if id is not None)))
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [settings.MESSAGING_EVENTS_CHANNEL, json.dumps(payload)])
+
+
+def new_message(message):
+    thread = message.thread
+    publish(
+        NEW_MESSAGE,
+        [thread.profile_1_id, thread.profile_2_id],
+        thread_id=thread.id,
+        message_id=message.id,
+        sender_id=message.sender_id,
+    )
+
+
+def thread_read(thread, reader):
+    publish(
+        THREAD_READ,
+        [thread.profile_1_id, thread.profile_2_id],
+        thread_id=thread.id,
+        reader_id=reader.id,
+    )
+
+
+async def listen(handler, channel=None):
+    """
+    Calls handler(event) for every event published on the channel, forever.
+    Uses its own autocommit connection to MESSAGING_EVENTS_DATABASE_HOST,
+    watched by the event loop
+    """
+    import psycopg2
+    import psycopg2.extensions
+
+    loop = asyncio.get_event_loop()
+    params = dict(
+        connection.get_connection_params(),
+        host=settings.MESSAGING_EVENTS_DATABASE_HOST,
+        port=settings.MESSAGING_EVENTS_DATABASE_PORT,
+    )
+    conn = psycopg2.connect(**params)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    lost = loop.create_future()
+
+    def on_readable():
+        try:
+            conn.poll()
+        except psycopg2.Error as e:
+            loop.remove_reader(conn.fileno())
+            if not lost.done():
+                lost.set_exception(e)
+            return
+        while conn.notifies:
+            notification = conn.notifies.pop(0)
+            try:
+                handler(json.loads(notification.payload))
+            except Exception:
+                logger.exception('failed to handle messaging event %s', notification.payload)
+
+    with conn.cursor() as cursor:
+        cursor.execute('LISTEN {}'.format(channel or settings.MESSAGING_EVENTS_CHANNEL))
+    loop.add_reader(conn.fileno(), on_readable)
+    try:
+        await lost
+    finally:
+        conn.close()
@@ -0,0 +1,42 @@
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from messaging.models import ArchivedMessage, Message, Thread
+
+
+class Command(BaseCommand):
+    help = 'Move the history of threads idle for N months into the message archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=6)
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def _idle_threads(self, months):
+        cutoff = timezone.now() - relativedelta(months=months)
+        # only threads with something left to move besides the latest message
+        older = Message.objects.filter(thread=OuterRef('pk')).exclude(id=OuterRef('last_message_id'))
+        return Thread.objects.filter(
+            last_activity__lt=cutoff,
+        ).annotate(
+            has_older=Exists(older),
+        ).filter(
+            has_older=True,
+        ).order_by('id').values_list('id', flat=True)
+
+    def handle(self, *args, **kwargs):
+        threads = self._idle_threads(kwargs['months'])
+
+        moved = archived_threads = 0
+        last_id = 0
+        while True:
+            batch = list(threads.filter(id__gt=last_id)[:kwargs['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                moved += ArchivedMessage.archive_threads(batch)
+            archived_threads += len(batch)
+            last_id = batch[-1]
+
+        self.stdout.write('Archived {} messages from {} threads'.format(moved, archived_threads))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from messaging.models import Thread
+
+
+class Command(BaseCommand):
+    help = "Rebuild each thread's last message, last activity and unread counters from its messages"
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            updated = Thread.reconcile()
+        self.stdout.write('Reconciled {} threads'.format(updated))
@@ -0,0 +1,28 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+from messaging.events import listen
+from messaging.notify import get_dispatcher
+
+
+def relay(event, dispatcher):
+    """
+    Forwards an event to the websockets service for each profile it concerns.
+    TYPE stays MESSAGE_UPDATE so older clients still just refetch
+    """
+    payload = dict(event, TYPE='MESSAGE_UPDATE')
+    del payload['profiles']
+    for profile_id in event['profiles']:
+        dispatcher.notify(profile_id, payload)
+
+
+class Command(BaseCommand):
+    help = 'Relay messaging events from Postgres NOTIFY to connected clients'
+
+    def handle(self, *args, **kwargs):
+        dispatcher = get_dispatcher()
+        loop = asyncio.get_event_loop()
+        self.stdout.write('Relaying messaging events')
+        # returns only if the database connection is lost; let the process
+        # supervisor restart us
+        loop.run_until_complete(listen(lambda event: relay(event, dispatcher)))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 22:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# same as messaging.models.RECONCILE_THREADS_SQL
+RECONCILE_THREADS_SQL = """
+UPDATE messaging_thread thread SET
+    last_message_id = (
+        SELECT message.id FROM messaging_message message
+        WHERE message.thread_id = thread.id
+        ORDER BY message.timestamp DESC, message.id DESC LIMIT 1
+    ),
+    last_activity = (
+        SELECT max(message.timestamp) FROM messaging_message message
+        WHERE message.thread_id = thread.id
+    ),
+    unread_count_1 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_1_id
+    ),
+    unread_count_2 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_2_id
+    )
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0004_auto_20180305_2306'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.Message'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='unread_count_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='unread_count_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'timestamp'], name='messaging_msg_thread_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'unread'], name='messaging_msg_thread_unread'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['profile_1', '-last_activity'], name='messaging_thread_p1_activity'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['profile_2', '-last_activity'], name='messaging_thread_p2_activity'),
+        ),
+        migrations.RunSQL(RECONCILE_THREADS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 22:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Fill in the ordered pair, then fold every thread into the oldest thread for
+# the same pair: move its messages over, drop it, and rebuild the surviving
+# threads' denormalized fields. Threads missing a participant keep no pair.
+MERGE_DUPLICATE_THREADS_SQL = """
+UPDATE messaging_thread SET
+    pair_low = LEAST(profile_1_id, profile_2_id),
+    pair_high = GREATEST(profile_1_id, profile_2_id)
+WHERE profile_1_id IS NOT NULL AND profile_2_id IS NOT NULL;
+
+CREATE TEMPORARY TABLE messaging_thread_merge ON COMMIT DROP AS
+SELECT duplicate.id AS duplicate_id, keeper.id AS keeper_id
+FROM messaging_thread duplicate
+JOIN (
+    SELECT pair_low, pair_high, min(id) AS id FROM messaging_thread
+    WHERE pair_low IS NOT NULL
+    GROUP BY pair_low, pair_high
+    HAVING count(*) > 1
+) keeper ON keeper.pair_low = duplicate.pair_low AND keeper.pair_high = duplicate.pair_high
+WHERE duplicate.id <> keeper.id;
+
+UPDATE messaging_message message SET thread_id = merge.keeper_id
+FROM messaging_thread_merge merge
+WHERE message.thread_id = merge.duplicate_id;
+
+DELETE FROM messaging_thread thread
+USING messaging_thread_merge merge
+WHERE thread.id = merge.duplicate_id;
+
+UPDATE messaging_thread thread SET
+    last_message_id = (
+        SELECT message.id FROM messaging_message message
+        WHERE message.thread_id = thread.id
+        ORDER BY message.timestamp DESC, message.id DESC LIMIT 1
+    ),
+    last_activity = (
+        SELECT max(message.timestamp) FROM messaging_message message
+        WHERE message.thread_id = thread.id
+    ),
+    unread_count_1 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_1_id
+    ),
+    unread_count_2 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_2_id
+    )
+WHERE thread.id IN (SELECT DISTINCT keeper_id FROM messaging_thread_merge);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0006_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='pair_high',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='pair_low',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunSQL(MERGE_DUPLICATE_THREADS_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 22:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # separate from 0007 so the constraint isn't added in the same transaction
+    # that deleted the duplicate threads
+
+    dependencies = [
+        ('messaging', '0007_thread_pair'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='thread',
+            unique_together=set([('pair_low', 'pair_high')]),
+        ),
+    ]
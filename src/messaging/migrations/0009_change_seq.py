@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 23:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+CHANGE_SEQ_TRIGGERS_SQL = """
+CREATE FUNCTION messaging_set_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := txid_current();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messaging_thread_change_seq BEFORE INSERT OR UPDATE ON messaging_thread
+    FOR EACH ROW EXECUTE PROCEDURE messaging_set_change_seq();
+CREATE TRIGGER messaging_message_change_seq BEFORE INSERT OR UPDATE ON messaging_message
+    FOR EACH ROW EXECUTE PROCEDURE messaging_set_change_seq();
+"""
+
+DROP_CHANGE_SEQ_TRIGGERS_SQL = """
+DROP TRIGGER messaging_message_change_seq ON messaging_message;
+DROP TRIGGER messaging_thread_change_seq ON messaging_thread;
+DROP FUNCTION messaging_set_change_seq();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0008_thread_pair_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['change_seq', 'id'], name='messaging_msg_change'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['profile_1', 'change_seq'], name='messaging_thread_p1_change'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['profile_2', 'change_seq'], name='messaging_thread_p2_change'),
+        ),
+        migrations.RunSQL(CHANGE_SEQ_TRIGGERS_SQL, DROP_CHANGE_SEQ_TRIGGERS_SQL),
+    ]
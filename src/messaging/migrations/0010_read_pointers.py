@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 23:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Each participant's pointer starts at the newest message they received and
+# have read under the old per-message flag
+BACKFILL_READ_POINTERS_SQL = """
+UPDATE messaging_thread thread SET
+    last_read_message_id_1 = COALESCE((
+        SELECT max(message.id) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND NOT message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_1_id
+    ), 0),
+    last_read_message_id_2 = COALESCE((
+        SELECT max(message.id) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND NOT message.unread
+            AND message.sender_id IS DISTINCT FROM thread.profile_2_id
+    ), 0)
+"""
+
+# The unread counters were counts of unread flags. Now they are messages
+# received past the pointer, which differs wherever an unread message came
+# before a read one
+RECOUNT_UNREAD_SQL = """
+UPDATE messaging_thread thread SET
+    unread_count_1 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.id > thread.last_read_message_id_1
+            AND message.sender_id IS DISTINCT FROM thread.profile_1_id
+    ),
+    unread_count_2 = (
+        SELECT count(*) FROM messaging_message message
+        WHERE message.thread_id = thread.id AND message.id > thread.last_read_message_id_2
+            AND message.sender_id IS DISTINCT FROM thread.profile_2_id
+    )
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0009_change_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_read_message_id_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_read_message_id_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunSQL(BACKFILL_READ_POINTERS_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(RECOUNT_UNREAD_SQL, migrations.RunSQL.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='messaging_msg_thread_unread',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='unread',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'id'], name='messaging_msg_thread_id'),
+        ),
+    ]
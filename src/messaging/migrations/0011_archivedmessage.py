@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 23:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0034_mentor_completion_score'),
+        ('messaging', '0010_read_pointers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('body', models.TextField(default='')),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='users.Profile')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='archived_messages',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='thread',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='messaging.Thread'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['thread', 'timestamp', 'id'], name='messaging_arch_thread_ts_id'),
+        ),
+    ]
@@ -1,13 +1,103 @@
-from django.db import models
-from django.db.models import Q
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q, F, Value, Case, When, IntegerField, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.db.models.signals import post_save
 
 from users.models import Profile
+from . import events
 # Create your models here.
 
+# Rebuilds Thread's denormalized fields from Message. Unread counters count
+# messages past the participant's read pointer that they didn't send,
+# including archived ones
+RECONCILE_THREADS_SQL = """
+WITH messaging_all_messages AS (
+    SELECT thread_id, id, sender_id FROM messaging_message
+    UNION ALL
+    SELECT thread_id, id, sender_id FROM messaging_archivedmessage
+)
+UPDATE messaging_thread thread SET
+    last_message_id = (
+        SELECT message.id FROM messaging_message message
+        WHERE message.thread_id = thread.id
+        ORDER BY message.timestamp DESC, message.id DESC LIMIT 1
+    ),
+    last_activity = (
+        SELECT max(message.timestamp) FROM messaging_message message
+        WHERE message.thread_id = thread.id
+    ),
+    unread_count_1 = (
+        SELECT count(*) FROM messaging_all_messages message
+        WHERE message.thread_id = thread.id AND message.id > thread.last_read_message_id_1
+            AND message.sender_id IS DISTINCT FROM thread.profile_1_id
+    ),
+    unread_count_2 = (
+        SELECT count(*) FROM messaging_all_messages message
+        WHERE message.thread_id = thread.id AND message.id > thread.last_read_message_id_2
+            AND message.sender_id IS DISTINCT FROM thread.profile_2_id
+    )
+"""
+
+# Moves messages and counts them onto their thread in one statement, so a
+# thread's archived_messages always matches its archive
+ARCHIVE_THREADS_SQL = """
+WITH moved AS (
+    DELETE FROM messaging_message message
+    USING messaging_thread thread
+    WHERE message.thread_id = thread.id AND thread.id = ANY(%s)
+        AND message.id <> thread.last_message_id
+    RETURNING message.id, message.thread_id, message.sender_id, message.body, message.timestamp
+), archived AS (
+    INSERT INTO messaging_archivedmessage (id, thread_id, sender_id, body, timestamp)
+    SELECT id, thread_id, sender_id, body, timestamp FROM moved
+    RETURNING thread_id
+), counted AS (
+    UPDATE messaging_thread thread SET archived_messages = thread.archived_messages + counts.moved
+    FROM (SELECT thread_id, count(*) AS moved FROM archived GROUP BY thread_id) counts
+    WHERE thread.id = counts.thread_id
+    RETURNING counts.moved
+)
+SELECT COALESCE(sum(moved), 0) FROM counted
+"""
+
 class Thread(models.Model):
     profile_1 = models.ForeignKey(Profile, null=True, on_delete=models.SET_NULL, related_name='profile_1')
     profile_2 = models.ForeignKey(Profile, null=True, on_delete=models.SET_NULL, related_name='profile_2')
 
+    # Read receipts: the id of the last message each participant has read.
+    # Everything after it that they didn't send is unread
+    last_read_message_id_1 = models.PositiveIntegerField(default=0)
+    last_read_message_id_2 = models.PositiveIntegerField(default=0)
+
+    # Denormalized from Message so the inbox never scans messages. Kept
+    # current by message_added() and mark_read(), rebuilt by the
+    # reconcile_threads command
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity = models.DateTimeField(null=True, blank=True)
+    unread_count_1 = models.PositiveIntegerField(default=0)
+    unread_count_2 = models.PositiveIntegerField(default=0)
+
+    # The participants' profile ids in ascending order, set by save(). Unique,
+    # so there is one thread per pair and finding it is a single index probe
+    pair_low = models.PositiveIntegerField(null=True, blank=True)
+    pair_high = models.PositiveIntegerField(null=True, blank=True)
+
+    # id of the transaction that last wrote the row, set by a trigger on
+    # every insert and update. The sync endpoint reads what changed from it
+    change_seq = models.BigIntegerField(default=0, editable=False)
+
+    # how many of this thread's messages are in ArchivedMessage
+    archived_messages = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('pair_low', 'pair_high'),)
+        indexes = [
+            models.Index(fields=['profile_1', '-last_activity'], name='messaging_thread_p1_activity'),
+            models.Index(fields=['profile_2', '-last_activity'], name='messaging_thread_p2_activity'),
+            models.Index(fields=['profile_1', 'change_seq'], name='messaging_thread_p1_change'),
+            models.Index(fields=['profile_2', 'change_seq'], name='messaging_thread_p2_change'),
+        ]
+
     @staticmethod
     def getProfileQuery(prof1, prof2=None):
         query = Q(profile_1=prof1) | Q(profile_2=prof1)
@@ -15,6 +105,164 @@ class Thread(models.Model):
             query &= Q(profile_1=prof2) | Q(profile_2=prof2)
         return query
 
+    @staticmethod
+    def pair_ids(prof1, prof2):
+        return tuple(sorted((getattr(prof1, 'id', prof1), getattr(prof2, 'id', prof2))))
+
+    @classmethod
+    def for_pair(cls, prof1, prof2):
+        low, high = cls.pair_ids(prof1, prof2)
+        return cls.objects.filter(pair_low=low, pair_high=high).first()
+
+    @classmethod
+    def get_or_create_for_pair(cls, prof1, prof2):
+        """
+        Returns (thread, created). Safe when both users send their first
+        message at the same time: the losing INSERT hits the unique pair index
+        and the existing thread is returned instead
+        """
+        thread = cls.for_pair(prof1, prof2)
+        if thread is not None:
+            return thread, False
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(profile_1=prof1, profile_2=prof2), True
+        except IntegrityError:
+            low, high = cls.pair_ids(prof1, prof2)
+            return cls.objects.get(pair_low=low, pair_high=high), False
+
+    @staticmethod
+    def inbox(profile):
+        """
+        Threads `profile` takes part in, newest activity first, with everything
+        OwnThreadSerializer needs loaded by a single query: both participants
+        and their users, the latest message and the caller's unread count
+        """
+        return Thread.objects.filter(
+            Thread.getProfileQuery(profile),
+        ).select_related(
+            'profile_1__user',
+            'profile_2__user',
+            'last_message',
+        ).annotate(
+            unread_count=Case(
+                When(profile_1=profile, then=F('unread_count_1')),
+                default=F('unread_count_2'),
+                output_field=IntegerField(),
+            ),
+        ).order_by(
+            '-last_activity',
+        )
+
+    @staticmethod
+    def change_horizon():
+        """
+        Oldest transaction still in flight. Every change with a lower
+        change_seq is already committed and visible, so it is safe for a
+        client to resume from here
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def reconcile():
+        with connection.cursor() as cursor:
+            cursor.execute(RECONCILE_THREADS_SQL)
+            return cursor.rowcount
+
+    def save(self, *args, **kwargs):
+        if self.profile_1_id is not None and self.profile_2_id is not None:
+            self.pair_low, self.pair_high = Thread.pair_ids(self.profile_1_id, self.profile_2_id)
+        super().save(*args, **kwargs)
+
+    def message_added(self, message):
+        # a single UPDATE with F()/GREATEST so concurrent sends neither lose
+        # counter increments nor move last_activity backwards
+        if message.sender_id is not None and message.sender_id == self.profile_1_id:
+            unread_field = 'unread_count_2'
+        elif message.sender_id is not None and message.sender_id == self.profile_2_id:
+            unread_field = 'unread_count_1'
+        else:
+            unread_field = None
+
+        changes = {
+            'last_message': Case(
+                When(last_activity__gt=message.timestamp, then=F('last_message')),
+                default=Value(message.id),
+            ),
+            'last_activity': Greatest(F('last_activity'), Value(message.timestamp)),
+        }
+        if unread_field is None:
+            changes['unread_count_1'] = F('unread_count_1') + 1
+            changes['unread_count_2'] = F('unread_count_2') + 1
+        else:
+            changes[unread_field] = F(unread_field) + 1
+        Thread.objects.filter(id=self.id).update(**changes)
+
+    def participant_suffix(self, profile):
+        profile_id = getattr(profile, 'id', profile)
+        if profile_id is not None and profile_id == self.profile_1_id:
+            return '1'
+        if profile_id is not None and profile_id == self.profile_2_id:
+            return '2'
+        return None
+
+    def mark_read(self, profile, message_id=None):
+        """
+        Moves `profile`'s read pointer up to `message_id`, or to the latest
+        message, as one UPDATE of this row. Never moves it backwards or past
+        the latest message. Returns False if `profile` isn't in the thread or
+        nothing changed
+        """
+        suffix = self.participant_suffix(profile)
+        if suffix is None:
+            return False
+        pointer = 'last_read_message_id_' + suffix
+        counter = 'unread_count_' + suffix
+        # read against the row's own last_message so a message saved
+        # concurrently is either covered by the pointer or counted
+        threads = Thread.objects.filter(id=self.id).exclude(last_message=None)
+
+        if message_id is None:
+            return threads.filter(
+                Q(**{pointer + '__lt': F('last_message_id')}) | Q(**{counter + '__gt': 0}),
+            ).update(**{
+                pointer: Greatest(F(pointer), F('last_message_id')),
+                counter: 0,
+            }) > 0
+
+        # unread = received messages past the new pointer, an index range
+        def unread_after(model):
+            count = model.objects.filter(
+                Q(id__gt=message_id) | Q(id__gt=OuterRef('last_message_id')),
+                thread=OuterRef('id'),
+            ).exclude(
+                sender=profile,
+            ).order_by().values('thread').annotate(count=Count('*')).values('count')
+            return Coalesce(Subquery(count, output_field=IntegerField()), Value(0))
+
+        unread = unread_after(Message)
+        if self.archived_messages:
+            unread = unread + unread_after(ArchivedMessage)
+        return threads.filter(
+            Q(**{pointer + '__lt': message_id}),
+            Q(**{pointer + '__lt': F('last_message_id')}),
+        ).update(**{
+            # an id from another thread or not yet sent reads only up to here
+            pointer: Least(Value(message_id), F('last_message_id')),
+            counter: unread,
+        }) > 0
+
+    def is_unread(self, message):
+        """Whether the participant who received `message` hasn't read it yet"""
+        if message.sender_id is not None and message.sender_id == self.profile_1_id:
+            return message.id > self.last_read_message_id_2
+        if message.sender_id is not None and message.sender_id == self.profile_2_id:
+            return message.id > self.last_read_message_id_1
+        return message.id > min(self.last_read_message_id_1, self.last_read_message_id_2)
+
     def get_other_user(self, user):
         if self.profile_1 == user or self.profile_1.id == user:
             return self.profile_2
@@ -23,9 +271,62 @@ class Thread(models.Model):
         return None
 
 
-class Message(models.Model):
+class BaseMessage(models.Model):
     thread = models.ForeignKey(Thread, null=True, on_delete=models.CASCADE)
     sender = models.ForeignKey(Profile, null=True, on_delete=models.SET_NULL)
     body = models.TextField(null=False, default = '')
     timestamp = models.DateTimeField(auto_now_add=True)
-    unread = models.BooleanField(default=True)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def unread(self):
+        return self.thread.is_unread(self)
+
+
+class Message(BaseMessage):
+    # see Thread.change_seq
+    change_seq = models.BigIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['change_seq', 'id'], name='messaging_msg_change'),
+            # keyset pagination of a thread's history, see MessageCursorPagination
+            models.Index(fields=['thread', 'timestamp', 'id'], name='messaging_msg_thread_ts_id'),
+            # unread counts are a range after a read pointer
+            models.Index(fields=['thread', 'id'], name='messaging_msg_thread_id'),
+        ]
+
+
+class ArchivedMessage(BaseMessage):
+    """
+    Cold storage for the history of idle threads, moved here by the
+    archive_messages command. Keeps the original message ids, and only the
+    index history pagination needs. Every archived message is older than
+    every message still in Message for its thread
+    """
+    id = models.IntegerField(primary_key=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread', 'timestamp', 'id'], name='messaging_arch_thread_ts_id'),
+        ]
+
+    @staticmethod
+    def archive_threads(thread_ids):
+        """
+        Moves all but the latest message of each thread into the archive.
+        The latest stays so the inbox never reads the archive. Returns the
+        number of messages moved
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(ARCHIVE_THREADS_SQL, [list(thread_ids)])
+            return cursor.fetchone()[0]
+
+def message_created(sender, instance, created=False, raw=False, **kwargs):
+    if raw or not created or instance.thread_id is None:
+        return
+    instance.thread.message_added(instance)
+    events.new_message(instance)
+post_save.connect(message_created, sender=Message)
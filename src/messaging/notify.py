@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from pickmybruin import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher(object):
+    """
+    Tells the websockets service that a user has something new, without
+    making the request wait for it. notify() only puts the user on a bounded
+    queue; a background thread posts through one pooled session with short
+    timeouts. A notification of the same TYPE already waiting for the same
+    user isn't queued again; the waiting one goes out with the latest
+    payload. Each waits `coalesce_window` seconds before going out so bursts
+    collapse into one post. When the queue is full
+    notifications are dropped, since the client refetches anyway.
+    """
+    def __init__(self, url, timeout, queue_size, coalesce_window, session=None):
+        self.url = url
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.session = session or self._make_session()
+        self.counters = dict.fromkeys(['queued', 'coalesced', 'dropped', 'delivered', 'failed'], 0)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            url=settings.WEBSOCKETS_NOTIFY_URL,
+            timeout=settings.WEBSOCKETS_NOTIFY_TIMEOUT,
+            queue_size=settings.WEBSOCKETS_NOTIFY_QUEUE_SIZE,
+            coalesce_window=settings.WEBSOCKETS_NOTIFY_COALESCE_WINDOW,
+        )
+
+    def _make_session(self):
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+        return session
+
+    def _ensure_worker(self):
+        # the queue and thread don't survive a fork (gunicorn preload), so
+        # each process starts its own on first use
+        if self._pid == os.getpid():
+            return
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        # key -> the latest payload for it
+        self._pending = {}
+        self._pid = os.getpid()
+        worker = threading.Thread(target=self._run, name='websockets-notify')
+        worker.daemon = True
+        worker.start()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+        metrics.WEBSOCKETS_NOTIFICATIONS.labels(outcome=name).inc()
+
+    def notify(self, user_id, payload=None):
+        """Returns False if the notification was dropped"""
+        payload = payload or {'TYPE': 'MESSAGE_UPDATE'}
+        key = (user_id, payload.get('TYPE'))
+        with self._lock:
+            self._ensure_worker()
+            if key in self._pending:
+                self._pending[key] = payload
+                outcome = 'coalesced'
+            else:
+                try:
+                    self._queue.put_nowait((key, time.time() + self.coalesce_window))
+                except queue.Full:
+                    outcome = 'dropped'
+                else:
+                    self._pending[key] = payload
+                    outcome = 'queued'
+            self.counters[outcome] += 1
+        metrics.WEBSOCKETS_NOTIFICATIONS.labels(outcome=outcome).inc()
+        return outcome != 'dropped'
+
+    def _run(self):
+        while True:
+            key, due = self._queue.get()
+            try:
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                with self._lock:
+                    payload = self._pending.pop(key)
+                self._post(key[0], payload)
+            finally:
+                self._queue.task_done()
+
+    def _post(self, user_id, payload):
+        start = time.time()
+        try:
+            resp = self.session.post(
+                self.url % user_id,
+                json=payload,
+                timeout=self.timeout,
+            )
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            metrics.WEBSOCKETS_NOTIFY_SECONDS.labels(outcome='failed').observe(time.time() - start)
+            self._count('failed')
+            logger.warning('websockets notify for %s failed: %s', user_id, e)
+        else:
+            metrics.WEBSOCKETS_NOTIFY_SECONDS.labels(outcome='delivered').observe(time.time() - start)
+            self._count('delivered')
+
+    def join(self):
+        """Blocks until everything queued so far has been posted"""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending'] = self._queue.qsize() if self._pid == os.getpid() else 0
+        return stats
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher.from_settings()
+        return _dispatcher
@@ -0,0 +1,146 @@
+import base64
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination for a thread's messages, newest first, keyed on
+    (timestamp, id). Every page is an index range scan on
+    (thread, timestamp, id), so a page deep in a long conversation costs the
+    same as the first one, and messages sent while scrolling don't shift pages.
+
+    ?before=<cursor> returns messages older than the cursor (scrolling back),
+    ?after=<cursor> returns messages newer than it (catching up). `next` and
+    `previous` in the response are links to the older and newer pages.
+
+    If the view has get_archive_queryset() and it returns a queryset, pages
+    continue into it. Archived messages are all older than the thread's
+    remaining ones, so the archive is only read once the recent messages
+    run out in that direction.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = api_settings.PAGE_SIZE
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        limit = self.get_limit(request)
+
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        sources = [queryset]
+        archive = view.get_archive_queryset() if hasattr(view, 'get_archive_queryset') else None
+        if archive is not None:
+            sources = [archive, queryset] if after is not None else [queryset, archive]
+
+        # one extra row tells whether there is another page in this direction
+        page = []
+        for source in sources:
+            if len(page) > limit:
+                break
+            page.extend(self.filter_queryset(source, before, after)[:limit + 1 - len(page)])
+
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        if after is not None:
+            page.reverse()
+            self.has_newer, self.has_older = has_more, True
+        else:
+            self.has_newer, self.has_older = before is not None, has_more
+
+        self.page = page
+        return page
+
+    def filter_queryset(self, queryset, before, after):
+        if after is not None:
+            timestamp, id = after
+            return queryset.filter(
+                Q(timestamp__gte=timestamp),
+                Q(timestamp__gt=timestamp) | Q(id__gt=id),
+            ).order_by('timestamp', 'id')
+
+        if before is not None:
+            timestamp, id = before
+            # the redundant timestamp bound lets Postgres range-scan the index
+            queryset = queryset.filter(
+                Q(timestamp__lte=timestamp),
+                Q(timestamp__lt=timestamp) | Q(id__lt=id),
+            )
+        return queryset.order_by('-timestamp', '-id')
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.has_older or not self.page:
+            return None
+        url = remove_query_param(self.base_url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        url = remove_query_param(self.base_url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[0]))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        if limit <= 0:
+            return self.default_limit
+        return min(limit, self.max_limit)
+
+    def encode_cursor(self, message):
+        cursor = '{}|{}'.format(message.timestamp.isoformat(), message.id)
+        return base64.urlsafe_b64encode(cursor.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            cursor = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            timestamp, id = cursor.split('|')
+            timestamp = parse_datetime(timestamp)
+            id = int(id)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, id
+
+
+def encode_change_cursor(change_seq, id):
+    cursor = '{}|{}'.format(change_seq, id)
+    return base64.urlsafe_b64encode(cursor.encode('ascii')).decode('ascii')
+
+
+def decode_change_cursor(encoded):
+    """(change_seq, id) from a sync cursor; no cursor means from the start"""
+    if not encoded:
+        return 0, 0
+    try:
+        cursor = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+        change_seq, id = cursor.split('|')
+        return int(change_seq), int(id)
+    except (TypeError, ValueError, UnicodeError):
+        raise NotFound(MessageCursorPagination.invalid_cursor_message)
@@ -15,6 +15,13 @@ class MessageSerializer(WritableNestedModelSerializer):
 		read_only_fields = ('id', 'sender', 'body', 'timestamp', 'unread',)
 
 
+#Messages returned by the sync endpoint, which also need their thread
+class SyncMessageSerializer(MessageSerializer):
+	class Meta(MessageSerializer.Meta):
+		fields = MessageSerializer.Meta.fields + ('thread',)
+		read_only_fields = fields
+
+
 class ThreadSerializer(WritableNestedModelSerializer):
 	profile_1 = ProfileSerializer()
 	profile_2 = ProfileSerializer()
@@ -30,22 +37,62 @@ class ThreadSerializer(WritableNestedModelSerializer):
 
 
 #Context of request must be defined by get_serializer_context() in calling method
+#Threads from Thread.inbox() are serialized without further queries
 class OwnThreadSerializer(WritableNestedModelSerializer):
 	recent_message = serializers.SerializerMethodField()
 	other_profile = serializers.SerializerMethodField()
-	
+	unread_count = serializers.SerializerMethodField()
+	last_read_message_id = serializers.SerializerMethodField()
+	other_last_read_message_id = serializers.SerializerMethodField()
+
+	def is_mine(self, obj, suffix):
+		my_user = self.context['request'].user
+		profile = obj.profile_1 if suffix == '1' else obj.profile_2
+		return profile is not None and profile.user_id == my_user.id
+
 	def get_recent_message(self, obj):
-		return MessageSerializer(Message.objects.filter(thread__id=obj.id).order_by('timestamp').last()).data
+		message = obj.last_message
+		if message is None:
+			return MessageSerializer(None).data
+
+		#unread is worked out against this thread's read pointers
+		message.thread = obj
+
+		#the sender is one of the participants, which Thread.inbox() already loaded
+		if message.sender_id is not None and message.sender_id == obj.profile_1_id:
+			message.sender = obj.profile_1
+		elif message.sender_id is not None and message.sender_id == obj.profile_2_id:
+			message.sender = obj.profile_2
+		return MessageSerializer(message).data
 
 	def get_other_profile(self, obj):
 		my_user = self.context['request'].user
 
-		if my_user == obj.profile_1.user:
+		if obj.profile_1 is not None and obj.profile_1.user_id == my_user.id:
 			return ProfileSerializer(obj.profile_2).data
 
 		return ProfileSerializer(obj.profile_1).data
 
+	def get_unread_count(self, obj):
+		if hasattr(obj, 'unread_count'):
+			return obj.unread_count
+
+		if self.is_mine(obj, '1'):
+			return obj.unread_count_1
+		return obj.unread_count_2
+
+	#read receipts: the last message each side has read
+	def get_last_read_message_id(self, obj):
+		if self.is_mine(obj, '1'):
+			return obj.last_read_message_id_1
+		return obj.last_read_message_id_2
+
+	def get_other_last_read_message_id(self, obj):
+		if self.is_mine(obj, '1'):
+			return obj.last_read_message_id_2
+		return obj.last_read_message_id_1
+
 	class Meta:
 		model = Thread
-		fields = ('id', 'other_profile', 'recent_message', )
-		read_only_fields = ('id', 'other_profile', 'recent_message', )
+		fields = ('id', 'other_profile', 'recent_message', 'unread_count', 'last_read_message_id', 'other_last_read_message_id', )
+		read_only_fields = fields
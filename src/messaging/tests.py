@@ -2,17 +2,33 @@
 from __future__ import unicode_literals
 
 from django.test import TestCase
+from django.db import IntegrityError, transaction
 from django.core.urlresolvers import reverse
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
 from django.db.models import Q
+from django.db.models.signals import pre_save
+from django.core.management import call_command
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
+from outbox.models import OutboundEmail
 from users.models import Profile
-from .models import Message, Thread
+from .models import ArchivedMessage, Message, Thread
+from .notify import NotificationDispatcher
+from .management.commands.relay_messaging_events import relay
+from django.db import connection
+from django.conf import settings
+import json
+import psycopg2
 from users import factories as users_factories
 from .factories import MessageFactory, ThreadFactory
 from .serializers import MessageSerializer, ProfileSerializer
 import random
+from datetime import timedelta
+from django.utils import timezone
+import threading
+import select
+import time
 
 class SendMessageTest(APITestCase):
 
@@ -51,6 +67,22 @@ class SendMessageTest(APITestCase):
         self.assertEqual(new_message.sender, self.me)
 
 
+    def test_failed_send_queues_no_email(self):
+        def fail(sender, **kwargs):
+            raise IntegrityError('failed')
+        pre_save.connect(fail, sender=Message)
+        try:
+            with self.assertRaises(IntegrityError):
+                self.client.post(
+                    reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id}),
+                    data={'body': 'Test Message'},
+                )
+        finally:
+            pre_save.disconnect(fail, sender=Message)
+
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(OutboundEmail.objects.exists())
+
     def test_send_existing_thread(self):
         self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
 
@@ -134,10 +166,10 @@ class MarkReadTest(APITestCase):
         self.client.force_authenticate(user=self.me.user)
         self.thread1 = ThreadFactory(profile_1 = self.me)
         self.thread2 = ThreadFactory(profile_1 = self.me)
-        self.message=MessageFactory(thread=self.thread1)
-        self.message1=MessageFactory(thread=self.thread2)
-        self.message2=MessageFactory(thread=self.thread2)
-        self.message3=MessageFactory(thread=self.thread2)
+        self.message=MessageFactory(thread=self.thread1, sender=self.thread1.profile_2)
+        self.message1=MessageFactory(thread=self.thread2, sender=self.thread2.profile_2)
+        self.message2=MessageFactory(thread=self.thread2, sender=self.thread2.profile_2)
+        self.message3=MessageFactory(thread=self.thread2, sender=self.thread2.profile_2)
 
     def tearDown(self):
         Message.objects.all().delete()
@@ -176,6 +208,87 @@ class MarkReadTest(APITestCase):
         self.assertFalse(self.db_message2.unread)
         self.assertFalse(self.db_message3.unread)
 
+    def test_own_messages_stay_unread(self):
+        sent = MessageFactory(thread=self.thread1, sender=self.me)
+
+        resp = self.client.patch(
+            reverse('messaging:read_thread', kwargs={'thread_id': self.thread1.id}),
+        )
+
+        self.assertFalse(Message.objects.get(id=self.message.id).unread)
+        self.assertTrue(Message.objects.get(id=sent.id).unread)
+        self.assertEqual(resp.data['last_read_message_id'], sent.id)
+        self.assertEqual(resp.data['other_last_read_message_id'], 0)
+
+    def test_cannot_read_others_thread(self):
+        thread = ThreadFactory()
+        resp = self.client.patch(
+            reverse('messaging:read_thread', kwargs={'thread_id': thread.id}),
+        )
+        self.assertEqual(resp.status_code, 404)
+
+    def test_read_many_threads(self):
+        others = ThreadFactory()
+        resp = self.client.post(
+            reverse('messaging:read_threads'),
+            data={'threads': [
+                {'thread_id': self.thread1.id},
+                {'thread_id': self.thread2.id, 'message_id': self.message2.id},
+                {'thread_id': others.id},
+            ]},
+            format='json',
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        unread = dict((thread['id'], thread['unread_count']) for thread in resp.data)
+        self.assertEqual(unread, {self.thread1.id: 0, self.thread2.id: 1})
+        self.assertFalse(Message.objects.get(id=self.message2.id).unread)
+        self.assertTrue(Message.objects.get(id=self.message3.id).unread)
+
+        # pointers never move backwards
+        self.thread2.mark_read(self.me, self.message1.id)
+        self.thread2.refresh_from_db()
+        self.assertEqual(self.thread2.last_read_message_id_1, self.message2.id)
+        self.assertEqual(self.thread2.unread_count_1, 1)
+
+    def test_read_many_threads_validates(self):
+        resp = self.client.post(
+            reverse('messaging:read_threads'),
+            data={'threads': [{'message_id': 1}]},
+            format='json',
+        )
+        self.assertEqual(resp.status_code, 400)
+
+        for message_id in (0, -1, 2 ** 31):
+            resp = self.client.post(
+                reverse('messaging:read_threads'),
+                data={'threads': [{'thread_id': self.thread1.id, 'message_id': message_id}]},
+                format='json',
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_read_stops_at_latest_message(self):
+        # an id from another thread, or one not sent yet, reads everything so far
+        for message_id in (self.message3.id, self.message3.id + 1000):
+            resp = self.client.post(
+                reverse('messaging:read_threads'),
+                data={'threads': [{'thread_id': self.thread1.id, 'message_id': message_id}]},
+                format='json',
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.thread1.refresh_from_db()
+            self.assertEqual(self.thread1.last_read_message_id_1, self.message.id)
+
+        later = MessageFactory(thread=self.thread1, sender=self.thread1.profile_2)
+        self.assertTrue(Message.objects.get(id=later.id).unread)
+        self.thread1.refresh_from_db()
+        self.assertEqual(self.thread1.unread_count_1, 1)
+
+    def test_read_again_changes_nothing(self):
+        self.assertTrue(self.thread1.mark_read(self.me))
+        self.assertFalse(self.thread1.mark_read(self.me))
+        self.assertFalse(self.thread1.mark_read(self.me, self.message.id))
+
 
 class CheckHistoryTest(APITestCase):
 
@@ -265,3 +378,460 @@ class GetThreadsTest(APITestCase):
 
         self.assertEqual(self.t1_message_json, resp_thread_1['recent_message'])
         self.assertEqual(self.t2_message_json, resp_thread_2['recent_message'])
+
+    def test_unread_count_excludes_own_messages(self):
+        self.thread1 = ThreadFactory(profile_1=self.me, profile_2=self.other1)
+        MessageFactory(thread=self.thread1, sender=self.me)
+        MessageFactory(thread=self.thread1, sender=self.other1)
+        MessageFactory(thread=self.thread1, sender=self.other1)
+
+        resp = self.client.get(
+            reverse('messaging:thread_list'),
+        )
+
+        self.assertEqual(resp.data['results'][0]['unread_count'], 2)
+
+    def test_thread_list_query_count(self):
+        # profile, count, then threads with participants and latest message
+        # in one query, however many threads there are
+        create_url = reverse('messaging:thread_list')
+
+        for count in (2, 20):
+            for i in range(count):
+                thread = ThreadFactory(profile_1=self.me, profile_2__user__last_name='Other_{}_{}'.format(count, i))
+                MessageFactory(thread=thread, sender=thread.profile_2)
+
+            with self.assertNumQueries(3):
+                resp = self.client.get(
+                    create_url,
+                )
+
+            self.assertEqual(len(resp.data['results']), count)
+            Thread.objects.all().delete()
+
+
+class ThreadActivityTest(APITestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+        self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
+
+    def tearDown(self):
+        Message.objects.all().delete()
+        Thread.objects.all().delete()
+        self.me.user.delete()
+        self.other.user.delete()
+
+    def test_new_message_updates_thread(self):
+        MessageFactory(thread=self.thread, sender=self.me)
+        message = MessageFactory(thread=self.thread, sender=self.other)
+        MessageFactory(thread=self.thread, sender=self.other)
+        latest = Message.objects.filter(thread=self.thread).latest('timestamp')
+
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message, latest)
+        self.assertEqual(self.thread.last_activity, latest.timestamp)
+        self.assertEqual(self.thread.unread_count_1, 2)
+        self.assertEqual(self.thread.unread_count_2, 1)
+
+    def test_read_resets_own_counter(self):
+        MessageFactory(thread=self.thread, sender=self.other)
+        MessageFactory(thread=self.thread, sender=self.me)
+
+        self.client.patch(
+            reverse('messaging:read_thread', kwargs={'thread_id': self.thread.id}),
+        )
+
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.unread_count_1, 0)
+        self.assertEqual(self.thread.unread_count_2, 1)
+
+    def test_reconcile_rebuilds_from_messages(self):
+        MessageFactory(thread=self.thread, sender=self.me)
+        latest = MessageFactory(thread=self.thread, sender=self.other)
+        Thread.objects.update(last_message=None, last_activity=None, unread_count_1=0, unread_count_2=0)
+
+        call_command('reconcile_threads', stdout=StringIO())
+
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_message, latest)
+        self.assertEqual(self.thread.unread_count_1, 1)
+        self.assertEqual(self.thread.unread_count_2, 1)
+
+
+class MessageHistoryPaginationTest(APITestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+        self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
+        self.messages = [MessageFactory(thread=self.thread, sender=self.me) for i in range(5)]
+        self.url = reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id})
+
+    def tearDown(self):
+        Message.objects.all().delete()
+        Thread.objects.all().delete()
+        self.me.user.delete()
+        self.other.user.delete()
+
+    def ids(self, resp):
+        return [message['id'] for message in resp.data['results']]
+
+    def test_first_page_is_newest(self):
+        resp = self.client.get(self.url, data={'limit': 2})
+
+        self.assertEqual(self.ids(resp), [self.messages[4].id, self.messages[3].id])
+        self.assertIsNone(resp.data['previous'])
+        self.assertIsNotNone(resp.data['next'])
+
+    def test_scroll_back_through_history(self):
+        resp = self.client.get(self.url, data={'limit': 2})
+        resp = self.client.get(resp.data['next'])
+        self.assertEqual(self.ids(resp), [self.messages[2].id, self.messages[1].id])
+
+        resp = self.client.get(resp.data['next'])
+        self.assertEqual(self.ids(resp), [self.messages[0].id])
+        self.assertIsNone(resp.data['next'])
+
+    def test_new_messages_do_not_shift_pages(self):
+        resp = self.client.get(self.url, data={'limit': 2})
+        newer = MessageFactory(thread=self.thread, sender=self.other)
+
+        older_page = self.client.get(resp.data['next'])
+        self.assertEqual(self.ids(older_page), [self.messages[2].id, self.messages[1].id])
+
+        newer_page = self.client.get(older_page.data['previous'])
+        self.assertEqual(self.ids(newer_page), [self.messages[4].id, self.messages[3].id])
+
+        catch_up = self.client.get(newer_page.data['previous'])
+        self.assertEqual(self.ids(catch_up), [newer.id])
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(self.url, data={'before': 'not a cursor'})
+        self.assertEqual(resp.status_code, 404)
+
+
+class ThreadPairTest(APITestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+
+    def tearDown(self):
+        Message.objects.all().delete()
+        Thread.objects.all().delete()
+        self.me.user.delete()
+        self.other.user.delete()
+
+    def test_pair_is_order_independent(self):
+        thread, created = Thread.get_or_create_for_pair(self.me, self.other)
+        self.assertTrue(created)
+
+        same, created = Thread.get_or_create_for_pair(self.other, self.me)
+        self.assertFalse(created)
+        self.assertEqual(same, thread)
+        self.assertEqual(Thread.for_pair(self.other.id, self.me.id), thread)
+
+    def test_one_thread_per_pair(self):
+        ThreadFactory(profile_1=self.me, profile_2=self.other)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ThreadFactory(profile_1=self.other, profile_2=self.me)
+
+    def test_reply_uses_existing_thread(self):
+        thread = ThreadFactory(profile_1=self.other, profile_2=self.me)
+        url = reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id})
+
+        resp = self.client.post(url, data={'body': 'reply'})
+
+        self.assertEqual(Message.objects.get(id=resp.data['id']).thread, thread)
+        self.assertEqual(Thread.objects.count(), 1)
+
+
+class FakeResponse(object):
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+
+    def __init__(self, block=False):
+        self.posts = []
+        self.payloads = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def post(self, url, json=None, timeout=None):
+        self.started.set()
+        self.release.wait(5)
+        self.posts.append(url)
+        self.payloads.append(json)
+        return FakeResponse()
+
+
+class NotificationDispatcherTest(TestCase):
+
+    def dispatcher(self, session, queue_size=10, coalesce_window=0):
+        return NotificationDispatcher(
+            url='http://websockets/broadcast/%d',
+            timeout=(0.5, 1),
+            queue_size=queue_size,
+            coalesce_window=coalesce_window,
+            session=session,
+        )
+
+    def test_delivers_in_background(self):
+        session = FakeSession()
+        dispatcher = self.dispatcher(session)
+
+        self.assertTrue(dispatcher.notify(7))
+        dispatcher.join()
+
+        self.assertEqual(session.posts, ['http://websockets/broadcast/7'])
+        self.assertEqual(dispatcher.stats()['delivered'], 1)
+
+    def test_coalesces_within_window(self):
+        session = FakeSession()
+        dispatcher = self.dispatcher(session, coalesce_window=0.2)
+
+        for i in range(3):
+            dispatcher.notify(7)
+        dispatcher.notify(8)
+        dispatcher.join()
+
+        self.assertEqual(sorted(session.posts), ['http://websockets/broadcast/7', 'http://websockets/broadcast/8'])
+        self.assertEqual(dispatcher.stats()['coalesced'], 2)
+
+    def test_coalesces_relayed_events(self):
+        session = FakeSession()
+        dispatcher = self.dispatcher(session, coalesce_window=0.2)
+
+        for message_id in (10, 11):
+            relay({'type': 'new_message', 'profiles': [7], 'thread_id': 3, 'message_id': message_id}, dispatcher)
+        dispatcher.join()
+
+        self.assertEqual(session.posts, ['http://websockets/broadcast/7'])
+        self.assertEqual(session.payloads[0]['message_id'], 11)
+        self.assertEqual(dispatcher.stats()['coalesced'], 1)
+
+    def test_drops_when_full(self):
+        session = FakeSession(block=True)
+        dispatcher = self.dispatcher(session, queue_size=1)
+
+        dispatcher.notify(1)
+        session.started.wait(5)
+        self.assertTrue(dispatcher.notify(2))
+        self.assertFalse(dispatcher.notify(3))
+        session.release.set()
+        dispatcher.join()
+
+        stats = dispatcher.stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['delivered'], 2)
+
+
+class MessagingEventsTest(APITransactionTestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+        self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
+
+        self.listener = psycopg2.connect(**connection.get_connection_params())
+        self.listener.autocommit = True
+        self.listener.cursor().execute('LISTEN messaging_events')
+
+    def tearDown(self):
+        self.listener.close()
+
+    def received(self, count=1):
+        # notifications can arrive a moment after the commit
+        events = []
+        deadline = time.time() + 5
+        while len(events) < count and time.time() < deadline:
+            select.select([self.listener], [], [], 0.1)
+            self.listener.poll()
+            events.extend(json.loads(n.payload) for n in self.listener.notifies)
+            self.listener.notifies[:] = []
+        return events
+
+    def test_new_message_event(self):
+        url = reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id})
+        resp = self.client.post(url, data={'body': 'hi'})
+
+        self.assertEqual(self.received(), [{
+            'type': 'new_message',
+            'profiles': sorted([self.me.id, self.other.id]),
+            'thread_id': self.thread.id,
+            'message_id': resp.data['id'],
+            'sender_id': self.me.id,
+        }])
+
+    def test_thread_read_event(self):
+        MessageFactory(thread=self.thread, sender=self.other)
+        self.received()
+
+        self.client.patch(reverse('messaging:read_thread', kwargs={'thread_id': self.thread.id}))
+
+        event, = self.received()
+        self.assertEqual(event['type'], 'thread_read')
+        self.assertEqual(event['reader_id'], self.me.id)
+
+    def test_relay_fans_out_to_participants(self):
+        notified = []
+        class FakeDispatcher(object):
+            def notify(self, profile_id, payload):
+                notified.append((profile_id, payload))
+
+        relay({'type': 'thread_read', 'profiles': [1, 2], 'thread_id': 3, 'reader_id': 1}, FakeDispatcher())
+
+        payload = {'TYPE': 'MESSAGE_UPDATE', 'type': 'thread_read', 'thread_id': 3, 'reader_id': 1}
+        self.assertEqual(notified, [(1, payload), (2, payload)])
+
+
+class SyncTest(APITransactionTestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+        self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
+        self.first = MessageFactory(thread=self.thread, sender=self.other)
+        self.url = reverse('messaging:sync')
+
+    def sync(self, cursor=None):
+        resp = self.client.get(self.url, data={'since': cursor} if cursor else {})
+        self.assertEqual(resp.status_code, 200)
+        return resp.data
+
+    def test_initial_sync_then_nothing_new(self):
+        data = self.sync()
+        self.assertEqual([thread['id'] for thread in data['threads']], [self.thread.id])
+        self.assertEqual([message['id'] for message in data['messages']], [self.first.id])
+        self.assertEqual(data['messages'][0]['thread'], self.thread.id)
+
+        data = self.sync(data['cursor'])
+        self.assertEqual(data['threads'], [])
+        self.assertEqual(data['messages'], [])
+
+    def test_only_changes_since_cursor(self):
+        cursor = self.sync()['cursor']
+        other_thread = ThreadFactory(profile_1=self.me, profile_2__user__last_name='Unchanged')
+        cursor = self.sync(cursor)['cursor']
+
+        message = MessageFactory(thread=self.thread, sender=self.other)
+        data = self.sync(cursor)
+
+        self.assertEqual([thread['id'] for thread in data['threads']], [self.thread.id])
+        self.assertEqual([message['id'] for message in data['messages']], [message.id])
+        self.assertEqual(data['threads'][0]['unread_count'], 2)
+
+    def test_read_state_changes(self):
+        cursor = self.sync()['cursor']
+        self.client.patch(reverse('messaging:read_thread', kwargs={'thread_id': self.thread.id}))
+
+        data = self.sync(cursor)
+
+        self.assertEqual(data['threads'][0]['unread_count'], 0)
+        self.assertEqual(data['threads'][0]['last_read_message_id'], self.first.id)
+        self.assertEqual(data['messages'], [])
+
+    def test_pages_through_many_changes(self):
+        messages = [self.first] + [MessageFactory(thread=self.thread, sender=self.me) for i in range(4)]
+
+        seen = []
+        cursor = None
+        with self.settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, PAGE_SIZE=2)):
+            while True:
+                data = self.sync(cursor)
+                seen.extend(message['id'] for message in data['messages'])
+                cursor = data['cursor']
+                if not data['has_more']:
+                    break
+
+        self.assertEqual(seen, [message.id for message in messages])
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(self.url, data={'since': 'nope'})
+        self.assertEqual(resp.status_code, 404)
+
+
+class ArchiveMessagesTest(APITestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+        self.thread = ThreadFactory(profile_1=self.me, profile_2=self.other)
+        self.messages = [MessageFactory(thread=self.thread, sender=self.other) for i in range(5)]
+        self.url = reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id})
+
+        # make the thread a year idle, keeping message order
+        for i, message in enumerate(self.messages):
+            Message.objects.filter(id=message.id).update(timestamp=timezone.now() - timedelta(days=365, minutes=10 - i))
+        Thread.objects.filter(id=self.thread.id).update(last_activity=timezone.now() - timedelta(days=365))
+
+    def tearDown(self):
+        Message.objects.all().delete()
+        Thread.objects.all().delete()
+        self.me.user.delete()
+        self.other.user.delete()
+
+    def archive(self, months=6):
+        out = StringIO()
+        call_command('archive_messages', months=months, stdout=out)
+        return out.getvalue()
+
+    def ids(self, resp):
+        return [message['id'] for message in resp.data['results']]
+
+    def test_moves_all_but_latest(self):
+        self.assertIn('Archived 4 messages from 1 threads', self.archive())
+
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.messages[4].id])
+        self.assertEqual(
+            sorted(ArchivedMessage.objects.values_list('id', flat=True)),
+            [message.id for message in self.messages[:4]],
+        )
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.archived_messages, 4)
+        self.assertEqual(self.thread.last_message_id, self.messages[4].id)
+
+        self.assertIn('Archived 0 messages from 0 threads', self.archive())
+
+    def test_recent_threads_are_kept(self):
+        self.assertIn('Archived 0 messages', self.archive(months=24))
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_history_reads_across_archive(self):
+        self.archive()
+
+        resp = self.client.get(self.url, data={'limit': 2})
+        self.assertEqual(self.ids(resp), [self.messages[4].id, self.messages[3].id])
+        self.assertTrue(resp.data['results'][1]['unread'])
+
+        resp = self.client.get(resp.data['next'])
+        self.assertEqual(self.ids(resp), [self.messages[2].id, self.messages[1].id])
+
+        resp = self.client.get(resp.data['previous'])
+        self.assertEqual(self.ids(resp), [self.messages[4].id, self.messages[3].id])
+
+    def test_unread_counts_include_archive(self):
+        self.archive()
+        self.thread.refresh_from_db()
+        self.thread.mark_read(self.me, self.messages[1].id)
+
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.unread_count_1, 3)
+
+        Thread.objects.update(unread_count_1=0)
+        call_command('reconcile_threads', stdout=StringIO())
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.unread_count_1, 3)
@@ -1,40 +1,30 @@
+from collections import OrderedDict
+
 from django.shortcuts import render, get_object_or_404
 from django.conf import settings
-from django.db.models import Q, Max
+from django.db import transaction
+from django.db.models import Q
 from django.http import Http404
 from rest_framework.response import Response
-from .models import Thread, Message
-from .serializers import MessageSerializer, OwnThreadSerializer
+from rest_framework.exceptions import ValidationError
+from .models import Thread, Message, ArchivedMessage
+from .serializers import MessageSerializer, OwnThreadSerializer, SyncMessageSerializer
+from .pagination import MessageCursorPagination, encode_change_cursor, decode_change_cursor
 from users.models import Profile, User
 from rest_framework import generics
 from rest_framework.views import APIView
+from rest_framework.settings import api_settings
+from pickmybruin.authentication import get_own_profile
+from pickmybruin.routers import ReplicaReadsMixin
 from pickmybruin.settings import MESSAGING_TEMPLATE
 
-import sendgrid
-from sendgrid.helpers.mail import Email, Content, Substitution, Mail
-import requests
-
-def websockets_notify_user(user):
-    # handles both objects and raw id's
-    if hasattr(user, 'id'):
-        user = user.id
-
-    url = 'http://websockets/broadcast/%d' % user
-    json_body = {
-        'TYPE': 'MESSAGE_UPDATE',
-    }
-    try:
-        resp = requests.post(url, json=json_body)
-    except requests.exceptions.ConnectionError as e:
-        import pprint
-        pprint.pprint(e)
-        return None
-    return resp
-        
-
+from outbox.models import OutboundEmail
+from . import events
 
 # Create your views here.
 
+MAX_ID = 2 ** 31 - 1
+
 class ReadThreadView(generics.UpdateAPIView):
     """
     View for marking a specified thread as read
@@ -43,19 +33,59 @@ class ReadThreadView(generics.UpdateAPIView):
 
     def patch(self, request, *args, **kwargs):
         thread_id = int(self.kwargs['thread_id'])
-        thread = get_object_or_404(Thread, id=thread_id)
-        unread_messages = Message.objects.filter(Q(thread=thread) & Q(unread=True))
+        my_profile = get_own_profile(self.request)
+        thread = get_object_or_404(Thread, Thread.getProfileQuery(my_profile), id=thread_id)
 
-        unread_messages.update(unread=False)
-
-        my_profile = get_object_or_404(Profile, user=self.request.user)
-        other_user = thread.get_other_user(my_profile)
-        websockets_notify_user(other_user)
+        with transaction.atomic():
+            if thread.mark_read(my_profile):
+                events.thread_read(thread, my_profile)
 
+        thread = Thread.inbox(my_profile).filter(id=thread.id).first() or thread
         return Response(OwnThreadSerializer(thread, context = {'request': self.request}).data)
       
 
 
+class ReadThreadsView(APIView):
+    """
+    View for acknowledging many threads at once. Takes
+    {"threads": [{"thread_id": 1, "message_id": 42}, ...]}, where message_id is
+    the last message read and defaults to the thread's latest
+    """
+    def parse(self, data):
+        receipts = data.get('threads') if hasattr(data, 'get') else None
+        if not isinstance(receipts, list):
+            raise ValidationError({'threads': 'Expected a list of read receipts'})
+        if len(receipts) > api_settings.PAGE_SIZE:
+            raise ValidationError({'threads': 'At most {} threads per request'.format(api_settings.PAGE_SIZE)})
+        def to_id(value):
+            # ids are Postgres integers; anything else can't name a row
+            value = int(value)
+            if not 0 < value <= MAX_ID:
+                raise ValueError(value)
+            return value
+        try:
+            return dict(
+                (to_id(receipt['thread_id']), to_id(receipt['message_id']) if receipt.get('message_id') is not None else None)
+                for receipt in receipts
+            )
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError({'threads': 'Each receipt needs a positive integer thread_id and optional message_id'})
+
+    def post(self, request, *args, **kwargs):
+        my_profile = get_own_profile(self.request)
+        receipts = self.parse(request.data)
+
+        #threads the caller isn't part of are ignored
+        threads = Thread.objects.filter(Thread.getProfileQuery(my_profile), id__in=receipts)
+        with transaction.atomic():
+            for thread in threads:
+                if thread.mark_read(my_profile, receipts[thread.id]):
+                    events.thread_read(thread, my_profile)
+
+        threads = Thread.inbox(my_profile).filter(id__in=receipts)
+        return Response(OwnThreadSerializer(threads, many=True, context={'request': self.request}).data)
+
+
 class CheckHistoryView(APIView):
     """
     View for checking the existence of a thread between two users
@@ -63,12 +93,11 @@ class CheckHistoryView(APIView):
     def get(self, request, *args, **kwargs):
 
         #check if thread exists
-        my_profile = get_object_or_404(Profile, user=self.request.user)
+        my_profile = get_own_profile(self.request)
         other_id = int(self.kwargs['profile_id'])
         other_profile = get_object_or_404(Profile, id=other_id)
 
-        query = Thread.getProfileQuery(my_profile, other_profile)
-        thread = Thread.objects.filter(query).first()
+        thread = Thread.for_pair(my_profile, other_profile)
 
         if thread is None:
             return Response({'exists': False})
@@ -81,95 +110,123 @@ class SendGetMessagesView(generics.ListCreateAPIView):
     View for both sending a message and retrieving all messages between two users
     """
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self, *args, **kwargs):
-        my_profile = get_object_or_404(Profile, user=self.request.user)
+        my_profile = get_own_profile(self.request)
         other_id = int(self.kwargs['profile_id'])
         other_profile = get_object_or_404(Profile, id=other_id)
 
         #Find associated thread
-        
-        query = Thread.getProfileQuery(my_profile, other_profile)
-        thread = Thread.objects.filter(query).first()
+        thread = Thread.for_pair(my_profile, other_profile)
 
         if thread is None:
             raise Http404("User does not exist")
 
-        messages = Message.objects.filter(thread=thread).order_by('timestamp').reverse()
+        #ordered newest first by MessageCursorPagination
+        self.thread = thread
+        messages = Message.objects.filter(thread=thread).select_related('sender__user', 'thread')
 
         return messages
 
+    def get_archive_queryset(self):
+        #older history of idle threads, see ArchivedMessage
+        if not self.thread.archived_messages:
+            return None
+        return ArchivedMessage.objects.filter(thread=self.thread).select_related('sender__user', 'thread')
+
     def post(self, request, *args, **kwargs):
-        my_profile = get_object_or_404(Profile, user=self.request.user)
+        my_profile = get_own_profile(self.request)
         other_id = int(self.kwargs['profile_id'])
         other_profile = get_object_or_404(Profile, id=other_id)
         message_body = request.data['body']
         
         #Find associated thread, or create new thread
-        query = Thread.getProfileQuery(my_profile, other_profile)
-        thread = Thread.objects.filter(query).first()
-        
-        if thread is None:
-            new_thread = Thread(
-                profile_1=my_profile,
-                profile_2=other_profile,
-                )
-
-            new_thread.save()
-            thread=new_thread
-
-            #Send email to recipient of message
-            sender_name = my_profile.user.first_name + ' ' + my_profile.user.last_name
-            message_url = 'bquest.ucladevx.com/messages/' + str(other_profile.id) + '/'
-            recipient_email = other_profile.user.email
-        
-            from_email =  Email('noreply@bquest.ucladevx.com')
-            to_email = Email(recipient_email)
-            subject = 'New Message from BQuest'
-            content = Content('text/html', 'N/A')
-            mail = Mail(from_email, subject, to_email, content)
-            mail.personalizations[0].add_substitution(Substitution('mentee_name', sender_name))
-            mail.personalizations[0].add_substitution(Substitution('user_message', message_body))
-            mail.personalizations[0].add_substitution(Substitution('user_message_address', message_url))
-            mail.template_id = MESSAGING_TEMPLATE
-            sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-            response = sg.client.mail.send.post(request_body=mail.get())
-            if not (200 <= response.status_code < 300):
-                raise ValidationError({'status_code': response.status_code})
+        thread, created = Thread.get_or_create_for_pair(my_profile, other_profile)
 
         new_message = Message(
             thread=thread,
             sender=my_profile,
             body=message_body,
-            unread=True,
         )
 
-        new_message.save()
-
-        other_user = new_message.thread.get_other_user(my_profile)
-        websockets_notify_user(other_user)
+        #saving also updates the thread's last message and unread counter,
+        #and publishes a new_message event once committed. The email is
+        #queued in the same transaction, so it only goes out with the message
+        with transaction.atomic():
+            new_message.save()
+
+            if created:
+                #Send email to recipient of message
+                sender_name = my_profile.user.first_name + ' ' + my_profile.user.last_name
+                message_url = 'bquest.ucladevx.com/messages/' + str(other_profile.id) + '/'
+                OutboundEmail.enqueue(
+                    to_email=other_profile.user.email,
+                    subject='New Message from BQuest',
+                    template_id=MESSAGING_TEMPLATE,
+                    substitutions={
+                        'mentee_name': sender_name,
+                        'user_message': message_body,
+                        'user_message_address': message_url,
+                    },
+                )
 
         return Response(MessageSerializer(new_message).data)
 
-class ListOwnThreadsView(generics.ListAPIView):
+class ListOwnThreadsView(ReplicaReadsMixin, generics.ListAPIView):
     serializer_class = OwnThreadSerializer
 
     def get_queryset(self):
-        my_profile = get_object_or_404(Profile, user=self.request.user)
+        my_profile = get_own_profile(self.request)
 
         #Find all threads that current user is involved in
-        query = Thread.getProfileQuery(my_profile)
-        
-        ret = Thread.objects.filter(
-            query,
-        ).annotate(
-            recent_message_timestamp=Max('message__timestamp'),
-        ).order_by(
-            '-recent_message_timestamp',
-        )
-
-        return ret
+        return Thread.inbox(my_profile)
 
     def get_serializer_context(self):
         return {'request': self.request}
 
+
+class SyncView(APIView):
+    """
+    Threads and messages that changed since ?since=<cursor>: new messages,
+    read-state changes and updated threads. Resume from the returned cursor;
+    while has_more is true there are more changed messages to fetch
+    """
+    def get(self, request, *args, **kwargs):
+        my_profile = get_own_profile(self.request)
+        since_seq, since_id = decode_change_cursor(request.query_params.get('since'))
+        limit = api_settings.PAGE_SIZE
+
+        # taken before reading, so a change that commits while we read is at
+        # or above it and shows up on the next sync
+        horizon = Thread.change_horizon()
+
+        threads = Thread.inbox(my_profile).filter(change_seq__gte=since_seq)
+        messages = list(Message.objects.filter(
+            Q(thread__profile_1=my_profile) | Q(thread__profile_2=my_profile),
+            Q(change_seq__gt=since_seq) | Q(change_seq=since_seq, id__gt=since_id),
+        ).select_related(
+            'sender__user',
+            'thread',
+        ).order_by(
+            'change_seq', 'id',
+        )[:limit + 1])
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        cursor = (horizon, 0)
+        if has_more:
+            # stay at or below the horizon unless that would repeat this page
+            last = (messages[-1].change_seq, messages[-1].id)
+            if min(last, cursor) > (since_seq, since_id):
+                cursor = min(last, cursor)
+            else:
+                cursor = last
+
+        context = {'request': request}
+        return Response(OrderedDict([
+            ('cursor', encode_change_cursor(*cursor)),
+            ('has_more', has_more),
+            ('threads', OwnThreadSerializer(threads, many=True, context=context).data),
+            ('messages', SyncMessageSerializer(messages, many=True, context=context).data),
+        ]))
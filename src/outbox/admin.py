@@ -0,0 +1,11 @@
+from __future__ import unicode_literals
+
+from django.contrib import admin
+from . import models
+
+# Register your models here.
+
+@admin.register(models.OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at')
+    list_filter = ('status',)
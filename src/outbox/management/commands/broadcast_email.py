@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from outbox.models import OutboundEmail
+from users.models import Mentor, Profile
+
+
+class Command(BaseCommand):
+    help = 'Queue a template email to every profile matching the filters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('template_id')
+        parser.add_argument('subject')
+        parser.add_argument('--verified', action='store_true',
+            help='Only verified profiles')
+        parser.add_argument('--mentors', action='store_true',
+            help='Only active mentors')
+        parser.add_argument('--year', choices=[choice for choice, _ in Profile.YEAR_CHOICES])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def _recipients(self, kwargs):
+        profiles = Profile.objects.filter(notifications_enabled=True).exclude(user__email='')
+        if kwargs['verified']:
+            profiles = profiles.filter(verified=True)
+        if kwargs['mentors']:
+            # a join would list a profile once per mentor row it has
+            active = Mentor.objects.filter(profile=OuterRef('pk'), active=True)
+            profiles = profiles.annotate(active_mentor=Exists(active)).filter(active_mentor=True)
+        if kwargs['year']:
+            profiles = profiles.filter(year=kwargs['year'])
+        return profiles.order_by('id').values_list('id', 'user__email', 'user__first_name')
+
+    def handle(self, *args, **kwargs):
+        recipients = self._recipients(kwargs)
+        if kwargs['dry_run']:
+            self.stdout.write('Would queue {} emails'.format(recipients.count()))
+            return
+
+        # keyset batches, so memory stays flat however many profiles match
+        queued = 0
+        last_id = 0
+        while True:
+            batch = list(recipients.filter(id__gt=last_id)[:kwargs['batch_size']])
+            if not batch:
+                break
+            OutboundEmail.objects.bulk_create(
+                OutboundEmail(
+                    to_email=email,
+                    subject=kwargs['subject'],
+                    template_id=kwargs['template_id'],
+                    substitutions={'-first_name-': first_name},
+                )
+                for id, email, first_name in batch
+            )
+            queued += len(batch)
+            last_id = batch[-1][0]
+
+        self.stdout.write('Queued {} emails'.format(queued))
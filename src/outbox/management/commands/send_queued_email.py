@@ -0,0 +1,53 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from outbox.models import OutboundEmail
+from outbox.transports import get_transport
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbound email, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--once', action='store_true',
+            help='Exit once nothing is due instead of polling')
+        parser.add_argument('--poll-interval', type=float, default=5)
+
+    def _send_batch(self, transport, batch_size):
+        batch = OutboundEmail.claim(batch_size)
+        if not batch:
+            return 0, 0
+
+        # outside any transaction, however long SendGrid takes
+        results = list(transport.send_many(batch))
+
+        with transaction.atomic():
+            sent_ids = defaultdict(list)
+            for result in results:
+                if result.error is None:
+                    sent_ids[result.message_id].append(result.email.id)
+                else:
+                    result.email.mark_failed(result.error)
+
+            # one UPDATE per SendGrid request rather than one per email
+            sent = 0
+            for message_id, ids in sent_ids.items():
+                sent += OutboundEmail.mark_sent(ids, message_id)
+        return len(batch), sent
+
+    def handle(self, *args, **kwargs):
+        transport = get_transport()
+        total_sent = total_failed = 0
+        while True:
+            claimed, sent = self._send_batch(transport, kwargs['batch_size'])
+            total_sent += sent
+            total_failed += claimed - sent
+            if claimed == 0:
+                if kwargs['once']:
+                    break
+                time.sleep(kwargs['poll_interval'])
+
+        self.stdout.write('Sent {} emails, {} failed'.format(total_sent, total_failed))
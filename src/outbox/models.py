@@ -0,0 +1,119 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+# Create your models here.
+
+DEFAULT_FROM_EMAIL = 'noreply@bquest.ucladevx.com'
+
+
+class OutboundEmail(models.Model):
+    """
+    An email waiting to be sent. Request handlers enqueue these and return
+    immediately; the send_queued_email command delivers them in the background
+    """
+    PENDING = 'pending'
+    # claimed by a worker until next_attempt_at
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    from_email = models.CharField(max_length=254, default=DEFAULT_FROM_EMAIL)
+    to_email = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255)
+    content = models.TextField(default='N/A')
+    template_id = models.CharField(max_length=64, blank=True, default='')
+    substitutions = JSONField(default=dict, blank=True)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    # X-Message-Id of the SendGrid request this went out in
+    provider_message_id = models.CharField(max_length=64, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker's "what is due" scan
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_email_due'),
+        ]
+
+    def __str__(self):
+        return '%s to %s (%s)' % (self.subject, self.to_email, self.status)
+
+    @classmethod
+    def enqueue(cls, to_email, subject, template_id='', substitutions=None, content='N/A', from_email=DEFAULT_FROM_EMAIL):
+        return cls.objects.create(
+            from_email=from_email,
+            to_email=to_email,
+            subject=subject,
+            content=content,
+            template_id=template_id or '',
+            substitutions=substitutions or {},
+        )
+
+    @classmethod
+    def due(cls):
+        # including emails claimed by a worker that never recorded the result
+        return cls.objects.filter(
+            status__in=(cls.PENDING, cls.SENDING),
+            next_attempt_at__lte=timezone.now(),
+        ).order_by('next_attempt_at', 'id')
+
+    @classmethod
+    def claim(cls, batch_size):
+        """
+        Up to `batch_size` due emails, marked as sending for
+        OUTBOX_CLAIM_TIMEOUT seconds so no other worker takes them. The
+        claim commits at once: sending holds no locks or transaction
+        """
+        with transaction.atomic():
+            # SKIP LOCKED lets several workers claim at the same time
+            batch = list(cls.due().select_for_update(skip_locked=True)[:batch_size])
+            if batch:
+                until = timezone.now() + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT)
+                cls.objects.filter(id__in=[email.id for email in batch]).update(
+                    status=cls.SENDING,
+                    next_attempt_at=until,
+                )
+                for email in batch:
+                    email.status = cls.SENDING
+                    email.next_attempt_at = until
+        return batch
+
+    @classmethod
+    def mark_sent(cls, ids, provider_message_id=''):
+        return cls.objects.filter(id__in=ids).update(
+            status=cls.SENT,
+            attempts=F('attempts') + 1,
+            sent_at=timezone.now(),
+            last_error='',
+            provider_message_id=provider_message_id,
+        )
+
+    def mark_failed(self, error):
+        """
+        Reschedules with exponential backoff, or gives up once
+        OUTBOX_MAX_ATTEMPTS is reached
+        """
+        self.attempts += 1
+        self.last_error = str(error)
+        if self.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            self.status = OutboundEmail.FAILED
+        else:
+            self.status = OutboundEmail.PENDING
+            delay = settings.OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        self.save(update_fields=['status', 'attempts', 'last_error', 'next_attempt_at'])
@@ -0,0 +1,208 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from rest_framework.test import APITestCase
+
+from users import factories as users_factories
+from .models import OutboundEmail
+from .transports import LocalTransport, SendGridTransport, group_for_sending
+
+
+class EnqueueTest(APITestCase):
+
+    def setUp(self):
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        self.other = users_factories.ProfileFactory()
+
+    def tearDown(self):
+        OutboundEmail.objects.all().delete()
+        self.me.user.delete()
+        self.other.user.delete()
+
+    def test_report_user_is_queued(self):
+        resp = self.client.post(
+            reverse('users:report_user'),
+            data={'reported_id': self.other.id, 'reason': 'spam'},
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.from_email, self.me.user.email)
+        self.assertEqual(email.to_email, 'bquest.ucla@gmail.com')
+        self.assertIn('spam', email.content)
+        self.assertEqual(email.status, OutboundEmail.PENDING)
+
+    def test_new_thread_is_queued(self):
+        url = reverse('messaging:send_get_messages', kwargs={'profile_id': self.other.id})
+        self.client.post(url, data={'body': 'hello'})
+        self.client.post(url, data={'body': 'again'})
+
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.to_email, self.other.user.email)
+        self.assertEqual(email.substitutions['user_message'], 'hello')
+
+
+@override_settings(
+    OUTBOX_TRANSPORT='outbox.transports.LocalTransport',
+    OUTBOX_MAX_ATTEMPTS=3,
+    OUTBOX_RETRY_DELAY=60,
+)
+class SendQueuedEmailTest(TestCase):
+
+    def setUp(self):
+        LocalTransport.outbox = []
+        LocalTransport.requests = []
+        LocalTransport.failing = set()
+
+    def tearDown(self):
+        OutboundEmail.objects.all().delete()
+
+    def drain(self):
+        out = StringIO()
+        call_command('send_queued_email', once=True, batch_size=2, stdout=out)
+        return out.getvalue()
+
+    def test_sends_due_email(self):
+        emails = [OutboundEmail.enqueue('user{}@example.com'.format(i), 'Hi') for i in range(3)]
+        later = OutboundEmail.enqueue('later@example.com', 'Hi')
+        OutboundEmail.objects.filter(id=later.id).update(next_attempt_at=timezone.now() + timedelta(hours=1))
+
+        self.assertIn('Sent 3 emails, 0 failed', self.drain())
+
+        self.assertEqual([email.id for email in LocalTransport.outbox], [email.id for email in emails])
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 3)
+        self.assertEqual(OutboundEmail.objects.get(id=later.id).status, OutboundEmail.PENDING)
+
+    def test_failure_backs_off(self):
+        LocalTransport.failing = {'bad@example.com'}
+        email = OutboundEmail.enqueue('bad@example.com', 'Hi')
+
+        self.assertIn('Sent 0 emails, 1 failed', self.drain())
+
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertIn('bad@example.com', email.last_error)
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+    def test_claimed_email_waits_for_its_worker(self):
+        email = OutboundEmail.enqueue('user@example.com', 'Hi')
+        self.assertEqual(OutboundEmail.claim(10), [email])
+        self.assertEqual(OutboundEmail.claim(10), [])
+        self.assertIn('Sent 0 emails', self.drain())
+
+        # its worker died before recording a result
+        OutboundEmail.objects.filter(id=email.id).update(next_attempt_at=timezone.now())
+        self.assertIn('Sent 1 emails', self.drain())
+        self.assertEqual(OutboundEmail.objects.get(id=email.id).status, OutboundEmail.SENT)
+
+    def test_gives_up_after_max_attempts(self):
+        LocalTransport.failing = {'bad@example.com'}
+        email = OutboundEmail.enqueue('bad@example.com', 'Hi')
+        OutboundEmail.objects.filter(id=email.id).update(attempts=2)
+
+        self.drain()
+
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+        self.assertEqual(email.attempts, 3)
+
+    def test_template_emails_share_a_request(self):
+        for i in range(3):
+            OutboundEmail.enqueue('user{}@example.com'.format(i), 'Hi', template_id='welcome')
+        OutboundEmail.enqueue('other@example.com', 'Hi', template_id='other')
+        LocalTransport.failing = {'user1@example.com'}
+
+        call_command('send_queued_email', once=True, stdout=StringIO())
+
+        self.assertEqual([len(group) for group in LocalTransport.requests], [3, 1])
+        welcome = OutboundEmail.objects.filter(template_id='welcome')
+        self.assertEqual(
+            sorted(welcome.values_list('to_email', 'status')),
+            [
+                ('user0@example.com', OutboundEmail.SENT),
+                ('user1@example.com', OutboundEmail.PENDING),
+                ('user2@example.com', OutboundEmail.SENT),
+            ],
+        )
+        self.assertEqual(welcome.get(to_email='user0@example.com').provider_message_id, 'local-0')
+
+
+class SendGridBatchTest(TestCase):
+
+    def tearDown(self):
+        OutboundEmail.objects.all().delete()
+
+    def test_groups_are_capped(self):
+        emails = [OutboundEmail(to_email=str(i), subject='Hi', template_id='t') for i in range(5)]
+        emails.append(OutboundEmail(to_email='x', subject='Hi', template_id='u'))
+
+        groups = list(group_for_sending(emails, size=2))
+
+        self.assertEqual([len(group) for group in groups], [2, 2, 1, 1])
+
+    def test_one_personalization_per_recipient(self):
+        emails = [
+            OutboundEmail.enqueue('a@example.com', 'Hi A', template_id='t', substitutions={'-name-': 'A'}),
+            OutboundEmail.enqueue('b@example.com', 'Hi B', template_id='t', substitutions={'-name-': 'B'}),
+        ]
+
+        body = SendGridTransport.build_mail(None, emails).get()
+
+        self.assertEqual(body['template_id'], 't')
+        self.assertEqual(len(body['personalizations']), 2)
+        second = body['personalizations'][1]
+        self.assertEqual(second['to'], [{'email': 'b@example.com'}])
+        self.assertEqual(second['subject'], 'Hi B')
+        self.assertEqual(second['substitutions'], {'-name-': 'B'})
+        self.assertEqual(second['custom_args'], {'outbound_email_id': str(emails[1].id)})
+
+
+class BroadcastEmailTest(TestCase):
+
+    def setUp(self):
+        self.profiles = [
+            users_factories.ProfileFactory(user__last_name='Broadcast{}'.format(i), verified=i < 3)
+            for i in range(5)
+        ]
+        self.profiles[0].notifications_enabled = False
+        self.profiles[0].save()
+
+    def tearDown(self):
+        OutboundEmail.objects.all().delete()
+        for profile in self.profiles:
+            profile.user.delete()
+
+    def test_queues_matching_profiles(self):
+        out = StringIO()
+        call_command('broadcast_email', 'welcome', 'Hello', verified=True, batch_size=1, stdout=out)
+
+        self.assertIn('Queued 2 emails', out.getvalue())
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list('to_email', flat=True)),
+            sorted(profile.user.email for profile in self.profiles[1:3]),
+        )
+        email = OutboundEmail.objects.get(to_email=self.profiles[1].user.email)
+        self.assertEqual(email.template_id, 'welcome')
+        self.assertEqual(email.substitutions, {'-first_name-': self.profiles[1].user.first_name})
+
+    def test_mentor_queued_once(self):
+        users_factories.MentorFactory(profile=self.profiles[1])
+        users_factories.MentorFactory(profile=self.profiles[1])
+        users_factories.MentorFactory(profile=self.profiles[2], active=False)
+
+        out = StringIO()
+        call_command('broadcast_email', 'welcome', 'Hello', mentors=True, stdout=out)
+
+        self.assertIn('Queued 1 emails', out.getvalue())
+        self.assertEqual(
+            list(OutboundEmail.objects.values_list('to_email', flat=True)),
+            [self.profiles[1].user.email],
+        )
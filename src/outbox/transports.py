@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from pickmybruin import metrics
+
+import sendgrid
+from sendgrid.helpers.mail import Email, Content, Substitution, Mail, Personalization, CustomArg
+
+# SendGrid's limit on personalizations in a single v3 mail/send request
+MAX_PERSONALIZATIONS = 1000
+
+
+class DeliveryError(Exception):
+    pass
+
+
+# The outcome of one OutboundEmail: `error` is None when it was accepted, and
+# `message_id` is the id SendGrid gave the request it went out in
+DeliveryResult = namedtuple('DeliveryResult', ['email', 'message_id', 'error'])
+
+
+def get_transport():
+    return import_string(settings.OUTBOX_TRANSPORT)()
+
+
+def group_for_sending(emails, size=MAX_PERSONALIZATIONS):
+    """
+    Splits emails into lists that can share one request: same sender,
+    template and body, at most `size` recipients each. Recipients differ only
+    in address, subject and substitutions, which are per-personalization
+    """
+    groups = OrderedDict()
+    for email in emails:
+        groups.setdefault((email.from_email, email.template_id, email.content), []).append(email)
+    for group in groups.values():
+        for start in range(0, len(group), size):
+            yield group[start:start + size]
+
+
+class SendGridTransport(object):
+    """
+    Sends through the SendGrid v3 API, one request per group of emails and
+    one personalization per recipient, reusing a single client
+    """
+    def __init__(self):
+        self.client = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
+
+    def build_mail(self, emails):
+        first = emails[0]
+        mail = Mail()
+        mail.from_email = Email(first.from_email)
+        mail.subject = first.subject
+        mail.add_content(Content('text/html', first.content))
+        if first.template_id:
+            mail.template_id = first.template_id
+
+        for email in emails:
+            personalization = Personalization()
+            personalization.add_to(Email(email.to_email))
+            personalization.subject = email.subject
+            for key, value in email.substitutions.items():
+                personalization.add_substitution(Substitution(key, value))
+            # comes back on SendGrid's event webhook, tying events to the row
+            personalization.add_custom_arg(CustomArg('outbound_email_id', str(email.id)))
+            mail.add_personalization(personalization)
+        return mail
+
+    def send_group(self, emails):
+        body = self.build_mail(emails).get()
+        start = time.time()
+        try:
+            response = self.client.client.mail.send.post(request_body=body)
+        except Exception as e:
+            metrics.SENDGRID_SECONDS.labels(outcome='error').observe(time.time() - start)
+            metrics.SENDGRID_FAILURES.labels(reason=type(e).__name__).inc()
+            raise
+        ok = 200 <= response.status_code < 300
+        metrics.SENDGRID_SECONDS.labels(outcome='ok' if ok else 'error').observe(time.time() - start)
+        if not ok:
+            metrics.SENDGRID_FAILURES.labels(reason=str(response.status_code)).inc()
+            raise DeliveryError('SendGrid returned {}'.format(response.status_code))
+        return response.headers.get('X-Message-Id', '')
+
+    def send_many(self, emails):
+        results = []
+        for group in group_for_sending(emails):
+            try:
+                message_id = self.send_group(group)
+            except Exception as e:
+                results.extend(DeliveryResult(email, '', e) for email in group)
+            else:
+                results.extend(DeliveryResult(email, message_id, None) for email in group)
+        return results
+
+
+class LocalTransport(object):
+    """
+    Keeps sent emails in memory instead of sending them, for tests and local
+    development. `requests` holds the groups a real transport would have sent
+    together. Addresses in `failing` fail to deliver
+    """
+    outbox = []
+    requests = []
+    failing = set()
+
+    def send_many(self, emails):
+        results = []
+        for group in group_for_sending(emails):
+            message_id = 'local-{}'.format(len(LocalTransport.requests))
+            LocalTransport.requests.append(group)
+            for email in group:
+                if email.to_email in LocalTransport.failing:
+                    results.append(DeliveryResult(email, '', DeliveryError('{} is failing'.format(email.to_email))))
+                else:
+                    LocalTransport.outbox.append(email)
+                    results.append(DeliveryResult(email, message_id, None))
+        return results
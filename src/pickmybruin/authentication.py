@@ -0,0 +1,190 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import SAFE_METHODS
+from users.models import Mentor, Profile
+
+AccessToken = get_access_token_model()
+
+
+def own_mentor_id():
+    """For annotate(): the id of the mentor of the row's `user`, or None"""
+    mentors = Mentor.objects.filter(profile__user=OuterRef('user')).order_by('id')
+    return Subquery(mentors.values('id')[:1])
+
+
+def get_own_profile(request):
+    """
+    The caller's Profile with its user, and own_mentor_id set to the id of
+    their Mentor or None. Loaded once per request, by token authentication
+    if that is how they signed in; 404 if they have no profile.
+
+    Writes load it afresh: token authentication's copy may be up to
+    TOKEN_CACHE_TTL seconds old, and saving it would undo newer changes.
+    """
+    if not hasattr(request, '_own_profile'):
+        user = request.user
+        profile = None
+        if request.method in SAFE_METHODS:
+            profile = getattr(user, '_own_profile', None)
+        if profile is None:
+            try:
+                # from `default` even where reads go to a replica, like the
+                # authentication: a new account may not have replicated yet
+                profiles = Profile.objects.using(DEFAULT_DB_ALIAS)
+                profile = profiles.annotate(own_mentor_id=own_mentor_id()).get(user=user)
+            except Profile.DoesNotExist:
+                raise Http404
+            profile.user = user
+        request._own_profile = profile
+    return request._own_profile
+
+
+class TokenCache(object):
+    """
+    token -> (user with its profile and mentor id, token expiry), least
+    recently used first, for this process. Entries live at most `ttl` seconds, which
+    bounds how long a token revoked or a user changed through another
+    process keeps working here; changes made in this process evict at once.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user, expires, cached_at = entry
+            if time.monotonic() - cached_at >= self.ttl or expires <= timezone.now():
+                self._discard(token)
+                return None
+            self._entries.move_to_end(token)
+        # views may change the user they're given
+        return copy.deepcopy(user)
+
+    def set(self, token, user, expires):
+        with self._lock:
+            self._discard(token)
+            self._entries[token] = (user, expires, time.monotonic())
+            self._by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.size:
+                self._discard(next(iter(self._entries)))
+
+    def evict(self, token):
+        with self._lock:
+            self._discard(token)
+
+    def evict_user(self, user_id):
+        with self._lock:
+            for token in list(self._by_user.get(user_id, ())):
+                self._discard(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[0].id
+        tokens = self._by_user[user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self._by_user[user_id]
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+
+class CachedTokenAuthentication(BaseAuthentication):
+    """
+    `Authorization: Bearer <token>` with an oauth2_provider access token,
+    as issued by /o/token/. A token seen recently costs no queries;
+    otherwise the token, user, profile and mentor id come from one joined
+    query. See get_own_profile().
+    Scopes aren't checked, as with oauth2_provider's own authentication.
+    """
+    keyword = 'bearer'
+    www_authenticate_realm = 'api'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid token header.')
+
+        user = token_cache.get(token)
+        if user is None:
+            user = self._load(token)
+        return user, token
+
+    def _load(self, token):
+        try:
+            access_token = AccessToken.objects.select_related('user__profile').annotate(
+                own_mentor_id=own_mentor_id(),
+            ).get(token=token)
+        except AccessToken.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        user = access_token.user
+        if access_token.is_expired() or user is None:
+            raise AuthenticationFailed('Invalid token.')
+        if not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        try:
+            user._own_profile = user.profile
+            user._own_profile.own_mentor_id = access_token.own_mentor_id
+        except Profile.DoesNotExist:
+            pass
+        token_cache.set(token, copy.deepcopy(user), access_token.expires)
+        return user
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="{}"'.format(self.www_authenticate_realm)
+
+
+def access_token_changed(sender, instance, **kwargs):
+    # revoking a token deletes it; refreshing replaces it
+    token_cache.evict(instance.token)
+post_save.connect(access_token_changed, sender=AccessToken)
+post_delete.connect(access_token_changed, sender=AccessToken)
+
+def user_changed(sender, instance, **kwargs):
+    token_cache.evict_user(instance.user_id if sender is Profile else instance.id)
+for model in (User, Profile):
+    post_save.connect(user_changed, sender=model)
+    post_delete.connect(user_changed, sender=model)
+
+def mentor_changed(sender, instance, created=True, **kwargs):
+    # only which mentor a profile has is cached
+    if created:
+        user_id = Profile.objects.filter(id=instance.profile_id).values_list('user_id', flat=True).first()
+        token_cache.evict_user(user_id)
+post_save.connect(mentor_changed, sender=Mentor)
+post_delete.connect(mentor_changed, sender=Mentor)
@@ -0,0 +1,416 @@
+"""
+Seeds a benchmark dataset through the test factories and replays timed
+requests against the main read endpoints. Used by the benchmark command.
+"""
+import random
+import time
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from faker import Faker
+from rest_framework.test import APIClient
+
+from blog import factories as blog_factories
+from blog.models import BlogPost, Comment
+from messaging import factories as messaging_factories
+from messaging.models import Message, Thread
+from users import factories as users_factories
+from users.models import Course, Major, Mentor, Minor, Profile
+from users.search import BUILD_SEARCH_DOCUMENTS_SQL
+
+from .profiling import percentile
+
+# What `benchmark` seeds by default. Each table is topped up to its size,
+# so re-running against a kept database only adds what is missing
+DEFAULT_SIZES = OrderedDict([
+    ('profiles', 50000),
+    ('mentors', 10000),
+    ('threads', 100000),
+    ('messages', 1000000),
+    ('posts', 100000),
+    ('comments', 300000),
+])
+
+
+def skewed(rng, count):
+    """An index below `count`, mostly small ones, so a few rows are busy"""
+    return int(count * rng.random() ** 3)
+
+
+class Seeder(object):
+    """
+    Bulk loads the dataset: rows are built by the factories without saving
+    and inserted `batch_size` at a time. bulk_create skips signals, so the
+    derived data the signals would maintain is rebuilt in bulk at the end
+    """
+    def __init__(self, sizes, batch_size=5000, seed=0, stdout=None):
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        self.fake = Faker()
+        self.fake.seed(seed)
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def batches(self, count):
+        for start in range(0, count, self.batch_size):
+            yield range(start, min(count, start + self.batch_size))
+
+    def seed(self):
+        self.seed_profiles()
+        self.seed_catalog()
+        self.seed_mentors()
+        self.seed_threads()
+        self.seed_messages()
+        self.seed_posts()
+        self.seed_comments()
+        self.log('Rebuilding derived data')
+        with connection.cursor() as cursor:
+            cursor.execute(BUILD_SEARCH_DOCUMENTS_SQL)
+        call_command('backfill_completion_scores', stdout=StringIO())
+        Thread.reconcile()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def seed_profiles(self):
+        existing = Profile.objects.count()
+        missing = max(0, self.sizes['profiles'] - existing)
+        self.log('Seeding {} profiles'.format(missing))
+        start = User.objects.count()
+        for batch in self.batches(missing):
+            users = [
+                users_factories.UserFactory.build(
+                    username='bench-{}'.format(start + i),
+                    last_login=timezone.now(),
+                )
+                for i in batch
+            ]
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                Profile.objects.bulk_create([
+                    users_factories.ProfileFactory.build(
+                        user=user,
+                        verified=True,
+                        year=self.rng.choice(Profile.YEAR_CHOICES)[0],
+                    )
+                    for user in users
+                ])
+        self.profile_ids = list(Profile.objects.order_by('id').values_list('id', flat=True))
+        self.user_ids = dict(Profile.objects.values_list('id', 'user_id'))
+
+    def seed_catalog(self):
+        call_command('populate_tables', stdout=StringIO())
+
+    def seed_mentors(self):
+        existing = Mentor.objects.count()
+        missing = max(0, self.sizes['mentors'] - existing)
+        self.log('Seeding {} mentors'.format(missing))
+        # mentors are the profiles without one, in order
+        mentored = set(Mentor.objects.values_list('profile_id', flat=True))
+        candidates = [profile_id for profile_id in self.profile_ids if profile_id not in mentored][:missing]
+        majors = list(Major.objects.values_list('id', flat=True))
+        minors = list(Minor.objects.values_list('id', flat=True))
+        courses = list(Course.objects.values_list('id', flat=True))
+
+        for batch in self.batches(len(candidates)):
+            mentors = [
+                users_factories.MentorFactory.build(
+                    profile=Profile(id=candidates[i]),
+                    bio=self.fake.paragraph(),
+                    clubs=self.fake.catch_phrase(),
+                    gpa=round(self.rng.uniform(2, 4), 2),
+                )
+                for i in batch
+            ]
+            with transaction.atomic():
+                Mentor.objects.bulk_create(mentors)
+                links = ((Mentor.major.through, 'major_id', majors, 1, 2),
+                         (Mentor.minor.through, 'minor_id', minors, 0, 3),
+                         (Mentor.courses.through, 'course_id', courses, 2, 6))
+                for through, field, choices, low, high in links:
+                    through.objects.bulk_create(
+                        through(mentor_id=mentor.id, **{field: choice})
+                        for mentor in mentors
+                        for choice in self.rng.sample(choices, min(len(choices), self.rng.randint(low, high)))
+                    )
+
+    def seed_threads(self):
+        existing = Thread.objects.count()
+        missing = max(0, self.sizes['threads'] - existing)
+        self.log('Seeding {} threads'.format(missing))
+        profiles = self.profile_ids
+        pairs = set(Thread.objects.values_list('pair_low', 'pair_high'))
+        # more threads than pairs would never finish
+        missing = min(missing, len(profiles) * (len(profiles) - 1) // 2 - len(pairs))
+
+        new_pairs = []
+        while len(new_pairs) < missing:
+            pair = Thread.pair_ids(profiles[skewed(self.rng, len(profiles))], self.rng.choice(profiles))
+            if pair[0] != pair[1] and pair not in pairs:
+                pairs.add(pair)
+                new_pairs.append(pair)
+
+        for batch in self.batches(len(new_pairs)):
+            # bulk_create skips save(), which sets the pair
+            Thread.objects.bulk_create(
+                messaging_factories.ThreadFactory.build(
+                    profile_1=Profile(id=new_pairs[i][0]),
+                    profile_2=Profile(id=new_pairs[i][1]),
+                    pair_low=new_pairs[i][0],
+                    pair_high=new_pairs[i][1],
+                )
+                for i in batch
+            )
+
+    def seed_messages(self):
+        existing = Message.objects.count()
+        missing = max(0, self.sizes['messages'] - existing)
+        self.log('Seeding {} messages'.format(missing))
+        threads = list(Thread.objects.order_by('id').values_list('id', 'profile_1_id', 'profile_2_id'))
+        if not threads:
+            return
+        for batch in self.batches(missing):
+            messages = []
+            for i in batch:
+                thread_id, profile_1_id, profile_2_id = threads[skewed(self.rng, len(threads))]
+                messages.append(messaging_factories.MessageFactory.build(
+                    thread=Thread(id=thread_id),
+                    sender=Profile(id=self.rng.choice((profile_1_id, profile_2_id))),
+                    body=self.fake.sentence(),
+                ))
+            Message.objects.bulk_create(messages)
+
+    def seed_posts(self):
+        existing = BlogPost.objects.count()
+        missing = max(0, self.sizes['posts'] - existing)
+        self.log('Seeding {} blog posts'.format(missing))
+        for batch in self.batches(missing):
+            BlogPost.objects.bulk_create(
+                blog_factories.BlogFactory.build(
+                    user_id=self.user_ids[self.rng.choice(self.profile_ids)],
+                    author=self.fake.name(),
+                    body=self.fake.text(),
+                )
+                for i in batch
+            )
+
+    def seed_comments(self):
+        existing = Comment.objects.count()
+        missing = max(0, self.sizes['comments'] - existing)
+        self.log('Seeding {} comments'.format(missing))
+        posts = list(BlogPost.objects.order_by('id').values_list('id', flat=True))
+        if not posts:
+            return
+        for batch in self.batches(missing):
+            # trees: about half the comments reply to an earlier comment on
+            # the same post. Inserted a level at a time so parents have ids
+            trees = {}
+            levels = []
+            for i in batch:
+                post_id = posts[skewed(self.rng, len(posts))]
+                tree = trees.setdefault(post_id, [])
+                parent, depth = (self.rng.choice(tree) if tree and self.rng.random() < 0.5 else (None, -1))
+                comment = blog_factories.CommentFactory.build(
+                    blog=BlogPost(id=post_id) if parent is None else None,
+                    comment=parent,
+                    user_id=self.user_ids[self.rng.choice(self.profile_ids)],
+                    author=self.fake.first_name(),
+                    body=self.fake.sentence(),
+                )
+                tree.append((comment, depth + 1))
+                if len(levels) <= depth + 1:
+                    levels.append([])
+                levels[depth + 1].append(comment)
+
+            with transaction.atomic():
+                for level in levels:
+                    # the parent had no id when it was assigned
+                    for comment in level:
+                        comment.comment = comment.comment
+                    Comment.objects.bulk_create(level)
+
+
+class Scenario(object):
+    """
+    A named sequence of requests. setup() picks the request targets from
+    the seeded data, so every run of a given dataset times the same requests
+    """
+    name = None
+
+    def __init__(self, rng, iterations):
+        self.rng = rng
+        self.iterations = iterations
+
+    def setup(self):
+        raise NotImplementedError
+
+    def requests(self):
+        """(user, url, params) for each iteration"""
+        raise NotImplementedError
+
+
+class MentorSearchScenario(Scenario):
+    name = 'mentor_search'
+
+    def setup(self):
+        words = list(Major.objects.values_list('name', flat=True)[:200])
+        words += list(User.objects.filter(profile__mentor__isnull=False).values_list('first_name', flat=True)[:200])
+        self.user = User.objects.filter(profile__isnull=False).first()
+        self.words = [self.rng.choice(word.split()) for word in self.rng.sample(words, min(len(words), self.iterations))]
+
+    def requests(self):
+        for i in range(self.iterations):
+            yield self.user, reverse('users:mentors_search'), {'query': self.words[i % len(self.words)]}
+
+
+class InboxScenario(Scenario):
+    name = 'inbox'
+
+    def setup(self):
+        # the profiles with the most threads
+        busiest = Thread.objects.values('profile_1').annotate(threads=Count('id')).order_by('-threads')
+        self.users = list(User.objects.filter(
+            profile__id__in=[row['profile_1'] for row in busiest[:self.iterations]],
+        ))
+
+    def requests(self):
+        for i in range(self.iterations):
+            yield self.users[i % len(self.users)], reverse('messaging:thread_list'), {}
+
+
+class ThreadHistoryScenario(Scenario):
+    name = 'thread_history'
+
+    def setup(self):
+        # the longest threads, read by their first participant
+        busiest = Message.objects.values('thread').annotate(messages=Count('id')).order_by('-messages')
+        threads = Thread.objects.filter(
+            id__in=[row['thread'] for row in busiest[:self.iterations]],
+        ).select_related('profile_1__user')
+        self.targets = [(thread.profile_1.user, thread.profile_2_id) for thread in threads]
+
+    def requests(self):
+        for i in range(self.iterations):
+            user, other_id = self.targets[i % len(self.targets)]
+            yield user, reverse('messaging:send_get_messages', kwargs={'profile_id': other_id}), {}
+
+
+class CheckHistoryScenario(Scenario):
+    name = 'check_history'
+
+    def setup(self):
+        # a cheap endpoint, so connection setup is most of its cost
+        threads = Thread.objects.order_by('id').select_related('profile_1__user')[:self.iterations]
+        self.targets = [(thread.profile_1.user, thread.profile_2_id) for thread in threads]
+
+    def requests(self):
+        for i in range(self.iterations):
+            user, other_id = self.targets[i % len(self.targets)]
+            yield user, reverse('messaging:check_history', kwargs={'profile_id': other_id}), {}
+
+
+class BlogSearchScenario(Scenario):
+    name = 'blog_search'
+
+    def setup(self):
+        titles = list(BlogPost.objects.order_by('id').values_list('title', flat=True)[:500])
+        self.user = User.objects.filter(profile__isnull=False).first()
+        self.words = [
+            max(title.rstrip('.').split(), key=len)
+            for title in self.rng.sample(titles, min(len(titles), self.iterations))
+        ]
+
+    def requests(self):
+        for i in range(self.iterations):
+            yield self.user, reverse('blog:blogs'), {'query': self.words[i % len(self.words)]}
+
+
+class CommentTreeScenario(Scenario):
+    name = 'comment_tree'
+
+    def setup(self):
+        busiest = Comment.objects.filter(blog__isnull=False).values('blog').annotate(comments=Count('id')).order_by('-comments')
+        self.posts = [row['blog'] for row in busiest[:self.iterations]]
+        self.user = User.objects.filter(profile__isnull=False).first()
+
+    def requests(self):
+        for i in range(self.iterations):
+            yield self.user, reverse('blog:blogcomments', kwargs={'blog_id': self.posts[i % len(self.posts)]}), {'depth': 3}
+
+
+SCENARIOS = OrderedDict((scenario.name, scenario) for scenario in (
+    MentorSearchScenario,
+    InboxScenario,
+    ThreadHistoryScenario,
+    CheckHistoryScenario,
+    BlogSearchScenario,
+    CommentTreeScenario,
+))
+
+
+# How run_scenario treats the database connection between requests
+CONNECTION_MODES = ('persistent', 'per-request')
+
+
+def run_scenario(scenario, warmup=3, connections='persistent'):
+    """
+    Times each request through the full middleware and view stack. With
+    'per-request' connections every request opens its own, as with
+    CONN_MAX_AGE = 0; 'persistent' keeps one, as with CONN_MAX_AGE or
+    pgbouncer
+    """
+    scenario.setup()
+    client = APIClient()
+    timings = []
+    queries = []
+    errors = 0
+    for i, (user, url, params) in enumerate(scenario.requests()):
+        client.force_authenticate(user=user)
+        if connections == 'per-request':
+            connection.close()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = client.get(url, params)
+            elapsed = time.perf_counter() - start
+        if i < warmup:
+            continue
+        if response.status_code != 200:
+            errors += 1
+        timings.append(elapsed * 1000)
+        queries.append(len(captured))
+
+    if not timings:
+        return OrderedDict([('requests', 0), ('errors', errors)])
+    timings.sort()
+    return OrderedDict([
+        ('requests', len(timings)),
+        ('errors', errors),
+        ('mean_ms', round(sum(timings) / len(timings), 3)),
+        ('p50_ms', round(percentile(timings, 50), 3)),
+        ('p95_ms', round(percentile(timings, 95), 3)),
+        ('p99_ms', round(percentile(timings, 99), 3)),
+        ('max_ms', round(max(timings), 3)),
+        ('mean_queries', round(sum(queries) / len(queries), 2)),
+        ('max_queries', max(queries)),
+    ])
+
+
+def dataset_counts():
+    return OrderedDict([
+        ('profiles', Profile.objects.count()),
+        ('mentors', Mentor.objects.count()),
+        ('threads', Thread.objects.count()),
+        ('messages', Message.objects.count()),
+        ('posts', BlogPost.objects.count()),
+        ('comments', Comment.objects.count()),
+    ])
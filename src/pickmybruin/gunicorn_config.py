@@ -0,0 +1,73 @@
+"""
+gunicorn settings for serving pickmybruin.wsgi; see initialize.sh. Each can
+be overridden from the environment:
+
+    GUNICORN_WORKER_CLASS  sync, gthread (default) or gevent. gevent needs
+                           the gevent and psycogreen packages installed
+    GUNICORN_WORKERS       processes, default 2 per CPU + 1
+    GUNICORN_THREADS       threads per gthread worker, default 4
+    GUNICORN_CONNECTIONS   concurrent requests per gevent worker, default 100
+    GUNICORN_MAX_REQUESTS  requests before a worker is replaced, default 1000
+    GUNICORN_TIMEOUT       seconds a request may take, default 30
+"""
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pickmybruin.settings')
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class not in ('sync', 'gthread', 'gevent'):
+    raise ValueError('GUNICORN_WORKER_CLASS must be sync, gthread or gevent')
+if worker_class == 'gevent':
+    # before the app is preloaded, so the locks it creates are gevent's and
+    # psycopg2 waits by yielding instead of blocking the worker
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) if worker_class == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 100))
+
+# Django and the apps are imported once, in the master, and the workers
+# share those pages after forking instead of each importing them
+preload_app = True
+
+# Replaces each worker after this many requests, jittered so they don't
+# all restart together, to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+# A worker stuck on one request this long is killed and replaced; on
+# shutdown or reload workers get graceful_timeout to finish what they have
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # the previous run's workers are gone; see pickmybruin.metrics
+    from pickmybruin.metrics import REGISTRY
+    REGISTRY.clear()
+
+
+def child_exit(server, worker):
+    # keeps totals without keeping a file for every worker max_requests
+    # has replaced
+    from pickmybruin.metrics import REGISTRY
+    REGISTRY.merge(worker.pid)
+
+
+def pre_fork(server, worker):
+    # a connection the master opened while loading must not be shared by
+    # the workers; each opens its own
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
@@ -0,0 +1,82 @@
+import json
+import random
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from pickmybruin.benchmark import (
+    CONNECTION_MODES, DEFAULT_SIZES, SCENARIOS, Seeder, dataset_counts, run_scenario,
+)
+
+
+class Command(BaseCommand):
+    help = 'Seed a benchmark dataset and time the main read endpoints, writing JSON results'
+
+    def add_arguments(self, parser):
+        for name, size in DEFAULT_SIZES.items():
+            parser.add_argument('--' + name, type=int, default=size,
+                help='Rows to seed (default {})'.format(size))
+        parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+            help='Only run these scenarios; may be repeated')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--connections', choices=CONNECTION_MODES, default='persistent',
+            help='Keep one database connection, or open one per request; compare runs with --label. '
+                 'To measure pgbouncer, point DATABASE_HOST/PORT at it and use --in-place')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0,
+            help='Random seed for the dataset and the requests')
+        parser.add_argument('--label', default='',
+            help='Stored in the results, e.g. the commit being measured')
+        parser.add_argument('--output', default=None,
+            help='Write the JSON results here instead of stdout')
+        parser.add_argument('--keepdb', action='store_true',
+            help='Keep the benchmark database, and its data, for the next run')
+        parser.add_argument('--in-place', action='store_true',
+            help='Use the configured database as is instead of a separate benchmark database')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['in_place']:
+            results = self._run(kwargs)
+        else:
+            # the test database: created and migrated here, dropped afterwards
+            # unless --keepdb
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=kwargs['keepdb'])
+            try:
+                results = self._run(kwargs)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=kwargs['keepdb'])
+
+        output = json.dumps(results, indent=2)
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write('Wrote results to {}'.format(kwargs['output']))
+        else:
+            self.stdout.write(output)
+
+    def _run(self, kwargs):
+        sizes = OrderedDict((name, kwargs[name]) for name in DEFAULT_SIZES)
+        Seeder(sizes, kwargs['batch_size'], kwargs['seed'], stdout=self.stderr).seed()
+
+        results = OrderedDict([
+            ('label', kwargs['label']),
+            ('seed', kwargs['seed']),
+            ('iterations', kwargs['iterations']),
+            ('connections', kwargs['connections']),
+            ('dataset', dataset_counts()),
+            ('scenarios', OrderedDict()),
+        ])
+        rng = random.Random(kwargs['seed'])
+        # profiled requests would add their own overhead to the timings
+        with override_settings(QUERY_PROFILER_SAMPLE_RATE=0):
+            for name in kwargs['scenario'] or SCENARIOS:
+                self.stderr.write('Running {}'.format(name))
+                scenario = SCENARIOS[name](rng, kwargs['iterations'] + kwargs['warmup'])
+                try:
+                    results['scenarios'][name] = run_scenario(scenario, kwargs['warmup'], kwargs['connections'])
+                except IndexError:
+                    raise CommandError('Not enough data for the {} scenario'.format(name))
+        return results
@@ -0,0 +1,59 @@
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pickmybruin.profiling import SampleRing, percentile
+
+
+class Command(BaseCommand):
+    help = 'Print p50/p95/p99 query count and timings per endpoint from profiled requests'
+
+    METRICS = (
+        ('queries', 'queries'),
+        ('wall_ms', 'wall ms'),
+        ('db_ms', 'db ms'),
+        ('serializer_ms', 'serializer ms'),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=float, default=None,
+            help='Only samples from the last N minutes')
+        parser.add_argument('--sort', default='wall_ms', choices=[name for name, _ in self.METRICS],
+            help='Order endpoints by this metric\'s p95')
+        parser.add_argument('--clear', action='store_true',
+            help='Discard all samples after printing')
+
+    def handle(self, *args, **kwargs):
+        ring = SampleRing(settings.QUERY_PROFILER_PATH, settings.QUERY_PROFILER_CAPACITY)
+        samples = ring.samples()
+        if kwargs['since'] is not None:
+            cutoff = time.time() - kwargs['since'] * 60
+            samples = [sample for sample in samples if sample.timestamp >= cutoff]
+
+        by_endpoint = defaultdict(list)
+        for sample in samples:
+            by_endpoint[sample.endpoint].append(sample)
+
+        rows = []
+        for endpoint, endpoint_samples in by_endpoint.items():
+            row = {'endpoint': endpoint, 'count': len(endpoint_samples)}
+            for name, _ in self.METRICS:
+                values = sorted(getattr(sample, name) for sample in endpoint_samples)
+                row[name] = [percentile(values, pct) for pct in (50, 95, 99)]
+            rows.append(row)
+        rows.sort(key=lambda row: row[kwargs['sort']][1], reverse=True)
+
+        header = '{:<40} {:>6}'.format('endpoint', 'n')
+        for _, label in self.METRICS:
+            header += ' {:>24}'.format(label + ' p50/p95/p99')
+        self.stdout.write(header)
+        for row in rows:
+            line = '{:<40} {:>6}'.format(row['endpoint'][:40], row['count'])
+            for name, _ in self.METRICS:
+                line += ' {:>24}'.format('/'.join('{:.0f}'.format(value) for value in row[name]))
+            self.stdout.write(line)
+        self.stdout.write('{} samples'.format(len(samples)))
+
+        if kwargs['clear']:
+            ring.clear()
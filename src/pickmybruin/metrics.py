@@ -0,0 +1,341 @@
+"""
+Prometheus-style counters and histograms that work under multi-process
+gunicorn. Each process keeps its values in its own memory-mapped file in
+METRICS_DIR, and the /metrics view sums every process's file. When gunicorn
+replaces a worker its file is added into one aggregate file, so totals
+include recycled workers without a file for each.
+"""
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+_ENTRY_HEADER = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+_USED = struct.Struct('<Q')
+
+
+class ValueFile(object):
+    """
+    Append-only map of sample key to float in a memory-mapped file. An
+    entry is written before the used-bytes header that publishes it, so a
+    reader in another process never sees half an entry
+    """
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.offsets = {}
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size == 0:
+            self.file.truncate(self.initial_size)
+        self.mmap = mmap.mmap(fd, 0)
+        self.used = _USED.unpack_from(self.mmap, 0)[0] or _USED.size
+        for key, value, offset in read_entries(self.mmap, self.used):
+            self.offsets[key] = offset
+
+    def _grow(self, needed):
+        size = len(self.mmap)
+        while size < needed:
+            size *= 2
+        self.mmap.close()
+        self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+
+    def _add_entry(self, key):
+        encoded = key.encode('utf-8')
+        # pad so the value is 8-byte aligned
+        padded = len(encoded) + (8 - (_ENTRY_HEADER.size + len(encoded)) % 8) % 8
+        size = _ENTRY_HEADER.size + padded + _VALUE.size
+        if self.used + size > len(self.mmap):
+            self._grow(self.used + size)
+        offset = self.used
+        _ENTRY_HEADER.pack_into(self.mmap, offset, len(encoded))
+        self.mmap[offset + _ENTRY_HEADER.size:offset + _ENTRY_HEADER.size + len(encoded)] = encoded
+        value_offset = offset + _ENTRY_HEADER.size + padded
+        _VALUE.pack_into(self.mmap, value_offset, 0.0)
+        self.used += size
+        _USED.pack_into(self.mmap, 0, self.used)
+        self.offsets[key] = value_offset
+        return value_offset
+
+    def inc(self, key, amount):
+        with self.lock:
+            offset = self.offsets.get(key)
+            if offset is None:
+                offset = self._add_entry(key)
+            _VALUE.pack_into(self.mmap, offset, _VALUE.unpack_from(self.mmap, offset)[0] + amount)
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+def read_entries(buffer, used):
+    offset = _USED.size
+    while offset < used:
+        length = _ENTRY_HEADER.unpack_from(buffer, offset)[0]
+        key = bytes(buffer[offset + _ENTRY_HEADER.size:offset + _ENTRY_HEADER.size + length]).decode('utf-8')
+        padded = length + (8 - (_ENTRY_HEADER.size + length) % 8) % 8
+        value_offset = offset + _ENTRY_HEADER.size + padded
+        yield key, _VALUE.unpack_from(buffer, value_offset)[0], value_offset
+        offset = value_offset + _VALUE.size
+
+
+def read_file(path):
+    """(key, value) for each entry of a ValueFile another process may be writing"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return
+    used = _USED.unpack_from(data, 0)[0]
+    for key, value, _ in read_entries(data, min(used, len(data))):
+        yield key, value
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self._values = None
+        self._owner = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _path(self, name):
+        return os.path.join(settings.METRICS_DIR, 'metrics_{}.db'.format(name))
+
+    @contextmanager
+    def _locked(self, operation):
+        # merge() holds it exclusively, so a collect() sees a dead process's
+        # values exactly once: in its own file or in the aggregate
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(os.path.join(settings.METRICS_DIR, 'metrics.lock'), 'a') as f:
+            fcntl.flock(f, operation)
+            yield
+
+    def values(self):
+        # one file per process; a forked worker opens its own
+        owner = (os.getpid(), settings.METRICS_DIR)
+        with self._lock:
+            if self._owner != owner:
+                self._owner = owner
+                path = self._path(os.getpid())
+                try:
+                    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+                    self._values = ValueFile(path)
+                except (IOError, OSError):
+                    # metrics must never fail a request; this process goes unmeasured
+                    logger.warning('could not open metrics file %s', path, exc_info=True)
+                    self._values = None
+            return self._values
+
+    def inc(self, sample, labels, amount):
+        values = self.values()
+        if values is not None:
+            values.inc(json.dumps([sample, labels], sort_keys=True), amount)
+
+    def clear(self):
+        """Removes every process's file; for server start, before workers run"""
+        for path in glob.glob(self._path('*')):
+            os.remove(path)
+        with self._lock:
+            self._owner = None
+            self._values = None
+
+    def merge(self, pid):
+        """
+        Adds the values of process `pid`, which has exited, into the
+        aggregate file and removes its own file
+        """
+        path = self._path(pid)
+        if not os.path.exists(path):
+            return
+        with self._locked(fcntl.LOCK_EX):
+            aggregate = ValueFile(self._path('aggregate'))
+            try:
+                for key, value in read_file(path):
+                    aggregate.inc(key, value)
+            finally:
+                aggregate.close()
+            os.remove(path)
+
+    def collect(self):
+        """Totals across every process's file: {(sample, labels json): value}"""
+        totals = {}
+        with self._locked(fcntl.LOCK_SH):
+            for path in glob.glob(self._path('*')):
+                for key, value in read_file(path):
+                    totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def expose(self):
+        """The text exposition format"""
+        samples = {}
+        for key, value in self.collect().items():
+            sample, labels = json.loads(key)
+            samples.setdefault(sample, []).append((labels, value))
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for sample in metric.sample_names():
+                for labels, value in sorted(samples.get(sample, []), key=lambda item: sorted(item[0].items())):
+                    lines.append('{}{} {}'.format(sample, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())
+    ) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    def labels(self, **labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(self.name, self.labelnames))
+        return self._child(dict((name, str(value)) for name, value in labels.items()))
+
+    def sample_names(self):
+        return [self.name]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self, labels):
+        return _CounterChild(self, labels)
+
+    def inc(self, amount=1):
+        self._child({}).inc(amount)
+
+
+class _CounterChild(object):
+
+    def __init__(self, counter, labels):
+        self.counter = counter
+        self.labels = labels
+
+    def inc(self, amount=1):
+        self.counter.registry.inc(self.counter.name, self.labels, amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def _child(self, labels):
+        return _HistogramChild(self, labels)
+
+    def sample_names(self):
+        return [self.name + '_bucket', self.name + '_sum', self.name + '_count']
+
+    def observe(self, value):
+        self._child({}).observe(value)
+
+    def time(self):
+        return self._child({}).time()
+
+
+class _HistogramChild(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def observe(self, value):
+        histogram = self.histogram
+        registry = histogram.registry
+        # buckets are stored cumulative, as they are exposed
+        for bound in histogram.buckets:
+            if value <= bound:
+                registry.inc(histogram.name + '_bucket', dict(self.labels, le=format_value(bound)), 1)
+        registry.inc(histogram.name + '_sum', self.labels, value)
+        registry.inc(histogram.name + '_count', self.labels, 1)
+
+    @contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+
+# Everything the app reports. Defined here so /metrics describes every
+# family no matter which modules the scraped worker has imported
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by URL name',
+    ['endpoint', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_queries', 'Database queries per request, for profiled requests',
+    ['endpoint'], buckets=(1, 2, 5, 10, 20, 50, 100, 200, float('inf')),
+)
+SENDGRID_SECONDS = Histogram(
+    'sendgrid_request_duration_seconds', 'Latency of SendGrid mail/send requests',
+    ['outcome'],
+)
+SENDGRID_FAILURES = Counter(
+    'sendgrid_failures_total', 'SendGrid mail/send requests that failed',
+    ['reason'],
+)
+WEBSOCKETS_NOTIFY_SECONDS = Histogram(
+    'websockets_notify_duration_seconds', 'Latency of posts to the websockets service',
+    ['outcome'],
+)
+WEBSOCKETS_NOTIFICATIONS = Counter(
+    'websockets_notifications_total', 'Websocket notifications by what happened to them',
+    ['outcome'],
+)
+S3_DELETE_SECONDS = Histogram(
+    's3_delete_duration_seconds', 'Latency of S3 object deletes',
+    ['outcome'],
+)
+SEARCH_SECONDS = Histogram(
+    'search_query_duration_seconds', 'Time spent running trigram search queries',
+    ['view'],
+)
@@ -1,5 +1,141 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
 from rest_framework.authentication import SessionAuthentication 
+from rest_framework.permissions import SAFE_METHODS
+
+from . import metrics
+from .profiling import (
+    Sample, SampleRing, install_serializer_timing, start_serializer_timing,
+    stop_serializer_timing,
+)
+
+logger = logging.getLogger(__name__)
 
 class CsrfExemptSessionAuthentication(SessionAuthentication):
     def enforce_csrf(self, request):
         return  # To not perform the csrf check previously happening
+
+
+def record_request(request, response, seconds):
+    """Observes the request's latency; returns its endpoint label"""
+    match = getattr(request, 'resolver_match', None)
+    endpoint = match.view_name if match and match.view_name else 'unresolved'
+    metrics.REQUEST_SECONDS.labels(
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    ).observe(seconds)
+    return endpoint
+
+
+class ConnectionHealthMiddleware(object):
+    """
+    Closes a kept database connection (CONN_MAX_AGE) that the server or
+    pgbouncer dropped while it sat idle, so the request opens a new one
+    instead of failing on its first query; Django 1.11 only notices once a
+    query has failed. Connections used within the last
+    DATABASE_HEALTH_CHECK_IDLE seconds are trusted, the rest cost a `SELECT 1`
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        now = time.monotonic()
+        for connection in connections.all():
+            if connection.connection is None or connection.in_atomic_block:
+                continue
+            idle_since = getattr(connection, 'idle_since', None)
+            if idle_since is not None and now - idle_since < settings.DATABASE_HEALTH_CHECK_IDLE:
+                continue
+            if not connection.is_usable():
+                connection.close()
+        try:
+            return self.get_response(request)
+        finally:
+            now = time.monotonic()
+            for connection in connections.all():
+                connection.idle_since = now
+
+
+class ReplicaStickinessMiddleware(object):
+    """
+    After a successful write, sets REPLICA_STICKY_COOKIE for
+    REPLICA_STICKY_SECONDS, which keeps the client's reads on `default`
+    until replicas have caught up. See pickmybruin.routers
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if (settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS
+                and response.status_code < 400):
+            response.set_cookie(
+                settings.REPLICA_STICKY_COOKIE, '1',
+                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True,
+            )
+        return response
+
+
+class QueryProfilerMiddleware(object):
+    """
+    When QUERY_PROFILER_ENABLED, records query count, database time,
+    serializer time and wall time for a random QUERY_PROFILER_SAMPLE_RATE
+    share of requests, keyed by URL name, into the ring buffer at
+    QUERY_PROFILER_PATH. See the query_report command. Every request's
+    latency goes to the request metrics
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if settings.QUERY_PROFILER_ENABLED:
+            install_serializer_timing()
+
+    def __call__(self, request):
+        if not settings.QUERY_PROFILER_ENABLED or random.random() >= settings.QUERY_PROFILER_SAMPLE_RATE:
+            start = time.time()
+            response = self.get_response(request)
+            record_request(request, response, time.time() - start)
+            return response
+
+        # Django 1.11 has no execute_wrapper; the debug cursor records each
+        # query's SQL and time for the duration of the request
+        tracked = []
+        for connection in connections.all():
+            tracked.append((connection, connection.force_debug_cursor, len(connection.queries_log)))
+            connection.force_debug_cursor = True
+
+        start_serializer_timing()
+        start = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            wall = time.time() - start
+            serializer = stop_serializer_timing()
+            queries = 0
+            db = 0.0
+            for connection, forced, seen in tracked:
+                connection.force_debug_cursor = forced
+                for query in list(connection.queries_log)[seen:]:
+                    queries += 1
+                    db += float(query['time'])
+
+        endpoint = record_request(request, response, wall)
+        metrics.REQUEST_QUERIES.labels(endpoint=endpoint).observe(queries)
+        sample = Sample(
+            timestamp=start,
+            endpoint=endpoint,
+            status=response.status_code,
+            queries=queries,
+            wall_ms=wall * 1000,
+            db_ms=db * 1000,
+            serializer_ms=serializer * 1000,
+        )
+        try:
+            SampleRing(settings.QUERY_PROFILER_PATH, settings.QUERY_PROFILER_CAPACITY).append(sample)
+        except (IOError, OSError):
+            logger.warning('could not record query profile sample', exc_info=True)
+        return response
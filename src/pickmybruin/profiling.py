@@ -0,0 +1,135 @@
+"""
+Request samples recorded by QueryProfilerMiddleware, kept in a fixed-size
+ring buffer file shared by every worker process on the host.
+"""
+import fcntl
+import math
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from rest_framework.serializers import BaseSerializer
+
+Sample = namedtuple('Sample', ['timestamp', 'endpoint', 'status', 'queries', 'wall_ms', 'db_ms', 'serializer_ms'])
+
+HEADER = struct.Struct('<4sIQ')    # magic, capacity, samples written
+RECORD = struct.Struct('<d80sHIfff')
+MAGIC = b'QPRF'
+
+
+class SampleRing(object):
+    """
+    Appends overwrite the oldest sample once `capacity` is reached. Writers
+    take an exclusive flock, so concurrent workers never interleave records
+    """
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return os.fdopen(fd, 'r+b')
+
+    def _read_header(self, f):
+        """Samples written, or None for a new file or another capacity's"""
+        f.seek(0)
+        header = f.read(HEADER.size)
+        if len(header) == HEADER.size:
+            magic, capacity, written = HEADER.unpack(header)
+            if magic == MAGIC and capacity == self.capacity:
+                return written
+        return None
+
+    def _header(self, f):
+        # rewrites the file, so only under the exclusive lock
+        written = self._read_header(f)
+        if written is not None:
+            return written
+        f.seek(0)
+        f.truncate()
+        f.write(HEADER.pack(MAGIC, self.capacity, 0))
+        f.write(b'\0' * RECORD.size * self.capacity)
+        return 0
+
+    def append(self, sample):
+        endpoint = sample.endpoint.encode('utf-8')[:80]
+        record = RECORD.pack(
+            sample.timestamp, endpoint, sample.status, sample.queries,
+            sample.wall_ms, sample.db_ms, sample.serializer_ms,
+        )
+        with self._open() as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            written = self._header(f)
+            f.seek(HEADER.size + (written % self.capacity) * RECORD.size)
+            f.write(record)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, self.capacity, written + 1))
+
+    def samples(self):
+        if not os.path.exists(self.path):
+            return []
+        with self._open() as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            # readers never rewrite the file; the next append starts it over
+            written = self._read_header(f) or 0
+            count = min(written, self.capacity)
+            f.seek(HEADER.size)
+            data = f.read(RECORD.size * count)
+
+        samples = []
+        for offset in range(0, len(data), RECORD.size):
+            timestamp, endpoint, status, queries, wall, db, serializer = RECORD.unpack_from(data, offset)
+            samples.append(Sample(
+                timestamp, endpoint.rstrip(b'\0').decode('utf-8', 'replace'),
+                status, queries, wall, db, serializer,
+            ))
+        return samples
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Time spent producing serializer output on this thread, while a request is
+# being profiled. Only the outermost .data is timed, so nested serializers
+# aren't counted twice
+_serializer_timing = threading.local()
+
+def start_serializer_timing():
+    _serializer_timing.total = 0.0
+    _serializer_timing.depth = 0
+
+def stop_serializer_timing():
+    total = getattr(_serializer_timing, 'total', None)
+    _serializer_timing.total = None
+    return total or 0.0
+
+def _timed_data(data):
+    def wrapper(self):
+        if getattr(_serializer_timing, 'total', None) is None:
+            return data.fget(self)
+        _serializer_timing.depth += 1
+        start = time.time()
+        try:
+            return data.fget(self)
+        finally:
+            _serializer_timing.depth -= 1
+            if _serializer_timing.depth == 0:
+                _serializer_timing.total += time.time() - start
+    wrapper._profiled = True
+    return property(wrapper)
+
+def install_serializer_timing():
+    # Serializer.data and ListSerializer.data both go through BaseSerializer.data
+    if not getattr(BaseSerializer.data.fget, '_profiled', False):
+        BaseSerializer.data = _timed_data(BaseSerializer.data)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
@@ -0,0 +1,67 @@
+"""
+Sends the reads of some safe requests to a read-only replica of `default`
+(settings.DATABASE_REPLICAS), so heavy list and search queries don't compete
+with writes. Everything else, including every write, uses `default`.
+
+A view opts in with ReplicaReadsMixin. Its request is authenticated against
+`default` first, then reads from one replica. A client that wrote in the
+last REPLICA_STICKY_SECONDS carries the REPLICA_STICKY_COOKIE set by
+ReplicaStickinessMiddleware and keeps reading from `default`, so it sees its
+own writes despite replication lag.
+"""
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+_state = threading.local()
+
+
+def use_replica():
+    """Routes this thread's reads to a replica until use_primary()"""
+    _state.replica = random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None
+
+
+def use_primary():
+    _state.replica = None
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        # a request that writes reads its own writes from then on; and
+        # instances loaded from a replica are saved to `default`
+        use_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS} | set(settings.DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema by replication
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaReadsMixin(object):
+    """For API views: safe requests read from a replica once authenticated"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and settings.REPLICA_STICKY_COOKIE not in request.COOKIES:
+            use_replica()
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            use_primary()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 import logging
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 from .keys import *
 
@@ -44,10 +45,12 @@ INSTALLED_APPS = (
     'storages',
 
     # Pick My Bruin Apps
+    'pickmybruin',
     'users',
     'email_requests',
     'messaging',
     'blog',
+    'outbox',
 )
 
 AUTHENTICATION_BACKENDS = (
@@ -56,8 +59,10 @@ AUTHENTICATION_BACKENDS = (
 )
 
 MIDDLEWARE = (
+    'pickmybruin.middleware.ConnectionHealthMiddleware',
+    'pickmybruin.middleware.QueryProfilerMiddleware',
+    'pickmybruin.middleware.ReplicaStickinessMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
-    'oauth2_provider.middleware.OAuth2TokenMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -74,17 +79,59 @@ WSGI_APPLICATION = 'pickmybruin.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
+# Minimum word_similarity() between a query word and a mentor search document.
+# Mentor search sets it as pg_trgm.word_similarity_threshold for its own
+# transaction, for the `%>` operator it uses so its trigram indexes apply.
+# Stricter than the similarity() >= 0.1 it replaced, on purpose: at 0.1
+# word_similarity(), which ignores the rest of the document, matches nearly
+# every mentor for short words
+MENTOR_SEARCH_WORD_SIMILARITY = 0.3
+
+# Seconds a process keeps its database connection for later requests; 0
+# opens one per request. A kept connection idle for DATABASE_HEALTH_CHECK_IDLE
+# seconds is checked before the next request uses it (see
+# ConnectionHealthMiddleware)
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+DATABASE_HEALTH_CHECK_IDLE = float(os.environ.get('DATABASE_HEALTH_CHECK_IDLE', 10))
+
+# Set DATABASE_PGBOUNCER=1 when DATABASE_HOST is pgbouncer in transaction
+# pooling mode, where consecutive transactions may run on different server
+# connections: nothing may rely on session state, so no server-side cursors
+DATABASE_PGBOUNCER = os.environ.get('DATABASE_PGBOUNCER') == '1'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
         'NAME': 'postgres',                      # Or path to database file if using sqlite3.
         # The following settings are not used with sqlite3:
         'USER': 'postgres',
-        'HOST': 'db',                      # Empty for localhost through domain sockets or '127.0.0.1' for localhost through TCP.
-        'PORT': '5432',                      # Set to empty string for default.
+        'HOST': os.environ.get('DATABASE_HOST', 'db'),    # Empty for localhost through domain sockets or '127.0.0.1' for localhost through TCP.
+        'PORT': os.environ.get('DATABASE_PORT', '5432'),  # Set to empty string for default.
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'DISABLE_SERVER_SIDE_CURSORS': DATABASE_PGBOUNCER,
     },
 }
 
+# Read-only replicas of `default`, as DATABASE_REPLICA_HOSTS=host:port,...
+# Views with ReplicaReadsMixin read from one of them on safe requests, except
+# for clients that wrote in the last REPLICA_STICKY_SECONDS, which keep
+# reading their own writes from `default` (see pickmybruin.routers)
+DATABASE_REPLICAS = []
+for address in filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',')):
+    host, _, port = address.partition(':')
+    alias = 'replica_{}'.format(len(DATABASE_REPLICAS))
+    DATABASES[alias] = dict(
+        DATABASES['default'],
+        HOST=host,
+        PORT=port or DATABASES['default']['PORT'],
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['pickmybruin.routers.ReplicaRouter']
+REPLICA_STICKY_COOKIE = 'read_primary'
+REPLICA_STICKY_SECONDS = 10
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -148,7 +195,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated'
     ],
+    # bearer tokens first, as clients should send them; Basic still works
+    # for clients that haven't moved to tokens yet
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'pickmybruin.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
         'pickmybruin.middleware.CsrfExemptSessionAuthentication',
     ),
@@ -160,6 +210,12 @@ OAUTH2_PROVIDER = {
     'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'},
 }
 
+# Bearer tokens seen recently are kept per process, up to TOKEN_CACHE_SIZE
+# of them. A token revoked, or a user changed, in another process keeps
+# working in this one for up to TOKEN_CACHE_TTL seconds
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 30
+
 # TODO(mark): change this in prod
 CORS_ORIGIN_ALLOW_ALL = True
 
@@ -177,6 +233,9 @@ else:
         filename = '/logs/django.log',
         filemode = 'a'
     )
+    # requests sampled by QueryProfilerMiddleware use the debug cursor; keep
+    # their SQL out of the log
+    logging.getLogger('django.db.backends').setLevel(logging.INFO)
 
 SHELL_PLUS_PRE_IMPORTS = [
     ('pprint', 'pprint'),
@@ -188,6 +247,61 @@ logging.getLogger('botocore').setLevel(logging.WARN)
 logging.getLogger('nose').setLevel(logging.WARN)
 logging.getLogger('s3transfer').setLevel(logging.WARN)
 
+# With QUERY_PROFILER_ENABLED=1, the share of requests whose query count and
+# timings QueryProfilerMiddleware records, into a ring buffer of the last
+# QUERY_PROFILER_CAPACITY samples read by the query_report command. Enabling
+# it also times every DRF serializer's .data in that process
+QUERY_PROFILER_ENABLED = os.environ.get('QUERY_PROFILER_ENABLED') == '1'
+QUERY_PROFILER_SAMPLE_RATE = 0.01
+QUERY_PROFILER_PATH = os.path.join(tempfile.gettempdir(), 'pickmybruin-query-profile')
+QUERY_PROFILER_CAPACITY = 20000
+
+# Shared by every worker, so a version bump there reaches all of them. The
+# table is created by `manage.py createcachetable`
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'pickmybruin_cache',
+    }
+}
+
+# How often a worker checks whether its cached Major/Minor/Course catalog is
+# still current, in seconds
+CATALOG_CHECK_INTERVAL = 2
+
+# Each process keeps its metrics in a file here, and /metrics sums them.
+# Clear it when the server starts. /metrics requires METRICS_TOKEN as a
+# bearer token, and is forbidden while it isn't set unless METRICS_PUBLIC=1
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pickmybruin-metrics'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC') == '1'
+
+# Messaging events are NOTIFYed on this channel when their transaction
+# commits; the relay_messaging_events command forwards them to clients.
+# Its LISTEN needs a session of its own, so behind pgbouncer point
+# MESSAGING_EVENTS_DATABASE_HOST/PORT at Postgres itself
+MESSAGING_EVENTS_CHANNEL = 'messaging_events'
+MESSAGING_EVENTS_DATABASE_HOST = os.environ.get('MESSAGING_EVENTS_DATABASE_HOST', DATABASES['default']['HOST'])
+MESSAGING_EVENTS_DATABASE_PORT = os.environ.get('MESSAGING_EVENTS_DATABASE_PORT', DATABASES['default']['PORT'])
+
+# The relay posts events to the websockets service from a background thread;
+# timeout is (connect, read) seconds, and notifications for the same profile
+# within the coalesce window are sent once, with the latest event
+WEBSOCKETS_NOTIFY_URL = 'http://websockets/broadcast/%d'
+WEBSOCKETS_NOTIFY_TIMEOUT = (0.5, 1)
+WEBSOCKETS_NOTIFY_QUEUE_SIZE = 1000
+WEBSOCKETS_NOTIFY_COALESCE_WINDOW = 0.25
+
+# Outbound email is queued by request handlers and delivered by the
+# send_queued_email command. Failed sends are retried after
+# OUTBOX_RETRY_DELAY seconds, doubling each time, up to OUTBOX_MAX_ATTEMPTS.
+# An email a worker claimed but never recorded a result for, because it
+# died mid-send, is sent again after OUTBOX_CLAIM_TIMEOUT seconds
+OUTBOX_TRANSPORT = 'outbox.transports.SendGridTransport'
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_CLAIM_TIMEOUT = 300
+
 REQUEST_TEMPLATE = '682f1eee-9441-4baf-aa1b-780281f25694'
 USER_VERIFICATION_TEMPLATE = 'ddd14008-25ee-46c6-9a55-b6b4d577a54b'
 MESSAGING_TEMPLATE = 'ea29ebe3-df27-4383-9234-0d01539980e3'
@@ -0,0 +1,389 @@
+import base64
+import glob
+import json
+import os
+import tempfile
+from datetime import timedelta
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from oauth2_provider.models import AccessToken, Application
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from messaging.factories import MessageFactory, ThreadFactory
+from messaging.models import Thread
+from users import factories as users_factories
+from users.models import Mentor
+from . import gunicorn_config
+from .authentication import TokenCache, token_cache
+from .metrics import Counter, Histogram, Registry, ValueFile
+from .profiling import Sample, SampleRing, percentile
+
+PROFILE_PATH = os.path.join(tempfile.gettempdir(), 'pickmybruin-query-profile-test')
+
+
+class SampleRingTest(TestCase):
+
+    def setUp(self):
+        self.ring = SampleRing(PROFILE_PATH, 3)
+        self.ring.clear()
+
+    def tearDown(self):
+        self.ring.clear()
+
+    def test_overwrites_oldest(self):
+        for i in range(5):
+            self.ring.append(Sample(i, 'endpoint', 200, i, 1.0, 0.5, 0.25))
+
+        samples = self.ring.samples()
+        self.assertEqual(sorted(sample.queries for sample in samples), [2, 3, 4])
+        self.assertEqual(samples[0].endpoint, 'endpoint')
+
+    def test_reader_leaves_file(self):
+        self.ring.append(Sample(0, 'endpoint', 200, 1, 1.0, 0.5, 0.25))
+        # a reader configured with another capacity sees nothing and keeps
+        # the samples for the writers
+        self.assertEqual(SampleRing(PROFILE_PATH, 5).samples(), [])
+        self.assertEqual(len(self.ring.samples()), 1)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+
+@override_settings(QUERY_PROFILER_ENABLED=True, QUERY_PROFILER_PATH=PROFILE_PATH, QUERY_PROFILER_SAMPLE_RATE=1)
+class QueryProfilerMiddlewareTest(APITestCase):
+
+    def setUp(self):
+        self.ring = SampleRing(PROFILE_PATH, 20000)
+        self.ring.clear()
+        self.me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=self.me.user)
+        thread = ThreadFactory(profile_1=self.me)
+        MessageFactory(thread=thread, sender=thread.profile_2)
+
+    def tearDown(self):
+        self.ring.clear()
+        self.me.user.delete()
+
+    def test_records_request(self):
+        self.client.get(reverse('messaging:thread_list'))
+
+        sample, = self.ring.samples()
+        self.assertEqual(sample.endpoint, 'messaging:thread_list')
+        self.assertEqual(sample.status, 200)
+        self.assertEqual(sample.queries, 3)
+        self.assertGreater(sample.serializer_ms, 0)
+        self.assertGreaterEqual(sample.wall_ms, sample.db_ms)
+
+    def test_report(self):
+        for i in range(3):
+            self.client.get(reverse('messaging:thread_list'))
+
+        out = StringIO()
+        call_command('query_report', stdout=out)
+
+        self.assertIn('messaging:thread_list', out.getvalue())
+        self.assertIn('3 samples', out.getvalue())
+
+    @override_settings(QUERY_PROFILER_SAMPLE_RATE=0)
+    def test_unsampled(self):
+        self.client.get(reverse('messaging:thread_list'))
+        self.assertEqual(self.ring.samples(), [])
+
+    @override_settings(QUERY_PROFILER_ENABLED=False)
+    def test_disabled(self):
+        self.client.get(reverse('messaging:thread_list'))
+        self.assertEqual(self.ring.samples(), [])
+
+
+METRICS_DIR = os.path.join(tempfile.gettempdir(), 'pickmybruin-metrics-test')
+
+
+@override_settings(METRICS_DIR=METRICS_DIR)
+class MetricsTest(APITestCase):
+
+    def setUp(self):
+        self.clear()
+        self.registry = Registry()
+        self.counter = Counter('test_events_total', 'Test events', ['kind'], registry=self.registry)
+        self.histogram = Histogram('test_seconds', 'Test latency', buckets=(0.1, 1, float('inf')), registry=self.registry)
+
+    def tearDown(self):
+        self.clear()
+
+    def clear(self):
+        for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*.db')):
+            os.remove(path)
+
+    def test_exposition(self):
+        self.counter.labels(kind='a').inc()
+        self.counter.labels(kind='a').inc(2)
+        self.counter.labels(kind='b').inc()
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+
+        text = self.registry.expose()
+        self.assertIn('# TYPE test_events_total counter', text)
+        self.assertIn('test_events_total{kind="a"} 3.0', text)
+        self.assertIn('test_events_total{kind="b"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2.0', text)
+        self.assertIn('test_seconds_count 2.0', text)
+
+    def test_sums_processes(self):
+        self.counter.labels(kind='a').inc()
+
+        # another worker's file
+        other = ValueFile(os.path.join(METRICS_DIR, 'metrics_0.db'))
+        other.inc(json.dumps(['test_events_total', {'kind': 'a'}], sort_keys=True), 4)
+
+        self.assertIn('test_events_total{kind="a"} 5.0', self.registry.expose())
+
+    def test_clear(self):
+        self.counter.labels(kind='a').inc()
+        self.registry.clear()
+        self.assertNotIn('test_events_total{kind="a"}', self.registry.expose())
+
+        # this process starts a new file
+        self.counter.labels(kind='a').inc()
+        self.assertIn('test_events_total{kind="a"} 1.0', self.registry.expose())
+
+    def test_merge_exited_worker(self):
+        self.counter.labels(kind='a').inc()
+        self.histogram.observe(0.5)
+        key = json.dumps(['test_events_total', {'kind': 'a'}], sort_keys=True)
+        for pid in (1, 2):
+            other = ValueFile(os.path.join(METRICS_DIR, 'metrics_{}.db'.format(pid)))
+            other.inc(key, 4)
+            other.close()
+        before = self.registry.expose()
+        self.assertIn('test_events_total{kind="a"} 9.0', before)
+
+        # gunicorn's master, as each worker exits
+        for pid in (1, 2):
+            gunicorn_config.child_exit(None, SimpleNamespace(pid=pid))
+            self.assertEqual(self.registry.expose(), before)
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*.db'))),
+            ['metrics_{}.db'.format(os.getpid()), 'metrics_aggregate.db'],
+        )
+
+    def test_file_grows(self):
+        for i in range(5000):
+            self.counter.labels(kind='kind-{}'.format(i)).inc()
+
+        # reopening finds every entry again
+        values = ValueFile(os.path.join(METRICS_DIR, 'metrics_{}.db'.format(os.getpid())))
+        self.assertEqual(len(values.offsets), 5000)
+        self.assertIn('test_events_total{kind="kind-4999"} 1.0', self.registry.expose())
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint(self):
+        me = users_factories.ProfileFactory()
+        self.client.force_authenticate(user=me.user)
+        self.client.get(reverse('users:mentors_search') + '?query=cs')
+        me.user.delete()
+
+        resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, 200)
+        text = resp.content.decode('utf-8')
+        self.assertIn('# TYPE sendgrid_request_duration_seconds histogram', text)
+        self.assertIn('search_query_duration_seconds_count{view="mentors"} 1.0', text)
+        self.assertIn('http_request_duration_seconds_count{endpoint="users:mentors_search",method="GET",status="200"} 1.0', text)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        resp = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_endpoint_closed_without_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with self.settings(METRICS_PUBLIC=True):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+
+class TokenAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.profile = users_factories.ProfileFactory()
+        application = Application.objects.create(
+            client_type=Application.CLIENT_PUBLIC,
+            authorization_grant_type=Application.GRANT_PASSWORD,
+        )
+        self.token = AccessToken.objects.create(
+            user=self.profile.user,
+            application=application,
+            token='token',
+            expires=timezone.now() + timedelta(hours=1),
+            scope='read write',
+        )
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer token')
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_cached(self):
+        with CaptureQueriesContext(connection) as first:
+            resp = self.client.get(reverse('users:me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['id'], self.profile.id)
+
+        with CaptureQueriesContext(connection) as second:
+            resp = self.client.get(reverse('users:me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(second), len(first) - 1)
+
+    def test_own_profile(self):
+        self.client.get(reverse('users:me'))
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('users:me'))
+        self.assertEqual(resp.data['id'], self.profile.id)
+
+        # becoming a mentor evicts the cached mentor id
+        self.assertEqual(self.client.get(reverse('users:mentors_me')).status_code, 404)
+        resp = self.client.post(reverse('users:mentors_me'))
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(reverse('users:mentors_me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['profile']['id'], self.profile.id)
+
+    def test_revoked(self):
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 200)
+        self.token.revoke()
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 401)
+
+    def test_basic_fallback(self):
+        self.profile.user.set_password('password')
+        self.profile.user.save()
+        credentials = base64.b64encode('{}:password'.format(self.profile.user.username).encode()).decode()
+        self.client.credentials(HTTP_AUTHORIZATION='Basic ' + credentials)
+        resp = self.client.get(reverse('users:me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['id'], self.profile.id)
+
+    def test_expired(self):
+        self.token.expires = timezone.now() - timedelta(seconds=1)
+        self.token.save()
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 401)
+
+    def test_inactive_user(self):
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 200)
+        user = self.profile.user
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 401)
+
+    def test_lru(self):
+        cache = TokenCache(2, 60)
+        users = [users_factories.ProfileFactory().user for i in range(3)]
+        expires = timezone.now() + timedelta(hours=1)
+        cache.set('a', users[0], expires)
+        cache.set('b', users[1], expires)
+        cache.get('a')
+        cache.set('c', users[2], expires)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), users[0])
+        self.assertEqual(len(cache), 2)
+
+
+class ConnectionHealthTest(APITransactionTestCase):
+
+    def test_dropped_connection(self):
+        self.client.force_authenticate(user=users_factories.ProfileFactory().user)
+        self.assertEqual(self.client.get(reverse('users:me')).status_code, 200)
+
+        # as if the server closed it while idle
+        connection.connection.close()
+        with override_settings(DATABASE_HEALTH_CHECK_IDLE=0):
+            resp = self.client.get(reverse('users:me'))
+        self.assertEqual(resp.status_code, 200)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(APITransactionTestCase):
+
+    def setUp(self):
+        # a second connection to the test database stands in for a replica
+        connections.databases['replica'] = dict(connections.databases['default'])
+        self.replica = connections['replica']
+        self.client.force_authenticate(user=users_factories.ProfileFactory().user)
+        users_factories.MentorFactory()
+
+    def tearDown(self):
+        self.replica.close()
+        del connections['replica']
+        del connections.databases['replica']
+
+    def search(self):
+        with CaptureQueriesContext(self.replica) as replica, CaptureQueriesContext(connection) as default:
+            resp = self.client.get(reverse('users:mentors_search'), {'query': 'cs'})
+        self.assertEqual(resp.status_code, 200)
+        return replica, default
+
+    def test_search_reads_replica(self):
+        replica, default = self.search()
+        self.assertTrue([query for query in replica if 'users_mentor' in query['sql']])
+        self.assertFalse([query for query in default if 'users_mentor' in query['sql']])
+
+    def test_reads_own_writes(self):
+        resp = self.client.post(reverse('users:mentors_me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(settings.REPLICA_STICKY_COOKIE, resp.cookies)
+
+        replica, default = self.search()
+        self.assertEqual(len(replica), 0)
+        self.assertTrue([query for query in default if 'users_mentor' in query['sql']])
+
+    def test_writes_use_default(self):
+        self.assertEqual(self.client.get(reverse('messaging:thread_list')).status_code, 200)
+        with CaptureQueriesContext(self.replica) as replica:
+            resp = self.client.post(reverse('users:mentors_me'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(replica), 0)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_benchmark(self):
+        output = os.path.join(tempfile.gettempdir(), 'pickmybruin-benchmark-test.json')
+        call_command(
+            'benchmark', '--in-place',
+            '--profiles', '40', '--mentors', '10', '--threads', '60', '--messages', '300',
+            '--posts', '20', '--comments', '60', '--iterations', '3', '--warmup', '1',
+            '--batch-size', '25', '--label', 'test', '--output', output,
+            stdout=StringIO(), stderr=StringIO(),
+        )
+        with open(output) as f:
+            results = json.load(f)
+        os.remove(output)
+
+        self.assertEqual(results['label'], 'test')
+        self.assertEqual(results['dataset']['messages'], 300)
+        self.assertEqual(results['connections'], 'persistent')
+        self.assertEqual(list(results['scenarios']), [
+            'mentor_search', 'inbox', 'thread_history', 'check_history', 'blog_search', 'comment_tree',
+        ])
+        for name, scenario in results['scenarios'].items():
+            self.assertEqual(scenario['requests'], 3, name)
+            self.assertEqual(scenario['errors'], 0, name)
+            self.assertLessEqual(scenario['p50_ms'], scenario['p95_ms'], name)
+
+        # seeded through bulk_create, so the derived data is rebuilt
+        self.assertEqual(Mentor.objects.filter(search_document__isnull=True).count(), 0)
+        self.assertEqual(Thread.objects.filter(last_message__isnull=True).count(),
+                         Thread.objects.exclude(message__isnull=False).count())
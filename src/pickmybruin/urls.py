@@ -1,6 +1,8 @@
 from django.conf.urls import include, url
+from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from rest_framework import routers
 from users import views as users_views
+from pickmybruin import views as pickmybruin_views
 
 from django.contrib import admin
 admin.autodiscover()
@@ -12,6 +14,7 @@ router = routers.DefaultRouter()
 router.registry.extend(users_router.registry)
 
 urlpatterns = [
+    url(r'^metrics$', pickmybruin_views.metrics, name='metrics'),
     url(r'^drf/', include(router.urls)),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
@@ -21,3 +24,6 @@ urlpatterns = [
     url(r'^messaging/', include('messaging.urls', namespace='messaging')),
     url(r'', include('blog.urls', namespace='blog')),
 ]
+
+# what runserver used to serve; only with DEBUG
+urlpatterns += staticfiles_urlpatterns()
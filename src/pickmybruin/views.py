@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from .metrics import REGISTRY
+
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metrics(request):
+    """Prometheus text exposition of every worker's metrics"""
+    token = settings.METRICS_TOKEN
+    if token:
+        if not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+            return HttpResponseForbidden()
+    elif not settings.METRICS_PUBLIC:
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.expose(), content_type=EXPOSITION_CONTENT_TYPE)
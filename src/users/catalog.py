@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import transaction
+from django.utils.http import quote_etag
+
+
+def new_version():
+    # never one a process could have loaded before, even if the cache entry
+    # was evicted. The database cache can't incr() atomically, so two
+    # concurrent bumps could otherwise write the same value
+    return uuid.uuid4().hex[:12]
+
+
+class Catalog(object):
+    """
+    Every entry of Major, Minor or Course, held in this process: name -> id,
+    id -> name, and the list endpoints' output. Loaded on first use.
+
+    Changes replace a version in the shared cache after they commit.
+    A process compares it with the version it loaded on its first read in
+    each request, and outside requests every CATALOG_CHECK_INTERVAL
+    seconds; that one cache read is all a current catalog costs.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.version_key = 'catalog:{}:version'.format(model._meta.label_lower)
+        self._lock = threading.Lock()
+        self._state = None
+        self._checked_at = None
+
+    def _shared_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, new_version(), timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def _load(self, version):
+        rows = list(self.model.objects.order_by('name').values_list('id', 'name'))
+        return {
+            'version': version,
+            'ids': {name: id for id, name in rows},
+            'names': dict(rows),
+            'entries': [OrderedDict([('id', id), ('name', name)]) for id, name in rows],
+            'etag': quote_etag('{}-{}'.format(self.model._meta.model_name, version)),
+        }
+
+    def state(self):
+        with self._lock:
+            now = time.monotonic()
+            if (self._state is None or self._checked_at is None
+                    or now - self._checked_at >= settings.CATALOG_CHECK_INTERVAL):
+                version = self._shared_version()
+                self._checked_at = now
+                if self._state is None or self._state['version'] != version:
+                    self._state = self._load(version)
+            return self._state
+
+    @property
+    def ids(self):
+        return self.state()['ids']
+
+    @property
+    def names(self):
+        return self.state()['names']
+
+    @property
+    def entries(self):
+        return self.state()['entries']
+
+    @property
+    def etag(self):
+        return self.state()['etag']
+
+    def invalidate(self):
+        """Call after changing the table; takes effect once the change commits"""
+        transaction.on_commit(self._bump)
+
+    def _bump(self):
+        cache.set(self.version_key, new_version(), timeout=None)
+        with self._lock:
+            self._state = None
+
+    def recheck(self):
+        self._checked_at = None
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(model):
+    with _catalogs_lock:
+        if model not in _catalogs:
+            _catalogs[model] = Catalog(model)
+        return _catalogs[model]
+
+
+def request_started_handler(sender, **kwargs):
+    for catalog in list(_catalogs.values()):
+        catalog.recheck()
+request_started.connect(request_started_handler)
+
+def catalog_entry_changed(sender, raw=False, **kwargs):
+    if raw:
+        return
+    get_catalog(sender).invalidate()
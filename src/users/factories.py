@@ -20,15 +20,18 @@ class ProfileFactory(factory.django.DjangoModelFactory):
 class MajorFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = models.Major
+        django_get_or_create = ('name',)
 
 class MinorFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = models.Minor
+        django_get_or_create = ('name',)
 
 
 class CourseFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = models.Course
+        django_get_or_create = ('name',)
 
 class MentorFactory(factory.django.DjangoModelFactory):
     class Meta:
@@ -0,0 +1,42 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from users.models import Mentor
+
+
+class Command(BaseCommand):
+    help = 'Recompute Mentor.completion_score for every mentor'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def _backfill(self, batch_size):
+        mentors = Mentor.objects.select_related(
+            'profile__user',
+        ).prefetch_related(
+            'major', 'minor', 'courses',
+        ).order_by('id')
+
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(mentors.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            # one UPDATE per distinct score instead of one per mentor
+            ids_by_score = defaultdict(list)
+            for mentor in batch:
+                score = mentor.calculate_completion_score()
+                if score != mentor.completion_score:
+                    ids_by_score[score].append(mentor.id)
+            for score, ids in ids_by_score.items():
+                updated += Mentor.objects.filter(id__in=ids).update(completion_score=score)
+
+            last_id = batch[-1].id
+
+        return updated
+
+    def handle(self, *args, **kwargs):
+        updated = self._backfill(kwargs['batch_size'])
+        self.stdout.write('Updated {} completion scores'.format(updated))
@@ -1,52 +1,87 @@
-from django.core.management.base import BaseCommand
-from users.models import Major, Minor, Course
-from django.db import IntegrityError
-from os import path
 import json
+from itertools import islice
+from os import path
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from users.catalog import get_catalog
+from users.models import INSERT_CATALOG_NAMES_SQL, Major, Minor, Course
+
+CATALOGS = (
+    (Major, 'majors.json'),
+    (Minor, 'minors.json'),
+    (Course, 'courses.json'),
+)
+
+
+def iter_json_array(f, chunk_size=64 * 1024):
+    """Yields the items of the JSON array in `f` without loading the whole file"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    while True:
+        chunk = f.read(chunk_size)
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not started:
+                if not buffer:
+                    break
+                if buffer[0] != '[':
+                    raise ValueError('Expected a JSON array')
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer[:1] == ',':
+                buffer = buffer[1:]
+                continue
+            if buffer[:1] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # an item cut off by the end of the chunk
+                break
+            if end == len(buffer) and chunk:
+                # a number might continue in the next chunk
+                break
+            yield item
+            buffer = buffer[end:]
+        if not chunk:
+            raise ValueError('Unterminated JSON array')
 
 
 class Command(BaseCommand):
-    def _create_majors(self):
-        base_path = path.dirname(__file__)
-        majors_path = path.abspath(path.join(base_path, "..", "..", "majors.json"))
-
-        with open(majors_path) as majors_file:
-            majors = json.load(majors_file)
-            for major in majors:
-                major_entry = Major(name=major)
-                try:
-                    major_entry.save()
-                except IntegrityError:
-                    pass
-
-    def _create_minors(self):
-        base_path = path.dirname(__file__)
-        minors_path = path.abspath(path.join(base_path, "..", "..", "minors.json"))
-
-        with open(minors_path) as minors_file:
-            minors = json.load(minors_file)
-            for minor in minors:
-                minor_entry = Minor(name=minor)
-                try:
-                    minor_entry.save()
-                except IntegrityError:
-                    pass
-
-    def _create_courses(self):
-        base_path = path.dirname(__file__)
-        courses_path = path.abspath(path.join(base_path, "..", "..", "courses.json"))
+    help = 'Load the Major, Minor and Course names from the JSON files, skipping ones already there'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
 
-        with open(courses_path) as courses_file:
-            courses = json.load(courses_file)
-            for course in courses:
-                course_entry = Course(name=course)
-                try:
-                    course_entry.save()
-                except IntegrityError:
-                    pass
+    def _load(self, model, filename, batch_size):
+        base_path = path.dirname(__file__)
+        catalog_path = path.abspath(path.join(base_path, "..", "..", filename))
+        # names that are already there are skipped, so running it again is a no-op
+        sql = INSERT_CATALOG_NAMES_SQL.format(table=model._meta.db_table)
 
+        inserted = skipped = 0
+        with open(catalog_path) as catalog_file:
+            names = iter_json_array(catalog_file)
+            while True:
+                batch = list(islice(names, batch_size))
+                if not batch:
+                    break
+                # one statement per batch
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [batch])
+                    inserted += cursor.rowcount
+                skipped += len(batch) - cursor.rowcount
+        if inserted:
+            get_catalog(model).invalidate()
+        return inserted, skipped
 
     def handle(self, *args, **kwargs):
-        self._create_majors()
-        self._create_minors()
-        self._create_courses()
\ No newline at end of file
+        for model, filename in CATALOGS:
+            inserted, skipped = self._load(model, filename, kwargs['batch_size'])
+            self.stdout.write('{}: {} inserted, {} skipped'.format(
+                model._meta.verbose_name_plural.capitalize(), inserted, skipped,
+            ))
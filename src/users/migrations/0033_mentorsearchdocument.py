@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 22:42
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+from users.search import BUILD_SEARCH_DOCUMENTS_SQL
+
+
+TRIGRAM_INDEXED_FIELDS = ('name', 'majors', 'bio', 'document')
+
+CREATE_TRIGRAM_INDEXES = [
+    'CREATE INDEX users_mentorsearch_{0}_trgm ON users_mentorsearchdocument USING gin ({0} gin_trgm_ops);'.format(field)
+    for field in TRIGRAM_INDEXED_FIELDS
+]
+
+DROP_TRIGRAM_INDEXES = [
+    'DROP INDEX users_mentorsearch_{0}_trgm;'.format(field)
+    for field in TRIGRAM_INDEXED_FIELDS
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0032_merge_20180604_0018'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MentorSearchDocument',
+            fields=[
+                ('mentor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='users.Mentor')),
+                ('name', models.TextField(blank=True, default='')),
+                ('majors', models.TextField(blank=True, default='')),
+                ('minors', models.TextField(blank=True, default='')),
+                ('courses', models.TextField(blank=True, default='')),
+                ('bio', models.TextField(blank=True, default='')),
+                ('clubs', models.TextField(blank=True, default='')),
+                ('document', models.TextField(blank=True, default='')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mentorsearchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='users_mentorsearch_vector_gin'),
+        ),
+        migrations.RunSQL(CREATE_TRIGRAM_INDEXES, DROP_TRIGRAM_INDEXES),
+        migrations.RunSQL(BUILD_SEARCH_DOCUMENTS_SQL, migrations.RunSQL.noop),
+    ]
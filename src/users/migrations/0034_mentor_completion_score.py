@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-16 22:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# same fields as Mentor.calculate_completion_score()
+BACKFILL_COMPLETION_SCORES = """
+UPDATE users_mentor mentor SET completion_score =
+    (auth_user.first_name <> '')::int +
+    (auth_user.last_name <> '')::int +
+    (auth_user.email <> '')::int +
+    (profile.phone_number <> '')::int +
+    (COALESCE(profile.picture, '') NOT IN ('', 'profile_pictures/default_pic.jpg'))::int +
+    (mentor.bio <> '')::int +
+    (mentor.gpa <> 0)::int +
+    (mentor.clubs <> '')::int +
+    (mentor.pros <> '')::int +
+    (mentor.cons <> '')::int +
+    EXISTS (SELECT 1 FROM users_mentor_major link WHERE link.mentor_id = mentor.id)::int +
+    EXISTS (SELECT 1 FROM users_mentor_minor link WHERE link.mentor_id = mentor.id)::int +
+    EXISTS (SELECT 1 FROM users_mentor_courses link WHERE link.mentor_id = mentor.id)::int
+FROM users_profile profile
+JOIN auth_user ON auth_user.id = profile.user_id
+WHERE profile.id = mentor.profile_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0033_mentorsearchdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mentor',
+            name='completion_score',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunSQL(BACKFILL_COMPLETION_SCORES, migrations.RunSQL.noop),
+    ]
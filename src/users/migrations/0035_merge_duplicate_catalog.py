@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Repeated populate_tables runs left several rows per name. Links move to the
+# lowest id with that name, dropping links a mentor would then have twice,
+# and the other rows go. Names become unique in the next migration
+MERGE_DUPLICATES_SQL = """
+DELETE FROM {links} link
+USING {table} item, {links} other, {table} other_item
+WHERE item.id = link.{column} AND other.mentor_id = link.mentor_id
+    AND other_item.id = other.{column} AND other_item.name = item.name AND other_item.id < item.id;
+
+UPDATE {links} link SET {column} = canonical.id
+FROM {table} item, (SELECT name, min(id) AS id FROM {table} GROUP BY name) canonical
+WHERE item.id = link.{column} AND canonical.name = item.name AND canonical.id <> item.id;
+
+DELETE FROM {table} item
+USING {table} canonical
+WHERE canonical.name = item.name AND canonical.id < item.id;
+"""
+
+CATALOG_TABLES = (
+    ('users_major', 'users_mentor_major', 'major_id'),
+    ('users_minor', 'users_mentor_minor', 'minor_id'),
+    ('users_course', 'users_mentor_courses', 'course_id'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0034_mentor_completion_score'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATES_SQL.format(table=table, links=links, column=column), migrations.RunSQL.noop)
+        for table, links, column in CATALOG_TABLES
+    ]
@@ -2,16 +2,21 @@
 from __future__ import unicode_literals
 import random, string
 
-from django.db import models
+from django.db import models, connection
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 
 from django.contrib.auth.models import User
 
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 
+from . import search  # registers the trigram_word_similar lookup
+from .catalog import catalog_entry_changed, get_catalog
+
 
 # Create your models here.
 class Profile(models.Model):
@@ -33,11 +38,12 @@ class Profile(models.Model):
 
     VERIFICATION_CHAR_NUM = 10
     PASSWORD_RESET_CHAR_NUM = 20
+    DEFAULT_PICTURE = 'profile_pictures/default_pic.jpg'
 
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     verified = models.BooleanField(default=False)
     verification_code = models.CharField(max_length=VERIFICATION_CHAR_NUM, null=True, default=None, blank=True)
-    picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True, default='profile_pictures/default_pic.jpg')
+    picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True, default=DEFAULT_PICTURE)
     year = models.CharField(max_length=15, choices=YEAR_CHOICES, default=INCOMING)
     notifications_enabled = models.BooleanField(default=True)
     phone_regex = RegexValidator(regex=r'^\([0-9]{3}\)[0-9]{3}[-][0-9]{4}$', message='Phone number must be entered in the format: (012)345-6789')
@@ -60,7 +66,7 @@ class Profile(models.Model):
         return self.user.email.split('@')[0]
 
 class Major(models.Model):
-    name = models.CharField(max_length=100, null=False)
+    name = models.CharField(max_length=100, null=False, unique=True)
 
     def __str__(self):
         return self.name
@@ -68,7 +74,7 @@ class Major(models.Model):
          ordering = ('name',)
 
 class Minor(models.Model):
-    name = models.CharField(max_length=100, null=False)
+    name = models.CharField(max_length=100, null=False, unique=True)
  
     def __str__(self):
          return self.name
@@ -76,7 +82,7 @@ class Minor(models.Model):
          ordering = ('name',)
 
 class Course(models.Model):
-    name = models.CharField(max_length=200, null=False)
+    name = models.CharField(max_length=200, null=False, unique=True)
 
     def __str__(self):
         return self.name
@@ -84,6 +90,37 @@ class Course(models.Model):
         ordering = ('name',)
 
 
+# Adds the names that aren't in a catalog table yet, in one statement
+INSERT_CATALOG_NAMES_SQL = 'INSERT INTO {table} (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING'
+
+def catalog_ids(model, names):
+    """
+    {name: id} for `names` in Major, Minor or Course, creating the missing
+    entries. Names already in the cached catalog cost no queries; the rest
+    take two at most, plus one if another request created some of them at
+    the same time
+    """
+    names = set(names)
+    catalog = get_catalog(model)
+    known = catalog.ids
+    ids = {name: known[name] for name in names if name in known}
+    missing = names.difference(ids)
+    if missing:
+        ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+        missing = names.difference(ids)
+    if missing:
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT_CATALOG_NAMES_SQL.format(table=model._meta.db_table) + ' RETURNING name, id', [sorted(missing)])
+            created = cursor.fetchall()
+        if created:
+            catalog.invalidate()
+        ids.update(created)
+        missing = names.difference(ids)
+        if missing:
+            ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+    return ids
+
+
 class Mentor(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
     major = models.ManyToManyField(Major, blank=True)
@@ -95,18 +132,166 @@ class Mentor(models.Model):
     courses = models.ManyToManyField(Course, blank=True)
     pros =  models.CharField(max_length=5000, null=False, blank=True, default='')
     cons =  models.CharField(max_length=5000, null=False, blank=True, default='')
+    # number of optional profile fields filled in, used to rank search results.
+    # Maintained by update_completion_score() from the signal handlers below
+    completion_score = models.PositiveSmallIntegerField(default=0, db_index=True)
     
     class Meta:
     	ordering = ('profile',)
     def __str__(self):
         return '%s (%s)' % (self.profile, self.major)
 
-def minor_changed(sender, **kwargs):
-    if kwargs['instance'].minor.count() > 3:
+    def calculate_completion_score(self):
+        profile = self.profile
+        user = profile.user
+        filled = [
+            user.first_name,
+            user.last_name,
+            user.email,
+            profile.phone_number,
+            profile.picture and profile.picture.name != Profile.DEFAULT_PICTURE,
+            self.bio,
+            self.gpa,
+            self.clubs,
+            self.pros,
+            self.cons,
+            # .all() rather than .exists() so prefetched relations are reused
+            self.major.all(),
+            self.minor.all(),
+            self.courses.all(),
+        ]
+        return sum(1 for value in filled if value)
+
+    def update_completion_score(self):
+        # update() rather than save() so the post_save handlers don't re-run
+        self.completion_score = self.calculate_completion_score()
+        Mentor.objects.filter(id=self.id).update(completion_score=self.completion_score)
+
+# pk_set on pre_add holds only the ids not linked yet; adding is the only
+# change that can pass a limit
+def minor_changed(sender, action, instance, reverse, pk_set, **kwargs):
+    if action == 'pre_add' and not reverse and instance.minor.count() + len(pk_set) > 3:
         raise ValidationError("You can't assign more than three minors", code='invalid')
 m2m_changed.connect(minor_changed, sender=Mentor.minor.through)
 
-def major_changed(sender, **kwargs):
-    if kwargs['instance'].major.count() > 2:
+def major_changed(sender, action, instance, reverse, pk_set, **kwargs):
+    if action == 'pre_add' and not reverse and instance.major.count() + len(pk_set) > 2:
         raise ValidationError("You can't assign more than two majors", code='invalid')
 m2m_changed.connect(major_changed, sender=Mentor.major.through)
+
+
+class MentorSearchDocument(models.Model):
+    """
+    Denormalized copy of everything MentorsSearchView matches against, one row
+    per mentor, so a search is a single indexed scan instead of trigram
+    comparisons across joins. Kept current by refresh_mentors() below.
+    """
+    mentor = models.OneToOneField(Mentor, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    name = models.TextField(blank=True, default='')
+    majors = models.TextField(blank=True, default='')
+    minors = models.TextField(blank=True, default='')
+    courses = models.TextField(blank=True, default='')
+    bio = models.TextField(blank=True, default='')
+    clubs = models.TextField(blank=True, default='')
+    # all of the above, used when the search isn't restricted to specific fields
+    document = models.TextField(blank=True, default='')
+    search_vector = SearchVectorField(null=True)
+
+    DOCUMENT_FIELDS = ('name', 'majors', 'minors', 'courses', 'bio', 'clubs')
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='users_mentorsearch_vector_gin'),
+        ]
+
+    def __str__(self):
+        return str(self.mentor)
+
+    @classmethod
+    def refresh(cls, mentor):
+        user = mentor.profile.user
+        fields = {
+            'name': '%s %s' % (user.first_name, user.last_name),
+            'majors': ' '.join(major.name for major in mentor.major.all()),
+            'minors': ' '.join(minor.name for minor in mentor.minor.all()),
+            'courses': ' '.join(course.name for course in mentor.courses.all()),
+            'bio': mentor.bio,
+            'clubs': mentor.clubs,
+        }
+        fields['document'] = ' '.join(fields[field] for field in cls.DOCUMENT_FIELDS)
+        cls.objects.update_or_create(mentor=mentor, defaults=fields)
+
+        # the tsvector is built from the stored columns, so it needs its own UPDATE
+        cls.objects.filter(mentor=mentor).update(
+            search_vector=(
+                SearchVector('name', weight='A', config='simple') +
+                SearchVector('majors', 'minors', 'courses', weight='B', config='simple') +
+                SearchVector('bio', 'clubs', weight='C', config='simple')
+            ),
+        )
+
+
+def refresh_mentors(mentors):
+    # recompute everything derived from a mentor's profile, loading the
+    # profile and links once for both
+    ids = [mentor.id for mentor in mentors]
+    if not ids:
+        return
+    mentors = Mentor.objects.filter(id__in=ids).select_related(
+        'profile__user',
+    ).prefetch_related(
+        'major', 'minor', 'courses',
+    )
+    for mentor in mentors:
+        MentorSearchDocument.refresh(mentor)
+        mentor.update_completion_score()
+
+def mentor_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh_mentors([instance])
+post_save.connect(mentor_saved, sender=Mentor)
+
+def profile_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh_mentors(Mentor.objects.filter(profile=instance))
+post_save.connect(profile_saved, sender=Profile)
+
+def user_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh_mentors(Mentor.objects.filter(profile__user=instance))
+post_save.connect(user_saved, sender=User)
+
+def catalog_entry_saved(sender, instance, created=False, raw=False, **kwargs):
+    # renaming a major/minor/course changes the document of every mentor linked to it
+    if raw or created:
+        return
+    refresh_mentors(instance.mentor_set.all())
+post_save.connect(catalog_entry_saved, sender=Major)
+post_save.connect(catalog_entry_saved, sender=Minor)
+post_save.connect(catalog_entry_saved, sender=Course)
+
+for catalog_model in (Major, Minor, Course):
+    post_save.connect(catalog_entry_changed, sender=catalog_model)
+    post_delete.connect(catalog_entry_changed, sender=catalog_model)
+
+def mentor_links_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            refresh_mentors([instance])
+        return
+
+    # reverse side: instance is a Major/Minor/Course and pk_set holds mentor ids.
+    # A reverse clear doesn't report which mentors it unlinked, so remember them first
+    if action == 'pre_clear':
+        instance._linked_mentor_ids = list(instance.mentor_set.values_list('id', flat=True))
+    elif action == 'post_clear':
+        mentor_ids = getattr(instance, '_linked_mentor_ids', [])
+        refresh_mentors(Mentor.objects.filter(id__in=mentor_ids))
+    elif action in ('post_add', 'post_remove'):
+        refresh_mentors(Mentor.objects.filter(id__in=pk_set))
+m2m_changed.connect(mentor_links_changed, sender=Mentor.major.through)
+m2m_changed.connect(mentor_links_changed, sender=Mentor.minor.through)
+m2m_changed.connect(mentor_links_changed, sender=Mentor.courses.through)
@@ -0,0 +1,73 @@
+from django.db import connections
+from django.db.models import CharField, TextField, FloatField
+from django.db.models.expressions import Func, Value
+from django.contrib.postgres.lookups import PostgresSimpleLookup
+
+
+# Fills users_mentorsearchdocument for mentors that don't have a document yet
+BUILD_SEARCH_DOCUMENTS_SQL = """
+INSERT INTO users_mentorsearchdocument (mentor_id, name, majors, minors, courses, bio, clubs, document)
+SELECT
+    mentor.id,
+    auth_user.first_name || ' ' || auth_user.last_name,
+    COALESCE((SELECT string_agg(major.name, ' ') FROM users_mentor_major link
+              JOIN users_major major ON major.id = link.major_id WHERE link.mentor_id = mentor.id), ''),
+    COALESCE((SELECT string_agg(minor.name, ' ') FROM users_mentor_minor link
+              JOIN users_minor minor ON minor.id = link.minor_id WHERE link.mentor_id = mentor.id), ''),
+    COALESCE((SELECT string_agg(course.name, ' ') FROM users_mentor_courses link
+              JOIN users_course course ON course.id = link.course_id WHERE link.mentor_id = mentor.id), ''),
+    mentor.bio,
+    mentor.clubs,
+    ''
+FROM users_mentor mentor
+JOIN users_profile profile ON profile.id = mentor.profile_id
+JOIN auth_user ON auth_user.id = profile.user_id
+WHERE NOT EXISTS (SELECT 1 FROM users_mentorsearchdocument document WHERE document.mentor_id = mentor.id);
+
+UPDATE users_mentorsearchdocument SET
+    document = concat_ws(' ', name, majors, minors, courses, bio, clubs),
+    search_vector =
+        setweight(to_tsvector('simple', name), 'A') ||
+        setweight(to_tsvector('simple', majors || ' ' || minors || ' ' || courses), 'B') ||
+        setweight(to_tsvector('simple', bio || ' ' || clubs), 'C')
+WHERE search_vector IS NULL;
+"""
+
+
+class TrigramWordSimilarity(Func):
+    """
+    word_similarity(string, expression): how well `string` matches the best
+    matching run of words inside `expression`
+    """
+    function = 'WORD_SIMILARITY'
+
+    def __init__(self, string, expression, **extra):
+        if not hasattr(string, 'resolve_expression'):
+            string = Value(string)
+        super().__init__(string, expression, output_field=FloatField(), **extra)
+
+
+class TrigramWordSimilar(PostgresSimpleLookup):
+    """
+    `column %> string`, true when word_similarity(string, column) is above
+    pg_trgm.word_similarity_threshold. Unlike comparing WORD_SIMILARITY() to a
+    constant, this operator can use a gin_trgm_ops index on the column.
+    """
+    lookup_name = 'trigram_word_similar'
+    operator = '%%>'
+
+
+CharField.register_lookup(TrigramWordSimilar)
+TextField.register_lookup(TrigramWordSimilar)
+
+
+def set_word_similarity_threshold(using, threshold):
+    """
+    pg_trgm.word_similarity_threshold for the rest of the current transaction
+    on `using`, so a pooled connection doesn't keep it
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+            [str(float(threshold))],
+        )
@@ -4,7 +4,7 @@ from drf_writable_nested import WritableNestedModelSerializer
 from django.shortcuts import render, get_object_or_404
 
 from django.contrib.auth.models import User, Group
-from .models import Profile, Major, Minor, Mentor, Course
+from .models import Profile, Major, Minor, Mentor, Course, catalog_ids
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -63,43 +63,84 @@ class CourseSerializer(serializers.ModelSerializer):
         fields = ('id', 'name')
         read_only_fields = ('id',)
 
+# Nested in MentorSerializer a name refers to an existing entry, or creates
+# it, so the unique check on name doesn't apply
+class MentorMajorSerializer(MajorSerializer):
+    class Meta(MajorSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
+class MentorMinorSerializer(MinorSerializer):
+    class Meta(MinorSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
+class MentorCourseSerializer(CourseSerializer):
+    class Meta(CourseSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
 class MentorSerializer(WritableNestedModelSerializer):
     profile = ProfileSerializer()
-    major = MajorSerializer(many=True)
-    minor = MinorSerializer(many=True)
-    courses = CourseSerializer(many=True)
+    major = MentorMajorSerializer(many=True)
+    minor = MentorMinorSerializer(many=True)
+    courses = MentorCourseSerializer(many=True)
     class Meta:
         model = Mentor
         fields = ('id', 'profile', 'active', 'major', 'minor', 'bio', 'gpa', 'clubs', 'courses', 'pros', 'cons',)
         read_only_fields = ('id',)
 
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        # loads everything the nested serializers read in a fixed number of
+        # queries. prefix is the path to the mentor when serializing a
+        # relation, e.g. 'mentor__'
+        return queryset.select_related(
+            prefix + 'profile__user',
+        ).prefetch_related(
+            prefix + 'major',
+            prefix + 'minor',
+            prefix + 'courses',
+        )
+
+    # (field, catalog model, most links a mentor can have)
+    CATALOG_LINKS = (
+        ('major', Major, 2),
+        ('minor', Minor, 3),
+        ('courses', Course, None),
+    )
+
+    def sync_links(self, instance, field, model, names):
+        """
+        Makes `instance`'s links in `field` exactly `names`. Only through rows
+        that change are written, without m2m_changed signals; saving the
+        mentor afterwards refreshes what they would have
+        """
+        ids = set(catalog_ids(model, names).values())
+        relation = Mentor._meta.get_field(field)
+        through = relation.remote_field.through
+        column = relation.m2m_reverse_name()
+
+        links = through.objects.filter(**{relation.m2m_column_name(): instance.id})
+        current = set(links.values_list(column, flat=True))
+        if current - ids:
+            links.filter(**{column + '__in': current - ids}).delete()
+        if ids - current:
+            through.objects.bulk_create(
+                through(**{relation.m2m_column_name(): instance.id, column: id})
+                for id in ids - current
+            )
 
     def update(self, instance, validated_data):
-        if 'courses' in validated_data:
-            instance.courses.clear()
-            courses_obj = validated_data.pop('courses')
-            for crs in courses_obj:
-                co, _ = Course.objects.get_or_create(name=crs['name'])
-                instance.courses.add(co)
-                instance.save()
-
-        if 'minor' in validated_data:
-            instance.minor.clear()
-            minor_obj = validated_data.pop('minor')
-            for mnr in minor_obj:
-                mi, _ = Minor.objects.get_or_create(name=mnr['name'])
-                instance.minor.add(mi)
-                instance.save()
-
-        if 'major' in validated_data:
-            instance.major.clear()
-            major_obj = validated_data.pop('major')
-            for mjr in major_obj:
-                ma, _ = Major.objects.get_or_create(name=mjr['name'])
-                instance.major.add(ma)
-                instance.save()
-
+        links = []
+        for field, model, limit in self.CATALOG_LINKS:
+            if field in validated_data:
+                names = {entry['name'] for entry in validated_data.pop(field)}
+                # sync_links() skips the m2m_changed limits, so they're
+                # checked here, before anything is written
+                if limit is not None and len(names) > limit:
+                    raise serializers.ValidationError({field: "You can't assign more than {} {}".format(
+                        limit, model._meta.verbose_name_plural,
+                    )})
+                links.append((field, model, names))
+        for field, model, names in links:
+            self.sync_links(instance, field, model, names)
 
         return super().update(instance, validated_data)
-
-
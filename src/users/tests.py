@@ -4,12 +4,17 @@ from __future__ import unicode_literals
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
 from django.contrib.auth.models import User
-from .models import Profile, Mentor, Minor, Major, Course
+from .models import Profile, Mentor, Minor, Major, Course, MentorSearchDocument, catalog_ids
+from .catalog import get_catalog
 from . import factories
-from django.db import transaction
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils.six import StringIO
 from django.core.exceptions import ValidationError
 
 # Create your tests here.
@@ -308,6 +313,17 @@ class MentorsSearchTest(APITestCase):
         )
         self.assertEqual(resp.data['count'], 3)
 
+    def test_similarity_threshold(self):
+        factories.MentorFactory(profile__user__last_name='Muhammad')
+        # word_similarity('Mohammed', 'Muhammad') is 0.25
+        resp = self.client.get(self.mentors_search_url, data={'query': 'Mohammed'})
+        self.assertEqual(resp.data['count'], 0)
+
+        with self.settings(MENTOR_SEARCH_WORD_SIMILARITY=0.2):
+            resp = self.client.get(self.mentors_search_url, data={'query': 'Mohammed'})
+        self.assertEqual(resp.data['count'], 1)
+        self.assertEqual(resp.data['results'][0]['profile']['last_name'], 'Muhammad')
+
     def test_query_aliases_do_not_exclude_original_query(self):
         resp = self.client.get(
             self.mentors_search_url,
@@ -531,6 +547,161 @@ class MentorsSearchWithFiltersTest(APITestCase):
         self.assertEqual(resp.data['count'],1)
         self.assertEqual(resp.data['results'][0]['profile']['id'], self.profile8.id)
 
+class MentorSearchDocumentTest(TestCase):
+    def setUp(self):
+        self.major = factories.MajorFactory(name='Physics')
+        self.mentor = factories.MentorFactory(major=[self.major], bio='Likes telescopes')
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Major.objects.all().delete()
+        Minor.objects.all().delete()
+        Course.objects.all().delete()
+
+    def get_document(self):
+        return MentorSearchDocument.objects.get(mentor=self.mentor)
+
+    def test_document_created_with_mentor(self):
+        document = self.get_document()
+        self.assertEqual(document.name, '%s %s' % (self.mentor.profile.user.first_name, self.mentor.profile.user.last_name))
+        self.assertEqual(document.majors, 'Physics')
+        self.assertEqual(document.bio, 'Likes telescopes')
+        self.assertIn('telescopes', document.document)
+
+    def test_document_follows_user_changes(self):
+        user = self.mentor.profile.user
+        user.first_name = 'Renamed'
+        user.save()
+        self.assertTrue(self.get_document().name.startswith('Renamed '))
+
+    def test_document_follows_m2m_changes(self):
+        minor = factories.MinorFactory(name='Astronomy')
+        course = factories.CourseFactory(name='PHYSICS 1A')
+        self.mentor.minor.add(minor)
+        self.mentor.courses.add(course)
+        self.mentor.major.remove(self.major)
+
+        document = self.get_document()
+        self.assertEqual(document.majors, '')
+        self.assertEqual(document.minors, 'Astronomy')
+        self.assertEqual(document.courses, 'PHYSICS 1A')
+
+    def test_document_follows_reverse_m2m_clear(self):
+        self.major.mentor_set.clear()
+        self.assertEqual(self.get_document().majors, '')
+
+    def test_document_follows_catalog_rename(self):
+        self.major.name = 'Applied Physics'
+        self.major.save()
+        self.assertEqual(self.get_document().majors, 'Applied Physics')
+
+    def test_document_deleted_with_mentor(self):
+        mentor_id = self.mentor.id
+        self.mentor.delete()
+        self.assertFalse(MentorSearchDocument.objects.filter(mentor_id=mentor_id).exists())
+
+class MentorCompletionScoreTest(APITestCase):
+    mentors_search_url = reverse('users:mentors_search')
+    def setUp(self):
+        self.mentor = factories.MentorFactory()
+        self.client.force_authenticate(user=factories.ProfileFactory().user)
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Major.objects.all().delete()
+
+    def test_score_follows_mentor_changes(self):
+        self.mentor.refresh_from_db()
+        score = self.mentor.completion_score
+
+        self.mentor.bio = 'Happy to help'
+        self.mentor.save()
+        self.mentor.major.add(factories.MajorFactory(name='Physics'))
+
+        self.mentor.refresh_from_db()
+        self.assertEqual(self.mentor.completion_score, score + 2)
+
+    def test_score_follows_profile_changes(self):
+        self.mentor.refresh_from_db()
+        score = self.mentor.completion_score
+
+        profile = self.mentor.profile
+        profile.phone_number = '(012)345-6789'
+        profile.save()
+
+        self.mentor.refresh_from_db()
+        self.assertEqual(self.mentor.completion_score, score + 1)
+
+    def test_backfill_command(self):
+        Mentor.objects.update(completion_score=0)
+        call_command('backfill_completion_scores', stdout=StringIO())
+        self.mentor.refresh_from_db()
+        self.assertEqual(self.mentor.completion_score, self.mentor.calculate_completion_score())
+        self.assertGreater(self.mentor.completion_score, 0)
+
+    def test_search_ranks_complete_profiles_first(self):
+        major = factories.MajorFactory(name='Geography')
+        sparse = factories.MentorFactory(major=[major])
+        complete = factories.MentorFactory(major=[major], bio='Ask me anything', clubs='Hiking club')
+
+        resp = self.client.get(
+            self.mentors_search_url,
+            data={
+                'query': 'Geography',
+                'major': 'True',
+                'bio': 'True',
+            },
+        )
+        self.assertEqual(resp.data['count'], 2)
+        self.assertEqual(resp.data['results'][0]['id'], complete.id)
+        self.assertEqual(resp.data['results'][1]['id'], sparse.id)
+
+class MentorListQueryCountTest(APITestCase):
+    """
+    Mentor list endpoints must run a fixed number of queries per page,
+    however many mentors are on it
+    """
+    mentors_search_url = reverse('users:mentors_search')
+    mentors_list_url = '/drf/mentors/'
+
+    def setUp(self):
+        self.client.force_authenticate(user=factories.ProfileFactory().user)
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Major.objects.all().delete()
+        Minor.objects.all().delete()
+        Course.objects.all().delete()
+
+    def create_mentors(self, count):
+        # unique last names so generated emails/usernames can't collide
+        for i in range(count):
+            factories.MentorFactory(
+                profile__user__last_name='Query_Mentor_{}_{}'.format(count, i),
+                major=[factories.MajorFactory(name='Query_Major')],
+                minor=[factories.MinorFactory(name='Query_Minor')],
+                courses=[factories.CourseFactory(name='Query_Course')],
+            )
+
+    def assertPageQueries(self, url, data, num_queries):
+        # count, mentors + profile + user, then one prefetch per m2m
+        for count in (2, 20):
+            self.create_mentors(count)
+            with self.assertNumQueries(num_queries):
+                resp = self.client.get(url, data=data)
+            self.assertEqual(len(resp.data['results']), Mentor.objects.count())
+            Mentor.objects.all().delete()
+
+    def test_mentor_viewset_queries(self):
+        self.assertPageQueries(self.mentors_list_url, {}, 5)
+
+    def test_search_without_query_queries(self):
+        self.assertPageQueries(self.mentors_search_url, {}, 5)
+
+    def test_search_with_query_queries(self):
+        # and setting the search's similarity threshold, in a savepoint here
+        self.assertPageQueries(self.mentors_search_url, {'query': 'Query_Major'}, 8)
+
 class MentorsUpdateTest(APITestCase):
     mentors_update_url = reverse('users:mentors_me')
     def setUp(self):
@@ -656,6 +827,22 @@ class MajorEdittingTest(APITestCase):
         self.assertEqual(len(major), 1)
         self.assertEqual(major[0].name, 'New_Major')
 
+    def test_update_existing_major(self):
+        existing = Major.objects.create(name='Existing_Major')
+        user_params = {
+            'major': [
+                { 'name' : 'Existing_Major' },
+            ],
+        }
+        resp = self.client.patch(
+            self.mentors_update_url,
+            data=user_params,
+            format='json',
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(self.mentor.major.all()), [existing])
+        self.assertEqual(Major.objects.filter(name='Existing_Major').count(), 1)
+
     def test_add_multiple_majors(self):
         user_params = {
             'major': [
@@ -692,6 +879,30 @@ class MajorEdittingTest(APITestCase):
         except ValidationError as e:
             self.assertEquals('invalid', e.code)
         
+    def test_limit_majors_returns_400(self):
+        resp = self.client.patch(
+            self.mentors_update_url,
+            data={'major': [{'name': 'A'}, {'name': 'B'}, {'name': 'C'}]},
+            format='json',
+        )
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.mentor.major.count(), 0)
+        self.assertFalse(Major.objects.filter(name='A').exists())
+
+    def test_limit_majors_on_add(self):
+        first, second, third = [factories.MajorFactory(name='Limit_Major{}'.format(i)) for i in range(3)]
+        self.mentor.major.add(first, second)
+        # already linked majors don't count again
+        self.mentor.major.add(first)
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.mentor.major.add(third)
+        self.assertEqual(set(self.mentor.major.all()), {first, second})
+
+        # only adding checks the limit
+        with CaptureQueriesContext(connection) as queries:
+            self.mentor.major.remove(first)
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+
 class MinorEdittingTest(APITestCase):
     mentors_update_url = reverse('users:mentors_me')
     def setUp(self):
@@ -848,3 +1059,98 @@ class CourseEdittingTest(APITestCase):
         self.assertEqual(courses[0].name, 'Test_Course')
         self.assertEqual(courses[1].name, 'Test_Course2')
         self.assertEqual(courses[2].name, 'Test_Course3')
+
+
+    def test_update_courses_only_writes_changes(self):
+        kept = Course.objects.create(name='Kept_Course')
+        self.mentor.courses.add(kept, Course.objects.create(name='Dropped_Course'))
+        kept_link = Mentor.courses.through.objects.get(mentor=self.mentor, course=kept)
+
+        # the same queries however many courses change, once the catalog
+        # is loaded
+        catalog = get_catalog(Course)
+        catalog.recheck()
+        catalog.ids
+        queries = []
+        for count in (2, 12):
+            user_params = {
+                'courses': [{'name': 'Kept_Course'}] + [
+                    {'name': 'New_Course_{}_{}'.format(count, i)} for i in range(count)
+                ],
+            }
+            with CaptureQueriesContext(connection) as captured:
+                resp = self.client.patch(self.mentors_update_url, data=user_params, format='json')
+            self.assertEqual(resp.status_code, 200)
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+
+        names = set(self.mentor.courses.values_list('name', flat=True))
+        self.assertEqual(names, {'Kept_Course'} | {'New_Course_12_{}'.format(i) for i in range(12)})
+        self.assertTrue(Mentor.courses.through.objects.filter(id=kept_link.id).exists())
+        self.assertIn('New_Course_12_11', MentorSearchDocument.objects.get(mentor=self.mentor).courses)
+
+class PopulateTablesTest(TestCase):
+
+    def test_idempotent(self):
+        Major.objects.create(name='Computer Science B.S.')
+
+        out = StringIO()
+        call_command('populate_tables', '--batch-size', '50', stdout=out)
+        majors = Major.objects.count()
+        self.assertIn('Courses: {} inserted, 0 skipped'.format(Course.objects.count()), out.getvalue())
+        self.assertEqual(Major.objects.filter(name='Computer Science B.S.').count(), 1)
+
+        out = StringIO()
+        call_command('populate_tables', stdout=out)
+        self.assertEqual(Major.objects.count(), majors)
+        self.assertIn('Majors: 0 inserted', out.getvalue())
+        self.assertIn('Courses: 0 inserted, {} skipped'.format(Course.objects.count()), out.getvalue())
+
+
+class CatalogTest(APITransactionTestCase):
+    majors_url = '/drf/majors/'
+
+    def setUp(self):
+        self.client.force_authenticate(user=factories.ProfileFactory().user)
+        Major.objects.create(name='Physics')
+        Major.objects.create(name='Art')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_list_with_etag(self):
+        resp = self.client.get(self.majors_url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([entry['name'] for entry in resp.data['results']], ['Art', 'Physics'])
+        etag = resp['ETag']
+
+        # served from the catalog, revalidated with the ETag
+        with CaptureQueriesContext(connection) as captured:
+            resp = self.client.get(self.majors_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse([query for query in captured if 'users_major' in query['sql']])
+
+        Major.objects.create(name='Biology')
+        resp = self.client.get(self.majors_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual([entry['name'] for entry in resp.data['results']], ['Art', 'Biology', 'Physics'])
+
+    def test_invalidated_on_delete(self):
+        catalog = get_catalog(Major)
+        self.assertIn('Art', catalog.ids)
+        physics = catalog.ids['Physics']
+        self.assertEqual(catalog.names[physics], 'Physics')
+
+        Major.objects.filter(name='Art').delete()
+        self.assertNotIn('Art', catalog.ids)
+
+    def test_catalog_ids(self):
+        get_catalog(Major).ids
+        with self.assertNumQueries(0):
+            ids = catalog_ids(Major, ['Physics'])
+        self.assertEqual(ids, {'Physics': Major.objects.get(name='Physics').id})
+
+        ids = catalog_ids(Major, ['Physics', 'Chemistry'])
+        self.assertEqual(ids['Chemistry'], Major.objects.get(name='Chemistry').id)
+        self.assertIn('Chemistry', get_catalog(Major).ids)
@@ -13,22 +13,27 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser
 
 from django.contrib.auth.models import User, Group
-from django.db import transaction
+from django.db import router, transaction
 from django.conf import settings
 from django.db.models import Q, F, Value
-from django.http import HttpResponse
-from django.contrib.postgres.search import TrigramSimilarity
+from django.http import Http404, HttpResponse
+from django.utils.http import parse_etags
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.db.models.functions import Greatest
 
 
 from .models import Profile, Major, Minor, Mentor, Course
+from .catalog import get_catalog
+from .search import TrigramWordSimilarity, set_word_similarity_threshold
 from .serializers import (
     UserSerializer, GroupSerializer, ProfileSerializer, MajorSerializer,
     MinorSerializer, MentorSerializer, CourseSerializer,
 )
 
-import sendgrid
-from sendgrid.helpers.mail import Email, Content, Substitution, Mail
+from outbox.models import OutboundEmail
+from pickmybruin import metrics
+from pickmybruin.authentication import get_own_profile
+from pickmybruin.routers import ReplicaReadsMixin
 from pickmybruin.settings import USER_VERIFICATION_TEMPLATE, PASSWORD_RESET_TEMPLATE
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -55,21 +60,39 @@ class ProfileViewSet(viewsets.ModelViewSet):
     serializer_class = ProfileSerializer
 
 
-class MajorViewSet(viewsets.ModelViewSet):
+class CatalogListMixin(object):
+    """
+    Lists Major, Minor or Course from the cached catalog instead of the
+    table, with an ETag so clients can revalidate with If-None-Match
+    """
+    def list(self, request, *args, **kwargs):
+        catalog = get_catalog(self.queryset.model)
+        etag = catalog.etag
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=304)
+        else:
+            entries = catalog.entries
+            page = self.paginate_queryset(entries)
+            response = self.get_paginated_response(page) if page is not None else Response(entries)
+        response['ETag'] = etag
+        return response
+
+
+class MajorViewSet(CatalogListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows majors to be viewed or edited.
     """
     queryset = Major.objects.all()
     serializer_class = MajorSerializer
 
-class MinorViewSet(viewsets.ModelViewSet):
+class MinorViewSet(CatalogListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows minors to be viewed or edited.
     """
     queryset = Minor.objects.all()
     serializer_class = MinorSerializer
 
-class CourseViewSet(viewsets.ModelViewSet):
+class CourseViewSet(CatalogListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows courses to be viewed or edited.
     """
@@ -81,7 +104,7 @@ class MentorViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows mentors to be viewed or edited.
     """
-    queryset = Mentor.objects.all()
+    queryset = MentorSerializer.setup_eager_loading(Mentor.objects.all())
     serializer_class = MentorSerializer
 
 
@@ -119,84 +142,67 @@ class CreateUser(generics.CreateAPIView):
         if settings.DEBUG:
             url = 'http://localhost:8000/verify?code='
 
-        from_email =  Email('noreply@bquest.ucladevx.com')
-        to_email = Email(new_user.email)
-        subject = 'BQuest User Verification'
         verification_link = url + new_profile.verification_code
-        content = Content('text/html', 'N/A')
-        mail = Mail(from_email, subject, to_email, content)
-        mail.personalizations[0].add_substitution(Substitution('-link-', verification_link))
-        mail.template_id = USER_VERIFICATION_TEMPLATE
-        sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-        response = sg.client.mail.send.post(request_body=mail.get())
-        if not (200 <= response.status_code < 300):
-            raise ValidationError({'status_code': response.status_code})
+        OutboundEmail.enqueue(
+            to_email=new_user.email,
+            subject='BQuest User Verification',
+            template_id=USER_VERIFICATION_TEMPLATE,
+            substitutions={'-link-': verification_link},
+        )
         return Response(ProfileSerializer(new_profile).data)
 
 
 class ResendVerifyUser(APIView):
     def post (self, request):
         email = self.request.user.email
-        verification_code = self.request.user.profile.verification_code
+        profile = get_own_profile(self.request)
+        verification_code = profile.verification_code
 
         url = 'https://bquest.ucladevx.com/verify?code='
         if settings.DEBUG:
             url = 'http://localhost:8000/verify?code='
-        from_email =  Email('noreply@bquest.ucladevx.com')
-        to_email = Email(email)
-        subject = 'BQuest User Verification'
         verification_link = url + verification_code
-        content = Content('text/html', 'N/A')
-        mail = Mail(from_email, subject, to_email, content)
-        mail.personalizations[0].add_substitution(Substitution('-link-', verification_link))
-        mail.template_id = USER_VERIFICATION_TEMPLATE
-        sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-        response = sg.client.mail.send.post(request_body=mail.get())
-        if not (200 <= response.status_code < 300):
-            raise ValidationError({'sendgrid_status_code': response.status_code})
-        return Response(ProfileSerializer(self.request.user.profile).data)
+        OutboundEmail.enqueue(
+            to_email=email,
+            subject='BQuest User Verification',
+            template_id=USER_VERIFICATION_TEMPLATE,
+            substitutions={'-link-': verification_link},
+        )
+        return Response(ProfileSerializer(profile).data)
 
 class VerifyUser(APIView):
     """
     API endpoint that verifies a user based on profile_id and associated verification code.
     """
     def post(self, request):
-        profile_id = self.request.user.profile.id
-        profile = get_object_or_404(Profile, id=profile_id)
+        profile = get_own_profile(self.request)
         if request.data['verification_code'] != profile.verification_code:
             raise ValidationError('Incorrect verification code')
 
         profile.verified = True
         profile.save()
-        return Response({'profile_id': profile_id})
+        return Response({'profile_id': profile.id})
 
 class SendPasswordReset(APIView):
     permission_classes = tuple()
     def post (self, request):
         email = request.data['username']
-        user = User.objects.get(username=email)
+        user = User.objects.select_related('profile').get(username=email)
 
-        profile_id = user.profile.id
-        profile = Profile.objects.get(id=profile_id)
+        profile = user.profile
         profile.password_reset_code = Profile.generate_password_reset_code()
         profile.save()
         url = 'https://bquest.ucladevx.com/password'
         if settings.DEBUG:
             url = 'http://localhost:8000/password'
 
-        from_email =  Email('noreply@bquest.ucladevx.com')
-        to_email = Email(email)
-        subject = 'BQuest User Password Reset'
         reset_link = "{}?code={}&userid={}".format(url, profile.password_reset_code, user.id)
-        content = Content('text/html', 'N/A')
-        mail = Mail(from_email, subject, to_email, content)
-        mail.personalizations[0].add_substitution(Substitution('password_reset_link', reset_link))
-        mail.template_id = PASSWORD_RESET_TEMPLATE
-
-        sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-        response = sg.client.mail.send.post(request_body=mail.get())
-        if not (200 <= response.status_code < 300):
-            raise ValidationError({'sendgrid_status_code': response.status_code})
+        OutboundEmail.enqueue(
+            to_email=email,
+            subject='BQuest User Password Reset',
+            template_id=PASSWORD_RESET_TEMPLATE,
+            substitutions={'password_reset_link': reset_link},
+        )
         return HttpResponse(status=200)
 
 class PasswordReset(APIView):
@@ -223,40 +229,15 @@ class OwnProfileView(generics.RetrieveUpdateDestroyAPIView):
     parser_classes = generics.RetrieveUpdateDestroyAPIView.parser_classes + [MultiPartParser]
     serializer_class = ProfileSerializer
     def get_object(self):
-        return get_object_or_404(Profile, user=self.request.user)
+        return get_own_profile(self.request)
 
-class MentorsSearchView(generics.ListAPIView):
+class MentorsSearchView(ReplicaReadsMixin, generics.ListAPIView):
     """
     View for finding a mentor by major, year
     """
-    queryset = Mentor.objects.all().filter(active=True)
+    queryset = MentorSerializer.setup_eager_loading(Mentor.objects.all().filter(active=True))
     serializer_class = MentorSerializer
 
-    # a utility function used to rate each mentor profile by completion.
-    # returns a number, which is used to sort the mentor search result.
-    def calculate_profile_completion_index(self, profile):
-        # these are the default values we don't want to count
-        omitted_values = ["", [], "0.00", None]
-        # profile object is an object itself, we count its attribute separately
-        # every user has an id, it's not informative
-        omitted_keys = {"profile", "id"}
-
-        # get the data
-        full_profile = self.serializer_class(profile).data
-
-        filled = 0
-        # count the number of filled in fields in the user profile
-        for key, value in full_profile["profile"].items():
-            if value not in omitted_values and key not in omitted_keys:
-                filled += 1
-
-        # count the number of filled in fields in the mentor profile
-        for key, value in full_profile.items():
-            if value not in omitted_values and key not in omitted_keys:
-                filled += 1
-
-        return filled
-
     def filter_queryset(self, queryset):
         queryset = queryset.exclude(profile__user=self.request.user)
         trans_dict = {
@@ -290,7 +271,9 @@ class MentorsSearchView(generics.ListAPIView):
 
         if 'query' in self.request.GET:
             query = self.request.GET['query']
-            query = query.split(' ')
+            query = [item for item in query.split(' ') if item]
+            if not query:
+                return queryset.none()
             ct=0
 
             if 'name' in self.request.GET:
@@ -303,91 +286,49 @@ class MentorsSearchView(generics.ListAPIView):
                 filter_bio = is_true(self.request.GET['bio'])
                 ct+=1
 
-            #if no filters are checked, all filters are on by default
+            #if no filters are checked, all filters are on by default and the
+            #whole search document is matched, which also covers minors,
+            #courses and clubs
             if filter_name==False and filter_major==False and filter_bio==False:
                 filter_name = True
                 filter_major = True
                 filter_bio = True
                 ct=3
-
-            # initialize the queryset for the similarity calculation
-            # similarity_name/bio/major: TrigramSimilarity between curr word
-            # and the mentor's name/bio/major
-            # similarity_name/bio/major_max: max TrigramSimilarity across all
-            # words compared with the mentor's name/bio/major
-            # similarity: the total TrigramSimilarity value between the query
-            # and the mentor's name&bio&major. Used to rank result
-            queryset = queryset.annotate(
-                similarity_name = Value(0),
-                similarity_name_max = Value(0),
-                similarity_major = Value(0),
-                similarity_major_max = Value(0),
-                similarity_bio = Value(0),
-                similarity_bio_max = Value(0),
-                similarity = Value(0)
-            )
-
-            # iterate over each word in the query
+                columns = ['document']
+            else:
+                columns = [column for column, enabled in (
+                    ('name', filter_name),
+                    ('majors', filter_major),
+                    ('bio', filter_bio),
+                ) if enabled]
+
+            # match: a mentor is returned if any query word (or its alias) is
+            # similar to one of the searched columns. Each `%>` comparison can
+            # use the column's trigram index, so this is one indexed query.
+            # similarity: sum over query words of the best similarity among the
+            # searched columns. Used to rank result
+            match = Q()
+            similarity = None
             for item in query:
-                item_alias = trans_dict.get(item.lower(),item)
-
-                # Compare each query word to the user profile, major, and bio
-                queryset = queryset.annotate(
-                    similarity_name=Greatest(
-                        TrigramSimilarity('profile__user__first_name', item),
-                        TrigramSimilarity('profile__user__last_name', item),
-                        TrigramSimilarity('profile__user__first_name', item_alias),
-                        TrigramSimilarity('profile__user__last_name', item_alias),
-                        Value(0)    # Nones are super annoying, so we weed them out here like this
-                    ),
-                    similarity_major=Greatest(
-                        TrigramSimilarity('major__name', item),
-                        TrigramSimilarity('major__name', item_alias),
-                        Value(0)
-                    ),
-                    similarity_bio=Greatest(
-                        TrigramSimilarity('bio', item),
-                        TrigramSimilarity('bio', item_alias),
-                        Value(0)
-                    )
-                )
-
-                queryset = queryset.annotate(
-                    similarity_name_max = Greatest(
-                        F("similarity_name"),
-                        F("similarity_name_max")
-                    ),
-                    similarity_major_max = Greatest(
-                        F("similarity_major"),
-                        F("similarity_major_max")
-                    ),
-                    similarity_bio_max = Greatest(
-                        F("similarity_bio"),
-                        F("similarity_bio_max")
-                    ),
-                    similarity =
-                        F("similarity_name") +
-                        F("similarity_major") +
-                        F("similarity_bio") +
-                        F("similarity")
+                terms = {item, trans_dict.get(item.lower(), item)}
+                word_similarities = []
+                for term in terms:
+                    for column in columns:
+                        field = 'search_document__' + column
+                        match |= Q(**{field + '__trigram_word_similar': term})
+                        word_similarities.append(TrigramWordSimilarity(term, field))
+
+                word_similarity = Greatest(*word_similarities, Value(0))
+                similarity = word_similarity if similarity is None else similarity + word_similarity
+
+            # exact word hits anywhere in the document rank above fuzzy ones
+            if columns == ['document']:
+                similarity = similarity + SearchRank(
+                    F('search_document__search_vector'),
+                    SearchQuery(' '.join(query), config='simple'),
                 )
 
-
-            queryset_name = Mentor.objects.none()
-            queryset_major = Mentor.objects.none()
-            queryset_bio = Mentor.objects.none()
-            #if name filter is checked
-            if filter_name:
-                queryset_name = queryset.filter(similarity_name_max__gte=0.10)
-            #if major filter is checked
-            if filter_major:
-                queryset_major = queryset.filter(similarity_major_max__gte=0.10)
-                #if bio filter is checked
-            if filter_bio:
-                queryset_bio = queryset.filter(similarity_bio_max__gte=0.10)
-
-            # take the intersection of all three filtered querysets
-            queryset = queryset_name | queryset_major | queryset_bio
+            queryset = queryset.filter(match).annotate(similarity=similarity)
 
         else:
             return queryset
@@ -402,14 +343,27 @@ class MentorsSearchView(generics.ListAPIView):
 
         else:
             if ct > 1:
-                # sort by similarity
-                queryset = queryset.order_by("-similarity")
-                # sort by profile completion
-                queryset = sorted(queryset,
-                    key=lambda each: self.calculate_profile_completion_index(each),
-                    reverse=True)
+                # sort by similarity, then by profile completion. Both happen
+                # in the database so pagination only loads one page
+                queryset = queryset.order_by('-similarity', '-completion_score', 'id')
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        if 'query' not in request.GET:
+            return super().list(request, *args, **kwargs)
+        # `%>` matches at pg_trgm.word_similarity_threshold
+        using = router.db_for_read(Mentor)
+        with transaction.atomic(using=using):
+            set_word_similarity_threshold(using, settings.MENTOR_SEARCH_WORD_SIMILARITY)
+            return super().list(request, *args, **kwargs)
+
+    # the search query runs when the page is fetched
+    def paginate_queryset(self, queryset):
+        if 'query' not in self.request.GET:
+            return super().paginate_queryset(queryset)
+        with metrics.SEARCH_SECONDS.labels(view='mentors').time():
+            return super().paginate_queryset(queryset)
+
 
 class MentorView(generics.RetrieveAPIView):
     """
@@ -417,7 +371,8 @@ class MentorView(generics.RetrieveAPIView):
     """
     serializer_class = MentorSerializer
     def get_object(self):
-        return get_object_or_404(Mentor, id=int(self.kwargs['mentor_id']))
+        mentors = MentorSerializer.setup_eager_loading(Mentor.objects.all())
+        return get_object_or_404(mentors, id=int(self.kwargs['mentor_id']))
 
 
 class OwnMentorView(generics.RetrieveUpdateDestroyAPIView):
@@ -426,19 +381,24 @@ class OwnMentorView(generics.RetrieveUpdateDestroyAPIView):
     """
     serializer_class = MentorSerializer
     def get_object(self):
-        return get_object_or_404(Mentor, profile__user=self.request.user)
+        profile = get_own_profile(self.request)
+        if profile.own_mentor_id is None:
+            raise Http404
+        mentor = get_object_or_404(Mentor, id=profile.own_mentor_id)
+        mentor.profile = profile
+        return mentor
     serializer_class = MentorSerializer
     def post (self,request):
 
-        profile_id = self.request.user.profile.id
-        profile = Profile.objects.get(id=profile_id)
-        mentor_request = Mentor.objects.filter(profile__user=self.request.user)
-        if not mentor_request.exists():
+        profile = get_own_profile(self.request)
+        if profile.own_mentor_id is None:
             mentor = Mentor(profile=profile, active=True)
         else:
-            mentor = mentor_request.first()
+            mentor = Mentor.objects.get(id=profile.own_mentor_id)
+            mentor.profile = profile
             mentor.active = True
         mentor.save()
+        profile.own_mentor_id = mentor.id
 
         return Response(MentorSerializer(mentor).data)
 
@@ -458,14 +418,10 @@ class ReportUser(APIView):
             reported_profile.user.last_name,
             reported_profile.user.email,
             reason)
-        from_email =  Email(email)
-        to_email = Email('bquest.ucla@gmail.com')
-        subject = '[URGENT] BQuest Reported User'
-        content = Content('text/html', message)
-        mail = Mail(from_email, subject, to_email, content)
-
-        sg = sendgrid.SendGridAPIClient(apikey=settings.SENDGRID_API_KEY)
-        response = sg.client.mail.send.post(request_body=mail.get())
-        if not (200 <= response.status_code < 300):
-            raise ValidationError({'sendgrid_status_code': response.status_code})
+        OutboundEmail.enqueue(
+            from_email=email,
+            to_email='bquest.ucla@gmail.com',
+            subject='[URGENT] BQuest Reported User',
+            content=message,
+        )
         return HttpResponse(status=200)